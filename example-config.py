@@ -4,6 +4,15 @@
 host = 'localhost' # '0.0.0.0' to listen on all addresses
 port = 8625,
 
+# sicdsapp can fork worker processes sharing the port, each serving requests
+# with a pool of threads (--workers and --threads on the command line take
+# precedence). workers need a store they can share: mongodb:, couchdb:,
+# sqlite: or shm: (optionally wrapped by coalesce+, or by lru+ without
+# partition, since a purge cannot empty the other workers' caches). threads
+# need a store which is safe with a threaded server (not tmp:).
+#workers = 4 # 0 to serve in a single process
+#threads = 8
+
 # clients must supply one of these keys to use the API
 keys = [
     'abracadabra',
@@ -12,6 +21,18 @@ keys = [
 # new keys can be registered using this superkey
 superkey = 'simsalabim'
 
+# with several processes or nodes sharing a store, keys registered through one
+# are picked up by the others every so many seconds (only the keys registered
+# since the last refresh are read from mongodb: and couchdb: stores):
+#keys_refresh = 5.0
+
+# alternatively, /register can issue keys of the form <newkey>.<signature>,
+# signed with the superkey, which every node checks without any lookup or
+# coordination. keys in the store (and the keys above) keep working. changing
+# the superkey invalidates all signed keys; single keys can be revoked:
+#signed_keys = True
+#revoked_keys = []
+
 # available backends for persistent storage (choose one):
 # databases will be created on startup if they don't exist already
 
@@ -21,15 +42,96 @@ superkey = 'simsalabim'
 # CouchDB:
 #store = 'couchdb://localhost:5984/sicds'
 # note: this creates two databases, 'sicds' and 'sicds_keys'
+# records are added over a pool of persistent connections, whose size and
+# timeout (also for waiting on a free connection) can be set:
+#store = 'couchdb://localhost:5984/sicds?pool_size=10&timeout=30'
+
+# SQLite (no server needed, safe for several threads and processes):
+#store = 'sqlite:///var/lib/sicds/sicds.sqlite'
+
+# hash table in a memory-mapped file, for a single process on a single node:
+#store = 'file:///var/lib/sicds/difs'
+# note: keys and log records go in /var/lib/sicds/difs.keys and difs.log
 
 # in memory:
 store = 'tmp:'
 # note: all data will be lost when process terminates, use only for testing
 # memory is not shared, use only with single-threaded server
 
+# in memory, safe to use with a threaded server:
+#store = 'striped:?stripes=16'
+# note: all data will be lost when process terminates
+
+# tmp: and striped: can be bounded, evicting the oldest digests to stay within
+# a number of entries and/or an estimated number of bytes of memory
+# (evictions are counted in the stats returned by /stats; not with lru+):
+#store = 'striped:?stripes=16&max_entries=10000000&max_bytes=1073741824'
+
+# in memory, compactly (8 or 16 bytes per digest), safe with a threaded server:
+#store = 'compact:?fingerprint_bits=128&buffer_size=65536'
+# note: all data will be lost when process terminates. needs numpy.
+# with fingerprint_bits=64, a new item is very rarely mistaken for a duplicate
+
+# in shared memory, seen by all worker processes forked from one master:
+#store = 'shm:?slots=16777216&stripes=64'
+# note: all data will be lost when the last process terminates
+
+# dif collections are identified by digests. any of the stores above can
+# take options in its url to choose how they are made, e.g.:
+#store = 'mongodb://localhost:27017/sicds?hash=blake2b&digest_size=16'
+# hash: 'legacy' (the default, sha1 as made by earlier versions), 'sha1',
+#   'sha256' or 'blake2b' (fastest, needs the pyblake2 package)
+# digest_size: bytes per digest, for shorter digests
+# to switch an existing store to a new scheme without forgetting what it
+# has seen, add migrate_from=<old scheme> until the old digests have aged out
+# (not possible for file: and shm: stores if the digest sizes differ)
+
+# to have content seen more than some number of days ago count as new again,
+# and keep the store from growing without bound, add e.g. retention_days=30
+# (mongodb:, couchdb:, sqlite:, tmp: and striped: only; not with lru+):
+#store = 'mongodb://localhost:27017/sicds?retention_days=30'
+# mongodb: deletes expired records with a TTL index. couchdb: puts records in
+# a database per 1/8th of the window (sicds_difs_<n>) and deletes old ones.
+
+# to keep each client's dif records apart, so that all of them can be dropped
+# at once with POST /purge {"superkey": ..., "key": ...}, add partition=1
+# (mongodb:, couchdb:, sqlite: and tmp: only; couchdb: not with retention_days):
+#store = 'mongodb://localhost:27017/sicds?partition=1'
+# each key gets a collection (mongodb:), database (couchdb:) or table (sqlite:)
+# named difs_<hash of the key>.
+
+# any of the above can be wrapped by prefixing its url with a wrapper scheme:
+# bloom filter of all digests in the store, so that digests never seen before
+# skip checking the store (only valid while this is the store's only writer):
+#store = 'bloom+mongodb://localhost:27017/sicds?bloom_capacity=10000000&bloom_error_rate=0.001&bloom_snapshot=/var/lib/sicds/bloom'
+# cache of recently seen digests, so repeats are answered without the store:
+#store = 'lru+mongodb://localhost:27017/sicds?lru_bytes=67108864'
+# with a threaded server, merge the digests of concurrent requests into one
+# write to the store, gathered for up to coalesce_ms or coalesce_max digests:
+#store = 'coalesce+mongodb://localhost:27017/sicds?coalesce_ms=2&coalesce_max=1000'
+# answer from an index in memory once new digests are synced to a local
+# journal, and add them to the store in the background (replayed on restart
+# after a crash, drained on exit; only while this is the store's only writer):
+#store = 'journal+mongodb://localhost:27017/sicds?journal=/var/lib/sicds/journal&journal_flush_interval=1.0'
+# with a threaded server, give each thread an instance of the store (and a
+# connection to it) of its own, or share a pool of pool_instances of them,
+# waiting up to pool_timeout seconds for a free one (mongodb:, couchdb: and
+# sqlite: only, whose instances share their records; put other wrappers first):
+#store = 'pool+mongodb://localhost:27017/sicds?pool_instances=8&pool_timeout=30'
+# wrappers can be combined, the leftmost one sees requests first:
+#store = 'lru+bloom+mongodb://localhost:27017/sicds'
+
 # configure one or more loggers:
 loggers = [
     'null:', # suppress logging (otherwise default is to stdout)
     'file:///dev/stdout', # log to specified file
     'store:' # log to whatever was configured as the store
     ]
+
+# by default every logger is called before each response is returned.
+# instead, log records can be queued and added to the loggers in batches by a
+# background thread (bulk inserts for MongoDB and CouchDB):
+#log_queue_size = 10000 # max records waiting to be logged
+#log_batch_size = 100 # max records added in one go
+#log_flush_interval = 1.0 # max seconds a record waits for its batch to fill
+#log_when_full = 'drop' # or 'block' to make requests wait for room
@@ -25,8 +25,8 @@ def die(msg):
     stderr.write(msg+'\n')
     exit(1)
 
-if not ((2, 6, 5) <= version_info < (3,)):
-    die('Python>=2.6.5,<3 required.') 
+if not ((2, 7, 7) <= version_info < (3,)):
+    die('Python>=2.7.7,<3 required.') 
 
 try:
     from setuptools import setup, find_packages
@@ -51,14 +51,16 @@ setup(name='SiCDS',
       description='SwiftRiver Content Duplication Service',
       long_description=long_description,
       install_requires=[
-          #'Python>=2.6.5,<3.0'
+          #'Python>=2.7.7,<3.0'
           'WebOb>=0.9.8',
           'simplejson>=2.1.1',
           ],
       extras_require = {
           'CouchDB': ["CouchDB>=0.7"],
-          'MongoDB': ["pymongo>=1.6"],
-          'Tornado': ["Tornado>=0.2"],
+          'MongoDB': ["pymongo>=2.7"],
+          'Tornado': ["Tornado>=3.0", "futures>=2.1"],
+          'BLAKE2': ["pyblake2>=1.0"],
+          'compact': ["numpy>=1.7"],
           'tests': ["WebTest>=1.2.1"],
           },
       entry_points=dict(
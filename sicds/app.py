@@ -19,9 +19,14 @@
 # Boston, MA  02110-1301
 # USA
 
-from sicds.base import StoreError
-from sicds.schema import Schema, SchemaError, many, t_uni
+from sicds.base import PartialStoreError, RawJson, StoreError
+from sicds.keys import sign_key, verify_key
+from sicds.schema import Schema, SchemaError, compile_schema, many, t_uni
+from itertools import chain, islice
 from simplejson import JSONDecodeError, load, loads, dumps
+from simplejson.encoder import encode_basestring_ascii
+from sys import stderr
+from threading import Event, Thread
 from urlparse import urlsplit
 from webob import Response, exc
 from webob.dec import wsgify
@@ -32,6 +37,18 @@ class KeyRegRequest(Schema):
 class KeyRegResponse(Schema):
     required = {'key': t_uni, 'result': t_uni}
 
+class StatsRequest(Schema):
+    required = {'superkey': t_uni}
+
+class StreamRequest(Schema):
+    required = {'key': t_uni}
+
+class PurgeRequest(Schema):
+    required = {'superkey': t_uni, 'key': t_uni}
+
+class PurgeResponse(Schema):
+    required = {'key': t_uni, 'result': t_uni}
+
 class Dif(Schema):
     required = {'type': t_uni, 'value': t_uni}
 
@@ -76,12 +93,65 @@ class IDResult(Schema):
 class IDResponse(Schema):
     required = {'key': t_uni, 'results': many(IDResult, atleast=1)}
 
+#: validates identify requests without going through :class:`Schema`'s
+#: generic constructor for every item, collection and dif
+_parse_idrequest = compile_schema(IDRequest)
+_parse_item = compile_schema(ContentItem)
+
+def _dumps_template(schema, **fields):
+    '''
+    Returns a format string (for the % operator) for the JSON encoding of an unwrapped
+    ``schema`` instance, given the encoded value of each field. The fields
+    are laid out in the same order ``dumps`` finds them in when iterating
+    over :attr:`Schema.unwrap`.
+    '''
+    order = dict((field, None) for field in
+        chain(schema.required, schema.optional))
+    return '{' + ', '.join('{0}: {1}'.format(dumps(field), fields[field])
+        for field in order) + '}'
+
+_IDRESPONSE = _dumps_template(IDResponse, key='%(key)s',
+    results='[%(results)s]')
+_UNIQUE_RESULT = _dumps_template(IDResult, id='%s', result=dumps(u'unique'))
+_DUPLICATE_RESULT = _dumps_template(IDResult, id='%s',
+    result=dumps(u'duplicate'))
+
+#: lines of the streaming identify route's response
+_STREAM_RESULTS = {True: _UNIQUE_RESULT + '\n', False: _DUPLICATE_RESULT + '\n'}
+_STREAM_ERROR = '{"error": %s}\n'
+
+def _dumps_idresponse(key, uniq, dup):
+    '''
+    Returns the JSON encoding of the identify response for the client with
+    the given key, with the given lists of unique and duplicate item ids.
+    It is written straight from the ids rather than through
+    :class:`IDResponse`, but comes out the same::
+
+        >>> key, uniq, dup = u'key', [u'id1', u'id\\xe9'], [u'"id3"']
+        >>> results = [IDResult(id=i, result=u'unique') for i in uniq] + \\
+        ...           [IDResult(id=i, result=u'duplicate') for i in dup]
+        >>> dumped = dumps(IDResponse(key=key, results=results).unwrap)
+        >>> _dumps_idresponse(key, uniq, dup) == dumped
+        True
+
+    '''
+    results = ', '.join(chain(
+        (_UNIQUE_RESULT % encode_basestring_ascii(i) for i in uniq),
+        (_DUPLICATE_RESULT % encode_basestring_ascii(i) for i in dup)))
+    return RawJson(_IDRESPONSE % {'key': encode_basestring_ascii(key),
+        'results': results})
+
 
 class SiCDSApp(object):
     #: max size of request body. bigger will be refused.
     REQMAXBYTES = 1024
+    #: max size of each line of a streamed identify request
+    STREAM_LINE_MAXBYTES = REQMAXBYTES
+    #: max number of streamed content items checked against the store at once
+    STREAM_BATCH_SIZE = 100
 
-    def __init__(self, superkey, store, loggers, keys=[]):
+    def __init__(self, superkey, store, loggers, keys=[], keys_refresh=0,
+            signed_keys=False, revoked_keys=[]):
         '''
         :param superkey: clients must supply an authorized key to use the API.
             New API keys can be registered using this superkey, e.g.::
@@ -89,106 +159,472 @@ class SiCDSApp(object):
                 > POST /register {"superkey": "abracadabra", "newkey": "foo"}
                 < {"key": "foo", "result": "registered"}
 
+            Any number of content items can be streamed to /stream, one per
+            line after a line giving the client's key, and the results are
+            streamed back one per line as items are checked, in batches of
+            up to :attr:`STREAM_BATCH_SIZE`::
+
+                > POST /stream {"key": "foo"}
+                >              {"id": "item1", "difcollections": [...]}
+                >              {"id": "item2", "difcollections": [...]}
+                < {"id": "item1", "result": "unique"}
+                < {"id": "item2", "result": "duplicate"}
+
+            If a line is invalid, the items before it are still checked and
+            the response ends with an {"error": ...} line instead.
+
+            With a store which partitions dif records by key, the superkey
+            can also drop all the records of a key, which stays registered::
+
+                > POST /purge {"superkey": "abracadabra", "key": "foo"}
+                < {"key": "foo", "result": "purged"}
+
         :param store: a :class:`sicds.base.BaseStore` implementation
         :param loggers: a list of :class:`sicds.base.BaseLogger` implementations
         :param keys: SiCDSApp can optionally be initialized with these keys,
             which it will synchronize with the store so they are persisted.
+        :param keys_refresh: if nonzero, keys registered with the store by
+            other processes are picked up by a background thread this many
+            seconds apart (see :meth:`refresh_keys`). Otherwise they are only
+            picked up on restart.
+        :param signed_keys: if true, keys registered with the superkey are
+            signed with it (see :mod:`sicds.keys`) instead of being added to
+            the store, and keys signed with it are accepted without being
+            looked up anywhere, alongside the keys in the store::
+
+                > POST /register {"superkey": "abracadabra", "newkey": "foo"}
+                < {"key": "foo.<signature>", "result": "registered"}
+
+        :param revoked_keys: keys which are refused even though they are
+            signed or in the store.
 
         '''
         self.superkey = superkey
         self.store = store
         self.loggers = loggers
         self.keys = set(self.store.ensure_keys(keys))
+        self.signed_keys = signed_keys
+        self.revoked_keys = frozenset(revoked_keys)
+        #: what to pass the store's ``key_changes`` on the next refresh
+        self.keys_since = None
+        self.keys_refresh = keys_refresh
+        self._stop_refreshing = Event()
+        if keys_refresh:
+            self.refresh_keys()
+            self._start_refreshing()
+
+    def _start_refreshing(self):
+        refresher = Thread(target=self._refresh_keys_forever,
+            name='SiCDSApp keys')
+        refresher.daemon = True
+        refresher.start()
+
+    def refresh_keys(self):
+        '''
+        Adds the keys registered with the store since the last refresh, by
+        this process or any other, to the keys clients may use. Only what
+        changed is read from stores which support it, and requests keep
+        checking keys against the set in memory::
+
+            >>> from sicds.stores.tmp import TmpStore
+            >>> store = TmpStore(urlsplit('tmp:'))
+            >>> app = SiCDSApp(u'superkey', store, [])
+            >>> store.register_key(u'elsewhere')
+            True
+            >>> u'elsewhere' in app.keys
+            False
+            >>> app.refresh_keys()
+            >>> u'elsewhere' in app.keys
+            True
+
+        '''
+        keys, self.keys_since = self.store.key_changes(self.keys_since)
+        self.keys.update(list(keys))
+
+    def _refresh_keys_forever(self):
+        while not self._stop_refreshing.wait(self.keys_refresh):
+            try:
+                self.refresh_keys()
+            except Exception as e:
+                stderr.write('Failed to refresh keys: {0}\n'.format(repr(e)))
+
+    def close(self):
+        '''
+        Stops refreshing keys.
+        '''
+        self._stop_refreshing.set()
+
+    @property
+    def threadsafe(self):
+        '''
+        Whether the app can serve requests in several threads at once, i.e.
+        whether its store and loggers can all be used by several threads at
+        once (see :attr:`sicds.base.BaseLogger.THREADSAFE`)::
+
+            >>> from sicds.config import store_from_url
+            >>> SiCDSApp(u'superkey', store_from_url('tmp:'), []).threadsafe
+            False
+            >>> SiCDSApp(u'superkey', store_from_url('striped:'), []).threadsafe
+            True
+
+        '''
+        return all(obj.THREADSAFE for obj in [self.store] + list(self.loggers))
+
+    def after_fork(self):
+        '''
+        Prepares the app to serve in a worker process forked by
+        :class:`sicds.server.PreforkServer`. The store and loggers replace
+        what they cannot share with the parent process, and background
+        threads, which are not inherited by a forked process, are started
+        again.
+        '''
+        seen = set()
+        for obj in [self.store] + list(self.loggers):
+            # the store can also be one of the loggers
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                obj.after_fork()
+        if self.keys_refresh and not self._stop_refreshing.is_set():
+            self._start_refreshing()
 
     def log(self, *args, **kw):
         for logger in self.loggers:
             logger.log(*args, **kw)
 
-    def _register(self, json):
+    def log_async(self, *args, **kw):
+        '''
+        Like :meth:`log` but returns a list of futures, one per logger.
+        '''
+        return [logger.log_async(*args, **kw) for logger in self.loggers]
+
+    # Each route is handled in steps which are shared with the asynchronous
+    # server in tornado_runner.py: first the request is validated, then the
+    # store is consulted, and then the response is made from the results.
+
+    def _register_request(self, json):
         data = KeyRegRequest(json)
         if data.superkey != self.superkey:
             raise exc.HTTPForbidden(explanation='Unauthorized superkey')
-        result = self.store.register_key(data.newkey)
+        return data
+
+    def _register_response(self, data, result):
         if result:
             self.keys.add(data.newkey)
         result = '{0}registered'.format('' if result else 'already ')
         resp = KeyRegResponse(key=data.newkey, result=result)
         return resp.unwrap
 
-    def _identify(self, json):
-        data = IDRequest(json)
-        if data.key not in self.keys:
+    def _signed_register_response(self, data):
+        key = sign_key(self.superkey, data.newkey)
+        return KeyRegResponse(key=key, result=u'registered').unwrap
+
+    def _register(self, json):
+        data = self._register_request(json)
+        if self.signed_keys:
+            return self._signed_register_response(data)
+        result = self.store.register_key(data.newkey)
+        return self._register_response(data, result)
+
+    def _stats(self, json):
+        data = StatsRequest(json)
+        if data.superkey != self.superkey:
+            raise exc.HTTPForbidden(explanation='Unauthorized superkey')
+        return self.store.stats()
+
+    def _purge_request(self, json):
+        data = PurgeRequest(json)
+        if data.superkey != self.superkey:
+            raise exc.HTTPForbidden(explanation='Unauthorized superkey')
+        return data
+
+    @staticmethod
+    def _purge_unsupported():
+        return exc.HTTPNotImplemented(explanation='Store does not partition '
+            'dif records by key')
+
+    @staticmethod
+    def _purge_response(data):
+        return PurgeResponse(key=data.key, result=u'purged').unwrap
+
+    def _purge(self, json):
+        data = self._purge_request(json)
+        try:
+            self.store.purge_key(data.key)
+        except NotImplementedError:
+            raise self._purge_unsupported()
+        return self._purge_response(data)
+
+    def authorized(self, key):
+        '''
+        Returns true if clients may use the API with the given key::
+
+            >>> from sicds.stores.tmp import TmpStore
+            >>> revoked = sign_key(u'superkey', u'revoked')
+            >>> app = SiCDSApp(u'superkey', TmpStore(urlsplit('tmp:')), [],
+            ...     keys=[u'stored'], signed_keys=True, revoked_keys=[revoked])
+            >>> signed = app._register({'superkey': u'superkey',
+            ...     'newkey': u'client'})['key']
+            >>> [app.authorized(key) for key in
+            ...     (u'stored', signed, u'client', revoked)]
+            [True, True, False, False]
+
+        '''
+        if key in self.revoked_keys:
+            return False
+        return key in self.keys or (self.signed_keys and
+            verify_key(self.superkey, key))
+
+    def _identify_request(self, json):
+        data = _parse_idrequest(json)
+        if not self.authorized(data.key):
             raise exc.HTTPForbidden(explanation='Unauthorized key')
-        uniq, dup = self._process(data.key, data.contentItems)
-        results = [IDResult({'id': i, 'result': 'unique'}) for i in uniq] + \
-                  [IDResult({'id': i, 'result': 'duplicate'}) for i in dup]
-        resp = IDResponse(key=data.key, results=results)
-        return resp.unwrap
+        return data
 
-    def _process(self, key, items):
+    def _identify_response(self, data, results):
+        uniq, dup = self._sort_results(data.contentItems, results)
+        return _dumps_idresponse(data.key, uniq, dup)
+
+    def _identify(self, json):
+        data = self._identify_request(json)
+        results = self._check(data.key, data.contentItems)
+        return self._identify_response(data, results)
+
+    def _check(self, key, items):
+        try:
+            return self.store.check_many(key, items)
+        except Exception as e:
+            raise self._store_error(items, e)
+
+    @staticmethod
+    def _store_error(items, e):
+        '''
+        Returns the error to raise for ``e``, raised by the store while
+        checking ``items``. Unless the store could tell which items it
+        failed on (see :class:`sicds.base.PartialStoreError`), they all did::
+
+            >>> items = [ContentItem({'id': id, 'difcollections': [{'name':
+            ...     u'n', 'difs': [{'type': u't', 'value': id}]}]})
+            ...     for id in (u'a', u'b', u'c')]
+            >>> e = StoreError('failed')
+            >>> SiCDSApp._store_error(items, e).args[0] == dict(uniq=[],
+            ...     dup=[], exc={u'a': e, u'b': e, u'c': e})
+            True
+            >>> SiCDSApp._store_error(items, PartialStoreError([True, e,
+            ...     False])).args[0] == dict(uniq=[u'a'], dup=[u'c'],
+            ...     exc={u'b': e})
+            True
+
+        '''
+        if isinstance(e, PartialStoreError):
+            results = e.results
+        else:
+            results = [e] * len(items)
         uniqs = []
         dups = []
         excs = {}
-        for item in items:
-            try:
-                uniq = self.store.check(key, item)
-            except Exception as e:
-                excs[item.id] = e
+        for item, result in zip(items, results):
+            if isinstance(result, Exception):
+                excs[item.id] = result
+            elif result:
+                uniqs.append(item.id)
+            else:
+                dups.append(item.id)
+        return StoreError(dict(uniq=uniqs, dup=dups, exc=excs))
+
+    @staticmethod
+    def _sort_results(items, results):
+        uniqs = []
+        dups = []
+        for item, uniq in zip(items, results):
+            if uniq:
+                uniqs.append(item.id)
             else:
-                if uniq:
-                    uniqs.append(item.id)
-                else:
-                    dups.append(item.id)
-        if excs:
-            raise StoreError(dict(uniq=uniqs, dup=dups, exc=excs))
+                dups.append(item.id)
         return uniqs, dups
 
+    def _stream_lines(self, body):
+        '''
+        Returns an iterator over the non-blank lines of ``body``, each read
+        on its own so that the whole body is never held in memory.
+        '''
+        maxbytes = self.STREAM_LINE_MAXBYTES
+        while True:
+            line = body.readline(maxbytes + 1)
+            if not line:
+                return
+            if len(line) > maxbytes:
+                raise exc.HTTPRequestEntityTooLarge(explanation='Streamed '
+                    'lines max size is {0} bytes'.format(maxbytes))
+            if line.strip():
+                yield line
+
+    def _identify_stream(self, req):
+        '''
+        Handles the streaming identify route (see :meth:`__init__`). Errors
+        found before the response starts get an error response as for other
+        routes. Otherwise the response is streamed, and logged with just the
+        number of items and results once it has finished.
+        '''
+        try:
+            if req.method != 'POST':
+                raise exc.HTTPMethodNotAllowed(explanation='Only POST allowed')
+            lines = self._stream_lines(req.body_file)
+            first = next(lines, None)
+            req.logged_body = first
+            if first is None:
+                raise exc.HTTPBadRequest(explanation='Empty request')
+            data = StreamRequest(loads(first))
+            if not self.authorized(data.key):
+                raise exc.HTTPForbidden(explanation='Unauthorized key')
+        except Exception as e:
+            resp = self._error_response(e)
+            try:
+                self.log(req, resp, False)
+            except Exception as e:
+                resp = self._log_failure_response(e, req, resp)
+            return resp
+        resp = Response(content_type='application/x-ndjson')
+        resp.app_iter = self._stream_results(req, resp, data.key, lines)
+        return resp
+
+    def _stream_results(self, req, resp, key, lines):
+        req.logged_body = logged = {u'key': key, u'items': 0}
+        resp.logged_body = counts = {u'unique': 0, u'duplicate': 0}
+        success = False
+        errors = []
+        items = self._stream_items(lines, errors)
+        try:
+            while True:
+                batch = list(islice(items, self.STREAM_BATCH_SIZE))
+                if not batch:
+                    break
+                yield self._stream_batch(key, batch, logged, counts)
+            if errors:
+                raise errors[0]
+            success = True
+        except Exception as e:
+            explanation = e.explanation if isinstance(e, exc.HTTPException) \
+                else repr(e)
+            counts[u'error'] = explanation
+            yield _STREAM_ERROR % encode_basestring_ascii(explanation)
+        finally:
+            try:
+                self.log(req, resp, success)
+            except Exception as e:
+                stderr.write('Failed to log streamed response: {0}\n'
+                    .format(repr(e)))
+
+    @staticmethod
+    def _stream_items(lines, errors):
+        '''
+        Yields the content item on each of ``lines`` up to the first invalid
+        one, whose error is appended to ``errors``, so that the items before
+        it are still checked.
+        '''
+        try:
+            for line in lines:
+                yield _parse_item(loads(line))
+        except Exception as e:
+            errors.append(e)
+
+    def _stream_batch(self, key, items, logged, counts):
+        results = self._check(key, items)
+        logged[u'items'] += len(items)
+        nuniq = sum(1 for uniq in results if uniq)
+        counts[u'unique'] += nuniq
+        counts[u'duplicate'] += len(items) - nuniq
+        return ''.join(_STREAM_RESULTS[bool(uniq)] %
+            encode_basestring_ascii(item.id)
+            for item, uniq in zip(items, results))
+
     #: routes
     R_IDENTIFY = '/'
+    R_IDENTIFY_STREAM = '/stream'
     R_REGISTER_KEY = '/register'
+    R_STATS = '/stats'
+    R_PURGE = '/purge'
     _routes = {
         R_IDENTIFY: _identify,
         R_REGISTER_KEY: _register,
+        R_STATS: _stats,
+        R_PURGE: _purge,
         }
 
+    def _parse(self, req):
+        '''
+        Checks that ``req`` is a well-formed request for one of the routes
+        and returns its decoded body.
+        '''
+        if req.path_info not in self._routes:
+            raise exc.HTTPNotFound
+        if req.method != 'POST':
+            raise exc.HTTPMethodNotAllowed(explanation='Only POST allowed')
+        maxbytes = self.REQMAXBYTES
+        if req.content_length is None or req.content_length > maxbytes:
+            # a body of unknown length (e.g. chunked) is read only as far
+            # as the limit
+            body = req.body_file.read(maxbytes + 1)
+        else:
+            body = req.body
+        if len(body) > maxbytes or req.content_length > maxbytes:
+            req.logged_body = body[:maxbytes] + '...'
+            raise exc.HTTPRequestEntityTooLarge(explanation='Request max '
+                'size is {0} bytes'.format(maxbytes))
+        reqjson = loads(body)
+        req.logged_body = reqjson
+        return reqjson
+
+    @staticmethod
+    def _response(respjson):
+        '''
+        Makes the response for ``respjson``, which is encoded unless it is
+        :class:`sicds.base.RawJson` already. Either way the response is
+        logged by reference, without being copied or decoded.
+        '''
+        if not isinstance(respjson, RawJson):
+            respjson = RawJson(dumps(respjson))
+        resp = Response(body=respjson, content_type='application/json')
+        resp.logged_body = respjson
+        return resp
+
+    @staticmethod
+    def _error_response(e):
+        if isinstance(e, exc.HTTPException):
+            resp = e
+        elif isinstance(e, (JSONDecodeError, SchemaError)):
+            resp = exc.HTTPBadRequest(explanation=repr(e))
+        else:
+            resp = exc.HTTPInternalServerError(explanation=repr(e))
+        resp.logged_body = resp.explanation
+        return resp
+
+    @staticmethod
+    def _log_failure_response(e, req, resp):
+        return exc.HTTPInternalServerError(explanation='Log failure: {0}\n'
+            'req: {1}\nresp: {2}'.format(repr(e), getattr(req, 'logged_body', None),
+            getattr(resp, 'logged_body', None)))
+
     @wsgify
     def __call__(self, req):
+        if req.path_info == self.R_IDENTIFY_STREAM:
+            return self._identify_stream(req)
         resp = None
         success = False
         try:
-            if req.path_info not in self._routes:
-                raise exc.HTTPNotFound
-            if req.method != 'POST':
-                raise exc.HTTPMethodNotAllowed(explanation='Only POST allowed')
-            if req.content_length > self.REQMAXBYTES:
-                req.logged_body = req.body_file.read(self.REQMAXBYTES) + '...'
-                raise exc.HTTPRequestEntityTooLarge(explanation='Request max '
-                    'size is {0} bytes'.format(self.REQMAXBYTES))
-            reqjson = loads(req.body)
-            req.logged_body = reqjson
+            reqjson = self._parse(req)
             handler = self._routes[req.path_info]
-            respjson = handler(self, reqjson)
-            resp = Response(body=dumps(respjson), content_type='application/json')
-            resp.logged_body = respjson
+            resp = self._response(handler(self, reqjson))
             success = True
         except Exception as e:
-            if isinstance(e, exc.HTTPException):
-                resp = e
-            elif isinstance(e, (JSONDecodeError, SchemaError)):
-                resp = exc.HTTPBadRequest(explanation=repr(e))
-            else:
-                resp = exc.HTTPInternalServerError(explanation=repr(e))
-            resp.logged_body = resp.explanation
+            resp = self._error_response(e)
         finally:
             try:
                 self.log(req, resp, success)
             except Exception as e:
-                resp = exc.HTTPInternalServerError(explanation='Log failure: {0}\n'
-                    'req: {1}\nresp: {2}'.format(repr(e), getattr(req, 'logged_body', None),
-                    getattr(resp, 'logged_body', None)))
+                resp = self._log_failure_response(e, req, resp)
             return resp
 
-def getconfig():
+def getconfig(args=None):
     from sicds.config import SiCDSConfig, DEFAULTCONFIG
     from sys import argv
 
@@ -196,8 +632,10 @@ def getconfig():
         print(msg)
         exit(1)
 
-    if argv[1:]:
-        configpath = argv[1]
+    if args is None:
+        args = argv[1:]
+    if args:
+        configpath = args[0]
         config = {}
         try:
             execfile(configpath, {}, config)
@@ -211,21 +649,58 @@ def getconfig():
     return SiCDSConfig(config)
 
 def makeapp(config):
-    return SiCDSApp(config.superkey, config.store, config.loggers, keys=config.keys)
+    loggers = config.loggers
+    if config.log_queue_size:
+        from sicds.loggers import QueueLogger
+        loggers = [QueueLogger(loggers, config.log_queue_size,
+            config.log_batch_size, config.log_flush_interval,
+            config.log_when_full)]
+    return SiCDSApp(config.superkey, config.store, loggers, keys=config.keys,
+        keys_refresh=config.keys_refresh, signed_keys=config.signed_keys,
+        revoked_keys=config.revoked_keys)
 
-def serve_forever(app, config):
-    from wsgiref.simple_server import make_server
-    httpd = make_server(config.host, config.port, app)
-    print('Serving on port {0}'.format(config.port))
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
+def serve_forever(app, config, workers=None, threads=None):
+    '''
+    Serves ``app`` with a :class:`sicds.server.PreforkServer` until it is
+    shut down by SIGTERM or SIGINT. ``workers`` and ``threads`` default to
+    the config's.
+    '''
+    from sicds.server import PreforkServer
+    if workers is None:
+        workers = config.workers
+    if threads is None:
+        threads = config.threads
+    server = PreforkServer(app, config.host, config.port, workers, threads)
+    if workers:
+        print('Serving on port {0} with {1} worker(s) of {2} thread(s)'
+            .format(server.port, workers, threads))
+    else:
+        print('Serving on port {0} with {1} thread(s)'
+            .format(server.port, threads))
+    server.serve_forever()
 
 def main():
-    config = getconfig()
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [config]')
+    parser.add_option('-w', '--workers', type='int',
+        help='number of worker processes to fork, 0 to serve in this '
+        'process (overrides workers in config)')
+    parser.add_option('-t', '--threads', type='int',
+        help='number of threads serving requests in each worker '
+        '(overrides threads in config)')
+    options, args = parser.parse_args()
+    config = getconfig(args)
+    workers = config.workers if options.workers is None else options.workers
+    if workers and not config.store.PROCESS_SAFE:
+        parser.error('the store cannot be shared by worker processes, use '
+            'a mongodb:, couchdb:, sqlite: or shm: store (and not lru+ with '
+            'partition)')
     app = makeapp(config)
-    serve_forever(app, config)
+    threads = config.threads if options.threads is None else options.threads
+    if threads > 1 and not app.threadsafe:
+        parser.error('the store or a logger cannot be used by several '
+            'threads at once (e.g. use striped: instead of tmp:)')
+    serve_forever(app, config, workers, threads)
 
 if __name__ == '__main__':
     main()
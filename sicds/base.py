@@ -18,14 +18,93 @@
 # Boston, MA  02110-1301
 # USA
 
-from datetime import datetime
-from functools import partial
+from datetime import datetime, timedelta
 from hashlib import sha1
-from operator import attrgetter
+from os import getpid
+from sicds.digest import LEGACY, hasher
+from simplejson import loads
+from threading import Lock
+from urlparse import parse_qsl
 utcnow = datetime.utcnow
 
 class StoreError(Exception): pass
 
+class PartialStoreError(StoreError):
+    '''
+    Raised by :meth:`BaseStore._add_difs_records_many` and
+    :meth:`BaseStore.check_many` when only some of the records or items
+    could not be handled. :attr:`results` is the list that would have been
+    returned, with the exception for each of those in its place.
+    '''
+    def __init__(self, results):
+        StoreError.__init__(self, results)
+        self.results = results
+
+    @classmethod
+    def check(cls, results):
+        '''
+        Returns ``results``, or raises an instance for them if any of them
+        is an exception::
+
+            >>> PartialStoreError.check([True, False])
+            [True, False]
+            >>> PartialStoreError.check([True, StoreError('x')])
+            Traceback (most recent call last):
+            ...
+            PartialStoreError: [True, StoreError('x',)]
+
+        '''
+        if any(isinstance(r, Exception) for r in results):
+            raise cls(results)
+        return results
+
+    @classmethod
+    def results_of(cls, add, *args):
+        '''
+        Returns what ``add(*args)`` returns, or the :attr:`results` of the
+        instance it raises, for wrappers which put them together with those
+        of other records.
+        '''
+        try:
+            return add(*args)
+        except cls as e:
+            return e.results
+
+class RawJson(str):
+    '''
+    A string of already encoded JSON, e.g. a response body, which can be
+    logged as is instead of keeping its decoded value around. Loggers which
+    need the decoded value get it with :meth:`BaseLogger._decode_bodies`.
+    '''
+
+def url_options(url, **defaults):
+    '''
+    Returns a dict mapping the name of each keyword argument to the value
+    given for it in the query string of ``url``, converted to the type of the
+    keyword argument's value, which is used as the default when the query
+    string does not give one. Anything else in the query string is ignored.
+
+        >>> from urlparse import urlsplit
+        >>> url = urlsplit('tmp:?size=10&verbose=0&other=1')
+        >>> sorted(url_options(url, size=1, verbose=True, path='').items())
+        [('path', ''), ('size', 10), ('verbose', False)]
+
+    '''
+    given = dict(parse_qsl(url.query))
+    options = {}
+    for name, default in defaults.iteritems():
+        try:
+            value = given[name]
+        except KeyError:
+            value = default
+        else:
+            if isinstance(default, bool):
+                value = value.lower() not in ('0', 'false', 'no', 'off', '')
+            else:
+                value = type(default)(value)
+        options[name] = value
+    return options
+
 class UrlInitable(object):
     '''
     Base class for objects whose __init__ methods take a urlparse.SplitResult
@@ -37,10 +116,74 @@ class UrlInitable(object):
 class BaseLogger(UrlInitable):
     '''
     Abstract base class for logger objects.
+
+    Methods with an ``_async`` suffix return a future
+    (:class:`concurrent.futures.Future`) instead of blocking. By default they
+    run their blocking counterpart in an executor (see :meth:`_executor`),
+    which only runs them in several threads at once if :attr:`THREADSAFE`
+    is true. Subclasses with a natively asynchronous backend can override
+    them::
+
+        >>> from sicds.stores.tmp import StripedStore, TmpStore
+        >>> from urlparse import urlsplit
+        >>> tmp = TmpStore(urlsplit('tmp:'))
+        >>> tmp._executor() is TmpStore(urlsplit('tmp:'))._executor()
+        False
+        >>> striped = StripedStore(urlsplit('striped:'))
+        >>> striped._executor() is StripedStore(urlsplit('striped:'))._executor()
+        True
+
     '''
     #: subclasses can index entries by this field if they support it
     LOG_INDEX = u'timestamp'
 
+    #: whether one instance can be used by several threads at once, as by a
+    #: server with threads (see :mod:`sicds.server`) or by :attr:`executor`.
+    #: Subclasses set this to true once whatever their calls share (e.g. a
+    #: connection or a file) is guarded against concurrent use.
+    THREADSAFE = False
+
+    #: the executor the default ``_async`` methods run in, if set (see
+    #: :meth:`_executor`)
+    executor = None
+    EXECUTOR_THREADS = 16
+    _executor_lock = Lock()
+
+    def _executor(self):
+        '''
+        Returns :attr:`executor` if set. Otherwise loggers and stores which
+        are :attr:`THREADSAFE` share a thread pool of
+        :attr:`EXECUTOR_THREADS` threads, and each of the others gets a
+        single thread of its own, so that its calls are made one at a time.
+        Executors are made again in a forked process, which does not
+        inherit their threads.
+        '''
+        if self.executor is not None:
+            return self.executor
+        owner = BaseLogger if self.THREADSAFE else self
+        pid = getpid()
+        made = owner.__dict__.get('_made_executor')
+        if made is None or made[0] != pid:
+            with BaseLogger._executor_lock:
+                made = owner.__dict__.get('_made_executor')
+                if made is None or made[0] != pid:
+                    from concurrent.futures import ThreadPoolExecutor
+                    made = (pid, ThreadPoolExecutor(self.EXECUTOR_THREADS
+                        if self.THREADSAFE else 1))
+                    setattr(owner, '_made_executor', made)
+        return made[1]
+
+    def _submit(self, fn, *args, **kw):
+        return self._executor().submit(fn, *args, **kw)
+
+    def after_fork(self):
+        '''
+        Called in each worker process forked by
+        :class:`sicds.server.PreforkServer` before it serves any request.
+        Subclasses holding connections or threads, which are not safely
+        inherited by a forked process, replace them here.
+        '''
+
     def log(self, req, resp, success, **kw):
         record = dict(
             timestamp=utcnow().isoformat(),
@@ -55,9 +198,32 @@ class BaseLogger(UrlInitable):
             **kw)
         self._add_log_record(record)
 
+    def log_async(self, req, resp, success, **kw):
+        return self._submit(self.log, req, resp, success, **kw)
+
+    @staticmethod
+    def _decode_bodies(record):
+        '''
+        Replaces any :class:`RawJson` request or response body in ``record``
+        with its decoded value and returns ``record``.
+        '''
+        for part in (u'request', u'response'):
+            body = record[part][u'body']
+            if isinstance(body, RawJson):
+                record[part] = dict(record[part], body=loads(body))
+        return record
+
     def _add_log_record(self, record):
         raise NotImplementedError
 
+    def _add_log_records(self, records):
+        '''
+        Adds a batch of log records. Subclasses can override this to add them
+        in a single operation.
+        '''
+        for record in records:
+            self._add_log_record(record)
+
     def iterlog(self):
         '''
         Subclasses can optionally override this to return an iterator over
@@ -68,19 +234,154 @@ class BaseLogger(UrlInitable):
 class BaseStore(BaseLogger):
     '''
     Abstract base class for Store objects.
+
+    Dif collections are identified by digests made by :attr:`hasher` (see
+    :mod:`sicds.digest`), which stores set from the ``hash``,
+    ``digest_size`` and ``migrate_from`` options in their url by calling
+    :meth:`_init_store_options`. Stores which support it also take a
+    ``retention_days`` option, after which a dif record no longer counts
+    and a dif collection seen only that long ago is unique again, and
+    ``max_entries`` and ``max_bytes`` options, beyond which the oldest dif
+    records are evicted, and a ``partition`` option, with which the dif
+    records of each client are kept apart (e.g. in a collection or table of
+    their own) so that they can be dropped at once by :meth:`purge_key`.
+
+    While a store is migrated from one scheme to another, digests made by
+    both are looked up and added, so that collections seen before the
+    migration are still found::
+
+        >>> from sicds.app import ContentItem
+        >>> from sicds.stores.tmp import TmpStore
+        >>> from urlparse import urlsplit
+        >>> item = ContentItem(id=u'item', difcollections=[{'name': u'c',
+        ...     'difs': [{'type': u't', 'value': u'v'}]}])
+        >>> store = TmpStore(urlsplit('tmp:'))
+        >>> store.check(u'key', item)
+        True
+        >>> store._init_store_options(urlsplit('tmp:?hash=sha1&migrate_from=legacy'))
+        >>> store.check(u'key', item)
+        False
+
+    Once the store has been running under the new scheme for as long as
+    duplicates need to be caught, ``migrate_from`` can be dropped.
+
+    Legacy digests are always whole SHA-1 digests, so ``digest_size`` needs
+    another scheme::
+
+        >>> TmpStore(urlsplit('tmp:?digest_size=16'))
+        Traceback (most recent call last):
+        ...
+        StoreError: digest_size cannot be used with the legacy hash, choose another one
+
     '''
+    #: the digest scheme for dif collections
+    hasher = LEGACY
+    #: if set, the digest scheme the store is being migrated from
+    migrate_from = None
+    #: how long dif records count for (a timedelta), or None for ever
+    retention = None
+    #: whether the store supports the ``retention_days`` option
+    SUPPORTS_RETENTION = False
+    #: the most dif records (or bytes of them) the store is to hold, or 0
+    max_entries = max_bytes = 0
+    #: whether the store supports the ``max_entries`` and ``max_bytes``
+    #: options, evicting the oldest records to stay within them
+    SUPPORTS_CAPACITY = False
+    #: whether dif records are partitioned by key
+    partition = False
+    #: whether the store supports the ``partition`` option
+    SUPPORTS_PARTITION = False
+    #: whether the store can be shared by several processes, such as the
+    #: workers forked by :class:`sicds.server.PreforkServer`, i.e. whether
+    #: its dif records are kept outside of the process or in shared memory
+    PROCESS_SAFE = False
+    #: whether separate instances made from the same url share their
+    #: records, so that each thread can be given one of its own (see
+    #: :class:`sicds.stores.pool.PooledStore`)
+    SHARED_BY_URL = False
+    #: whether :meth:`iterdigests` can list the digests in the store
+    LISTS_DIGESTS = True
+    #: the url the store was made from by :func:`sicds.config.store_from_url`
+    from_url = None
+
+    def _init_store_options(self, url):
+        options = url_options(url, hash='legacy', digest_size=0,
+            migrate_from='', retention_days=0.0, max_entries=0, max_bytes=0,
+            partition=False)
+        if options['hash'] == LEGACY.name and \
+                options['digest_size'] not in (0, LEGACY.size):
+            # legacy digests are whole sha1 digests, made as they always were
+            raise StoreError('digest_size cannot be used with the legacy '
+                'hash, choose another one')
+        self.hasher = hasher(options['hash'], options['digest_size'])
+        if options['migrate_from']:
+            self.migrate_from = hasher(options['migrate_from'])
+        if options['retention_days']:
+            if not self.SUPPORTS_RETENTION:
+                raise StoreError('{0} does not support retention_days'
+                    .format(self.__class__.__name__))
+            self.retention = timedelta(days=options['retention_days'])
+        if options['max_entries'] or options['max_bytes']:
+            if not self.SUPPORTS_CAPACITY:
+                raise StoreError('{0} does not support max_entries or '
+                    'max_bytes'.format(self.__class__.__name__))
+            self.max_entries = options['max_entries']
+            self.max_bytes = options['max_bytes']
+        if options['partition']:
+            if not self.SUPPORTS_PARTITION:
+                raise StoreError('{0} does not support partition'
+                    .format(self.__class__.__name__))
+            self.partition = True
+
     @staticmethod
-    def _hash(key, difs):
-        hashed = sha1(key)
-        for type, value in sorted((d.type, d.value) for d in difs):
-            hashed.update(type)
-            hashed.update(value)
-        return hashed.digest()
+    def _partition_name(key):
+        '''
+        Returns the name of the partition for the dif records of the client
+        with the given key, which is safe to use in the name of a table,
+        collection or database whatever the key is::
+
+            >>> BaseStore._partition_name(u'some key')
+            'difs_ab0d8e0ce58e6fa9'
+
+        '''
+        return 'difs_' + sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def _cutoff(self):
+        '''
+        Returns the time before which dif records no longer count.
+        '''
+        return utcnow() - self.retention
+
+    @staticmethod
+    def _encode_digest(digest):
+        '''
+        Subclasses can override this to convert digests to the type their
+        backend stores them as.
+        '''
+        return digest
+
+    @staticmethod
+    def _decode_digest(s):
+        '''
+        Returns the digest, as converted by :meth:`_encode_digest`, whose
+        str() is ``s``, e.g. to read back one written to a file.
+        '''
+        return s
+
+    def _hash(self, key, difs):
+        return self._encode_digest(self.hasher(key, difs))
 
     @staticmethod
     def _new_difs_record(cls, id):
         raise NotImplementedError
 
+    @staticmethod
+    def _difs_record_id(record):
+        '''
+        Returns the id (i.e. the hash) of the given dif record.
+        '''
+        return record
+
     def _add_difs_records(self, records):
         '''
         Adds the given records to the store, returns true if none of them
@@ -88,15 +389,119 @@ class BaseStore(BaseLogger):
         '''
         raise NotImplementedError
 
+    def _add_difs_records_many(self, key, records):
+        '''
+        Adds the given records, all belonging to the client with the given
+        key, to the store. Returns a list with one entry per record which is
+        true if that record was not already in the store. If only some of
+        the records could not be added, :class:`PartialStoreError` is raised
+        instead.
+
+        Subclasses should override this to add all the records in a single
+        operation. The default implementation falls back to adding them one
+        at a time.
+        '''
+        return [self._add_difs_records([r]) for r in records]
+
+    def _add_difs_records_nowait(self, key, records):
+        '''
+        Adds the given records to the store without waiting to find out
+        whether they were already present. Subclasses can override this with
+        an unacknowledged write if their backend supports one.
+        '''
+        self._add_difs_records_many(key, records)
+
+    def iterdigests(self, since=None):
+        '''
+        Returns an iterator over the ids of the dif records in the store.
+        If ``since`` (a datetime) is given, stores may leave out records
+        added before then.
+        '''
+        raise NotImplementedError
+
+    def _item_hashes(self, key, item):
+        hashes = [self._hash(key, c.difs) for c in item.difcollections]
+        if self.migrate_from is not None:
+            hashes.extend(self._encode_digest(self.migrate_from(key, c.difs))
+                for c in item.difcollections)
+        return hashes
+
     def check(self, key, item):
         '''
         Returns false if client with the given key has seen the given item
         before, otherwise returns true.
         '''
-        alldifs = map(attrgetter('difs'), item.difcollections)
-        hashes = map(partial(self._hash, key), alldifs)
-        records = map(self._new_difs_record, hashes)
-        return self._add_difs_records(records)
+        return self.check_many(key, [item])[0]
+
+    def check_many(self, key, items):
+        '''
+        Returns a list with one entry per item in ``items`` which is false if
+        client with the given key has seen that item before, otherwise true.
+
+        All dif collections in ``items`` are hashed up front and resolved
+        against the store in a single call to :meth:`_add_difs_records_many`.
+        A dif collection repeated within the same request only counts against
+        the items after the first one it appears in, just as if the items had
+        been checked one after another.
+
+        If the store could not add only some of the records, the items they
+        belong to fail with :class:`PartialStoreError` and the others are
+        still resolved::
+
+            >>> from sicds.app import ContentItem
+            >>> from sicds.stores.tmp import TmpStore
+            >>> from urlparse import urlsplit
+            >>> store = TmpStore(urlsplit('tmp:'))
+            >>> add = store._add_difs_records_many
+            >>> def failing_add(key, records):
+            ...     added = add(key, records)
+            ...     if len(records) > 2:
+            ...         added[1] = StoreError('failed')
+            ...     return PartialStoreError.check(added)
+            >>> store._add_difs_records_many = failing_add
+            >>> items = [ContentItem({'id': id, 'difcollections': [{'name':
+            ...     u'n', 'difs': [{'type': u't', 'value': id}]}]})
+            ...     for id in (u'a', u'b', u'c')]
+            >>> store.check_many(u'key', items[:1])
+            [True]
+            >>> store.check_many(u'key', items)
+            Traceback (most recent call last):
+            ...
+            PartialStoreError: [False, StoreError('failed',), True]
+
+        '''
+        uniqs = []
+        owners = {}
+        records = []
+        recordowners = []
+        for i, item in enumerate(items):
+            uniq = True
+            for hash in self._item_hashes(key, item):
+                if hash in owners:
+                    if owners[hash] != i:
+                        uniq = False
+                    continue
+                owners[hash] = i
+                records.append(self._new_difs_record(hash))
+                recordowners.append(i)
+            uniqs.append(uniq)
+        added = PartialStoreError.results_of(self._add_difs_records_many,
+            key, records)
+        failed = {}
+        for owner, isnew in zip(recordowners, added):
+            if isinstance(isnew, Exception):
+                failed.setdefault(owner, isnew)
+            elif not isnew:
+                uniqs[owner] = False
+        for owner, e in failed.iteritems():
+            uniqs[owner] = e
+        return PartialStoreError.check(uniqs)
+
+    def check_async(self, key, item):
+        return self._submit(self.check, key, item)
+
+    def check_many_async(self, key, items):
+        return self._submit(self.check_many, key, items)
 
     def register_key(self, newkey):
         '''
@@ -105,6 +510,9 @@ class BaseStore(BaseLogger):
         '''
         raise NotImplementedError
 
+    def register_key_async(self, newkey):
+        return self._submit(self.register_key, newkey)
+
     def ensure_keys(self, keys):
         '''
         Registers each key in ``keys`` that has not been registered already
@@ -112,12 +520,133 @@ class BaseStore(BaseLogger):
         '''
         raise NotImplementedError
 
+    def purge_key(self, key):
+        '''
+        Deletes the dif records of the client with the given key, so that
+        everything it submits from then on is unique again. The key stays
+        registered. Only stores which partition dif records by key can tell
+        which are the client's, so others raise NotImplementedError.
+        '''
+        raise NotImplementedError
+
+    def purge_key_async(self, key):
+        return self._submit(self.purge_key, key)
+
+    def key_changes(self, since=None):
+        '''
+        Returns a pair of an iterable over the keys registered since the
+        call which returned ``since`` (or over all keys, if ``since`` is
+        None), and a value to pass as ``since`` next time. The keys may
+        include some seen before.
+
+        Subclasses which can find recently registered keys without reading
+        them all should override this. The default implementation returns
+        all the keys every time.
+        '''
+        return self.ensure_keys([]), None
+
     def clear(self):
         '''
         Clears contents of the store.
         '''
         raise NotImplementedError
 
+    def stats(self):
+        '''
+        Returns a dict of statistics about the store for monitoring.
+        '''
+        return {u'store': self.__class__.__name__}
+
+class StoreWrapper(BaseStore):
+    '''
+    Abstract base class for stores which add a layer in front of another
+    store. A wrapper is configured by prefixing the url of the store it wraps
+    with its own scheme, e.g. "bloom+mongodb://localhost:27017/sicds", and
+    is initialized with the url (under its own scheme) and the wrapped store.
+    Anything not overridden is passed through to the wrapped store.
+    '''
+    def __init__(self, url, store):
+        self.store = store
+
+    def _hash(self, key, difs):
+        return self.store._hash(key, difs)
+
+    def _item_hashes(self, key, item):
+        return self.store._item_hashes(key, item)
+
+    @property
+    def retention(self):
+        return self.store.retention
+
+    @property
+    def partition(self):
+        return self.store.partition
+
+    @property
+    def PROCESS_SAFE(self):
+        return self.store.PROCESS_SAFE
+
+    @property
+    def LISTS_DIGESTS(self):
+        return self.store.LISTS_DIGESTS
+
+    @property
+    def THREADSAFE(self):
+        # wrappers guard their own state, but call the wrapped store from
+        # whichever thread they are called in
+        return self.store.THREADSAFE
+
+    def after_fork(self):
+        self.store.after_fork()
+
+    def _decode_digest(self, s):
+        return self.store._decode_digest(s)
+
+    def _new_difs_record(self, id):
+        return self.store._new_difs_record(id)
+
+    def _difs_record_id(self, record):
+        return self.store._difs_record_id(record)
+
+    def _add_difs_records(self, records):
+        return self.store._add_difs_records(records)
+
+    def _add_difs_records_many(self, key, records):
+        return self.store._add_difs_records_many(key, records)
+
+    def _add_difs_records_nowait(self, key, records):
+        self.store._add_difs_records_nowait(key, records)
+
+    def iterdigests(self, since=None):
+        return self.store.iterdigests(since)
+
+    def register_key(self, newkey):
+        return self.store.register_key(newkey)
+
+    def ensure_keys(self, keys):
+        return self.store.ensure_keys(keys)
+
+    def key_changes(self, since=None):
+        return self.store.key_changes(since)
+
+    def purge_key(self, key):
+        self.store.purge_key(key)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return self.store.stats()
+
+    def _add_log_record(self, record):
+        self.store._add_log_record(record)
+
+    def _add_log_records(self, records):
+        self.store._add_log_records(records)
+
+    def iterlog(self):
+        return self.store.iterlog()
+
 class DocStore(BaseStore):
     '''
     Abstract base class for document-oriented stores such as CouchDB and
@@ -134,3 +663,7 @@ class DocStore(BaseStore):
             cls.kID: id,
             cls.kTIMEADDED: utcnow().isoformat(),
             }
+
+    @classmethod
+    def _difs_record_id(cls, record):
+        return record[cls.kID]
@@ -19,8 +19,9 @@
 # Boston, MA  02110-1301
 # USA
 
-from sicds.loggers import StdOutLogger
-from sicds.schema import Reference, Schema, SchemaError, many, \
+from sicds.base import StoreError
+from sicds.loggers import QueueLogger, StdOutLogger
+from sicds.schema import Reference, Schema, SchemaError, many, nonfalse, \
     withdefault, t_uni
 from urlparse import urlparse
 
@@ -33,10 +34,26 @@ class DEFAULTCONFIG(object):
 
 STORES = {
     'tmp': 'sicds.stores.tmp.TmpStore',
+    'striped': 'sicds.stores.tmp.StripedStore',
     'couchdb': 'sicds.stores.couch.CouchStore',
     'mongodb': 'sicds.stores.mongo.MongoStore',
+    'file': 'sicds.stores.hashfile.FileStore',
+    'sqlite': 'sicds.stores.sqlite.SqliteStore',
+    'shm': 'sicds.stores.shm.ShmStore',
+    'compact': 'sicds.stores.compact.CompactStore',
     }
 
+STORE_WRAPPERS = {
+    'bloom': 'sicds.stores.bloom.BloomStore',
+    'lru': 'sicds.stores.lru.LRUStore',
+    'coalesce': 'sicds.stores.coalesce.CoalescingStore',
+    'journal': 'sicds.stores.journal.JournalStore',
+    'pool': 'sicds.stores.pool.PooledStore',
+    }
+
+#: wrappers which read every digest in the store they wrap on startup
+NEEDS_DIGESTS = frozenset(['bloom', 'journal'])
+
 LOGGERS = {
     'null': 'sicds.loggers.NullLogger',
     'file': 'sicds.loggers.FileLogger',
@@ -47,10 +64,11 @@ class ConfigError(SchemaError): pass
 class UnknownUrlScheme(ConfigError): pass
 class UrlInitFailure(ConfigError): pass
 
-def _instance_from_url(url, urlscheme2type):
+def _instance_from_url(url, urlscheme2type, *args):
     '''
     Returns a new UrlInitable object designated by the given url and
-    urlscheme2type mapping.
+    urlscheme2type mapping. Any additional arguments are passed on to the
+    object's constructor after the url.
 
         >>> filelogger = _instance_from_url('file:///dev/stdout',
         ...     {'file': 'sicds.loggers.FileLogger'})
@@ -75,16 +93,77 @@ def _instance_from_url(url, urlscheme2type):
         for component in modulename.split('.')[1:]:
             module = getattr(module, component)
         factory = getattr(module, factory)
-        return factory(parsedurl)
+        return factory(parsedurl, *args)
     except:
         raise UrlInitFailure(url) 
 
 def store_from_url(url):
-    return _instance_from_url(url, STORES)
+    '''
+    Returns a new store designated by the given url. The url's scheme can be
+    prefixed by the schemes of one or more wrappers, joined by "+". Each
+    wrapper is given the url under its own scheme::
+
+        >>> store = store_from_url('bloom+tmp:?bloom_capacity=1000')
+        >>> store
+        <sicds.stores.bloom.BloomStore object at ...>
+        >>> store.store
+        <sicds.stores.tmp.TmpStore object at ...>
+        >>> store.filter.capacity
+        1000
+
+    Wrappers which need to read every digest in the store cannot wrap one
+    which only keeps fingerprints of them::
+
+        >>> store_from_url('bloom+compact:')
+        Traceback (most recent call last):
+        ...
+        StoreError: bloom cannot wrap CompactStore, which cannot list its digests
+
+    '''
+    scheme, sep, rest = url.partition(':')
+    schemes = scheme.split('+')
+    storeurl = schemes.pop() + sep + rest
+    store = _instance_from_url(storeurl, STORES)
+    store.from_url = storeurl
+    while schemes:
+        wrapper = schemes.pop()
+        if wrapper in NEEDS_DIGESTS and not store.LISTS_DIGESTS:
+            raise StoreError('{0} cannot wrap {1}, which cannot list its '
+                'digests'.format(wrapper, store.__class__.__name__))
+        store = _instance_from_url(wrapper + sep + rest, STORE_WRAPPERS, store)
+        storeurl = wrapper + '+' + storeurl
+        store.from_url = storeurl
+    return store
 
 def logger_from_url(url):
     return _instance_from_url(url, LOGGERS)
 
+def count(value):
+    '''
+    Returns ``value`` as an int, which must not be negative. Wrapped by
+    :func:`sicds.schema.nonfalse`, it must also not be zero::
+
+        >>> config = dict(superkey=u'superkey', store='tmp:')
+        >>> SiCDSConfig(dict(config, log_queue_size=-1))
+        Traceback (most recent call last):
+        ...
+        InvalidField: ...
+        >>> SiCDSConfig(dict(config, log_batch_size=0))
+        Traceback (most recent call last):
+        ...
+        EmptyField: ...
+
+    '''
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+def log_when_full(value):
+    if value not in QueueLogger.WHEN_FULL:
+        raise ValueError(value)
+    return value
+
 class SiCDSConfig(Schema):
     required = {
         'superkey': t_uni,
@@ -93,8 +172,25 @@ class SiCDSConfig(Schema):
     optional = {
         'host': str,
         'port': withdefault(int, ''),
+        # worker processes forked by sicdsapp (0 to serve in one process),
+        # and threads serving requests in each (see sicds.server)
+        'workers': withdefault(int, 0),
+        'threads': withdefault(int, 1),
         'keys': withdefault(many(t_uni), []),
+        # if nonzero, keys registered by other processes are picked up this
+        # many seconds apart
+        'keys_refresh': withdefault(float, 0.0),
+        # if true, /register issues keys signed with the superkey, which are
+        # checked without a lookup, unless listed in revoked_keys
+        'signed_keys': withdefault(bool, False),
+        'revoked_keys': withdefault(many(t_uni), []),
         'loggers': withdefault(many(logger_from_url), [StdOutLogger()]),
+        # if nonzero, log records are queued (up to this many) and added
+        # to the loggers in batches by a background thread
+        'log_queue_size': withdefault(count, 0),
+        'log_batch_size': withdefault(nonfalse(count), 100),
+        'log_flush_interval': withdefault(float, 1.0),
+        'log_when_full': withdefault(log_when_full, 'drop'),
         }
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+'''
+Digest functions for dif collections.
+
+Each scheme turns a client key and a collection of difs into a digest
+identifying the collection for that client, regardless of the order of its
+difs::
+
+    >>> from sicds.app import Dif
+    >>> difs = [Dif(type=u'ab', value=u'c'), Dif(type=u'x', value=u'y')]
+    >>> sha1 = hasher('sha1')
+    >>> sha1(u'key', difs) == sha1(u'key', difs[::-1])
+    True
+
+Every scheme but the legacy one feeds the hash function the key, types and
+values each prefixed by its length, so that differently split strings
+cannot collide as they do for the legacy scheme::
+
+    >>> legacy = hasher('legacy')
+    >>> moved = [Dif(type=u'a', value=u'bc'), Dif(type=u'x', value=u'y')]
+    >>> legacy(u'key', difs) == legacy(u'key', moved)
+    True
+    >>> sha1(u'key', difs) == sha1(u'key', moved)
+    False
+
+and tags its digests with a leading version byte, so that digests from
+different schemes (or sizes) can be stored side by side::
+
+    >>> len(legacy(u'key', difs)), len(sha1(u'key', difs))
+    (20, 21)
+    >>> sha1(u'key', difs)[0] == chr(sha1.version)
+    True
+    >>> short = hasher('sha256', digest_size=8)
+    >>> len(short(u'key', difs)), short.size
+    (9, 9)
+
+'''
+
+import hashlib
+from struct import Struct
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+class UnknownHash(ValueError): pass
+
+_length = Struct('>I').pack
+
+def _encode(key, difs):
+    '''
+    Returns the length-prefixed utf-8 encoding of ``key`` followed by the
+    sorted types and values of ``difs``.
+    '''
+    parts = []
+    for s in [key] + [s for pair in sorted((d.type, d.value) for d in difs)
+            for s in pair]:
+        s = s.encode('utf-8')
+        parts.append(_length(len(s)))
+        parts.append(s)
+    return ''.join(parts)
+
+class Hasher(object):
+    '''
+    A digest scheme. Calling it with a client key and a collection of difs
+    returns their digest, ``size`` bytes long.
+    '''
+    #: the name the scheme is configured by
+    name = None
+    #: the leading byte of digests made by this scheme, or None
+    version = None
+
+    def __init__(self, digest_size=0):
+        self.digest_size = digest_size or self.DEFAULT_DIGEST_SIZE
+        if not 0 < self.digest_size <= self.MAX_DIGEST_SIZE:
+            raise ValueError('digest_size must be between 1 and {0}'
+                .format(self.MAX_DIGEST_SIZE))
+        self.size = self.digest_size + (self.version is not None)
+        if self.version is not None:
+            self.tag = chr(self.version)
+
+    def __call__(self, key, difs):
+        return self.tag + self._digest(_encode(key, difs))
+
+    def _digest(self, data):
+        raise NotImplementedError
+
+class LegacyHasher(Hasher):
+    '''
+    SHA-1 over the key and the sorted types and values run together, as
+    digests were made before schemes could be chosen. Digests are untagged.
+    '''
+    name = 'legacy'
+    DEFAULT_DIGEST_SIZE = MAX_DIGEST_SIZE = 20
+
+    def __init__(self, digest_size=0):
+        if digest_size not in (0, self.DEFAULT_DIGEST_SIZE):
+            raise ValueError('legacy digests are always {0} bytes'
+                .format(self.DEFAULT_DIGEST_SIZE))
+        Hasher.__init__(self, digest_size)
+
+    def __call__(self, key, difs):
+        hashed = hashlib.sha1(key)
+        for type, value in sorted((d.type, d.value) for d in difs):
+            hashed.update(type)
+            hashed.update(value)
+        return hashed.digest()
+
+class _HashlibHasher(Hasher):
+    '''
+    A hash function from :mod:`hashlib`, truncated to ``digest_size``.
+    '''
+    def _digest(self, data):
+        return self.HASH(data).digest()[:self.digest_size]
+
+class Sha1Hasher(_HashlibHasher):
+    name = 'sha1'
+    version = 1
+    HASH = hashlib.sha1
+    DEFAULT_DIGEST_SIZE = MAX_DIGEST_SIZE = 20
+
+class Sha256Hasher(_HashlibHasher):
+    name = 'sha256'
+    version = 2
+    HASH = hashlib.sha256
+    DEFAULT_DIGEST_SIZE = MAX_DIGEST_SIZE = 32
+
+class Blake2bHasher(Hasher):
+    '''
+    BLAKE2b, which is faster than SHA-1 and takes its digest size as a
+    parameter. Needs Python 3.6's :mod:`hashlib` or the pyblake2 package.
+    '''
+    name = 'blake2b'
+    version = 3
+    DEFAULT_DIGEST_SIZE = 20
+    MAX_DIGEST_SIZE = 64
+
+    def __init__(self, digest_size=0):
+        if blake2b is None:
+            raise UnknownHash('blake2b requires the pyblake2 package')
+        Hasher.__init__(self, digest_size)
+
+    def _digest(self, data):
+        return blake2b(data, digest_size=self.digest_size).digest()
+
+HASHERS = dict((h.name, h) for h in
+    (LegacyHasher, Sha1Hasher, Sha256Hasher, Blake2bHasher))
+
+def hasher(name, digest_size=0):
+    '''
+    Returns the digest scheme called ``name``, making digests of
+    ``digest_size`` bytes (not counting the version byte) if given.
+    '''
+    try:
+        return HASHERS[name](digest_size)
+    except KeyError:
+        raise UnknownHash(name)
+
+#: used by stores unless configured otherwise
+LEGACY = hasher('legacy')
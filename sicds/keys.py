@@ -0,0 +1,73 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+'''
+Signed API keys, which can be checked without looking them up anywhere.
+
+A signed key is the name it was issued for, a dot, and an HMAC of the name
+keyed with the superkey::
+
+    >>> key = sign_key(u'simsalabim', u'client')
+    >>> key
+    u'client.laLCuWExenOeMa5yPpwqrQ'
+    >>> verify_key(u'simsalabim', key)
+    True
+
+so that only the holder of the superkey can issue one, and any process which
+knows the superkey can check one::
+
+    >>> verify_key(u'simsalabim', u'client.forged')
+    False
+    >>> verify_key(u'simsalabim', key.replace(u'client', u'other'))
+    False
+    >>> verify_key(u'other superkey', key)
+    False
+    >>> verify_key(u'simsalabim', u'unsigned')
+    False
+
+Changing the superkey invalidates every key signed with it.
+'''
+
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from hmac import compare_digest, new as hmac
+
+#: bytes of the HMAC kept in a signed key
+SIGNATURE_SIZE = 16
+
+def _signature(superkey, name):
+    mac = hmac(superkey.encode('utf-8'), name.encode('utf-8'), sha256)
+    return urlsafe_b64encode(mac.digest()[:SIGNATURE_SIZE]).rstrip('=')
+
+def sign_key(superkey, name):
+    '''
+    Returns the key signed with ``superkey`` for the client called ``name``.
+    '''
+    return u'{0}.{1}'.format(name, _signature(superkey, name))
+
+def verify_key(superkey, key):
+    '''
+    Returns true if ``key`` was signed with ``superkey``.
+    '''
+    name, dot, signature = key.rpartition(u'.')
+    if not dot:
+        return False
+    return compare_digest(_signature(superkey, name),
+        signature.encode('utf-8'))
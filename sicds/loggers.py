@@ -18,38 +18,75 @@
 # Boston, MA  02110-1301
 # USA
 
+from Queue import Empty, Full, Queue
+from atexit import register as atexit
 from sicds.base import BaseLogger
-from sys import stdout
+from sys import stderr, stdout
+from threading import Lock, Thread
+from time import time
+
+def _completed_future(result=None):
+    from concurrent.futures import Future
+    future = Future()
+    future.set_result(result)
+    return future
 
 class NullLogger(BaseLogger):
     '''
     Stub logger. Just throws entries away.
     '''
+    THREADSAFE = True
+
     def log(self, *args, **kw):
         pass
 
+    def log_async(self, *args, **kw):
+        return _completed_future()
+
+    def _add_log_records(self, records):
+        pass
+
 class TmpLogger(BaseLogger):
     '''
     Stores log records in memory. Records are lost when the object is destroyed.
     '''
+    # appending to a list is atomic
+    THREADSAFE = True
+
     def __init__(self, *args, **kw):
         self._log_records = []
 
     def _add_log_record(self, record):
         self._log_records.append(record)
 
+    def _add_log_records(self, records):
+        self._log_records.extend(records)
+
     def iterlog(self):
         return iter(self._log_records)
 
 class FileLogger(BaseLogger):
     '''
     Opens a file at the path specified in ``url`` and logs entries to it.
+    Entries are written whole, one thread at a time.
     '''
+    THREADSAFE = True
+
     def __init__(self, url):
         self.file = open(url.path, 'a')
+        self.filelock = Lock()
 
     def _add_log_record(self, entry):
-        self.file.write('{0}\n'.format(entry))
+        line = '{0}\n'.format(self._decode_bodies(entry))
+        with self.filelock:
+            self.file.write(line)
+
+    def _add_log_records(self, entries):
+        lines = ''.join('{0}\n'.format(self._decode_bodies(e))
+            for e in entries)
+        with self.filelock:
+            self.file.write(lines)
+            self.file.flush()
 
 class StdOutLogger(FileLogger):
     '''
@@ -57,3 +94,116 @@ class StdOutLogger(FileLogger):
     '''
     def __init__(self, *args):
         self.file = stdout
+        self.filelock = Lock()
+
+class QueueLogger(BaseLogger):
+    '''
+    Puts log records on a bounded queue and returns right away, so that
+    logging does not hold up (or fail) the response. A background thread
+    takes the records off the queue in batches of up to ``batch_size``,
+    waiting at most ``flush_interval`` seconds for a batch to fill up, and
+    adds each batch to every logger in ``loggers`` in a single call to
+    :meth:`sicds.base.BaseLogger._add_log_records`.
+
+    When the queue already holds ``maxsize`` records, ``when_full`` decides
+    what happens to the next one: ``'drop'`` throws it away and counts it in
+    :attr:`dropped`, ``'block'`` makes the request wait for room.
+    Records that fail to be added are counted in :attr:`failed` and
+    reported on stderr.
+
+    Records still on the queue are flushed by :meth:`close`, which is
+    called at exit.
+
+        >>> tmp = TmpLogger()
+        >>> logger = QueueLogger([tmp], batch_size=2, flush_interval=60)
+        >>> for i in range(3):
+        ...     logger._add_log_record({'i': i})
+        >>> logger.close()
+        >>> list(tmp.iterlog())
+        [{'i': 0}, {'i': 1}, {'i': 2}]
+
+    '''
+    WHEN_FULL = ('drop', 'block')
+    THREADSAFE = True
+
+    _STOP = object()
+
+    def __init__(self, loggers, maxsize=10000, batch_size=100,
+            flush_interval=1.0, when_full='drop'):
+        if when_full not in self.WHEN_FULL:
+            raise ValueError(when_full)
+        self.loggers = loggers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = when_full == 'block'
+        self.maxsize = maxsize
+        self.dropped = self.failed = 0
+        self._start()
+        atexit(self.close)
+
+    def _start(self):
+        self.queue = Queue(self.maxsize)
+        self._counterlock = Lock()
+        self._worker = Thread(target=self._run, name='QueueLogger')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def after_fork(self):
+        # the background thread does not survive a fork. records queued
+        # before it are left to the parent process to flush.
+        self._start()
+        for logger in self.loggers:
+            logger.after_fork()
+
+    def log_async(self, *args, **kw):
+        self.log(*args, **kw)
+        return _completed_future()
+
+    def _add_log_record(self, record):
+        try:
+            self.queue.put(record, self.block)
+        except Full:
+            with self._counterlock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                return
+            batch = [record]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(True, timeout)
+                except Empty:
+                    break
+                if record is self._STOP:
+                    self._flush(batch)
+                    return
+                batch.append(record)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        for logger in self.loggers:
+            try:
+                # each logger gets its own copies, since some of them
+                # (e.g. MongoDB and CouchDB) add fields to the records
+                logger._add_log_records([dict(r) for r in batch])
+            except Exception as e:
+                with self._counterlock:
+                    self.failed += len(batch)
+                stderr.write('Failed to log {0} record(s) to {1}: {2}\n'
+                    .format(len(batch), logger.__class__.__name__, repr(e)))
+
+    def close(self):
+        '''
+        Flushes any records still on the queue and stops the background
+        thread. Records logged afterwards are queued but never flushed.
+        '''
+        if self._worker.is_alive():
+            self.queue.put(self._STOP)
+            self._worker.join()
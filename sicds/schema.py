@@ -29,6 +29,26 @@ class EmptyField(SchemaError): pass
 class ExtraFields(SchemaError): pass
 class ReferenceError(SchemaError): pass
 
+class SchemaType(type):
+    '''
+    Metaclass for :class:`Schema`. Unless a class defines its own
+    ``__slots__``, it gets a slot for each of its fields which is not
+    already a slot of a base class, so that its instances have no
+    ``__dict__``.
+    '''
+    def __new__(meta, name, bases, attrs):
+        if '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for cls in base.__mro__:
+                    slots = cls.__dict__.get('__slots__', ())
+                    if isinstance(slots, basestring):
+                        slots = (slots,)
+                    inherited.update(slots)
+            fields = chain(attrs.get('required', ()), attrs.get('optional', ()))
+            attrs['__slots__'] = tuple(sorted(set(fields) - inherited))
+        return type.__new__(meta, name, bases, attrs)
+
 class Schema(object):
     '''
     Subclasses specify required and optional field->validator mappings to
@@ -85,6 +105,11 @@ class Schema(object):
           ...
         ExtraFields: suffix
 
+    Fields are stored in slots rather than in a per-instance dict::
+
+        >>> hasattr(name, '__dict__')
+        False
+
     You can delete fields too, but only if they're optional. This causes the
     field to be reset to its default value::
 
@@ -173,6 +198,8 @@ class Schema(object):
         <Name first='(first)' last='Simpson'>
 
     '''
+    __metaclass__ = SchemaType
+
     required = {}
     optional = {}
 
@@ -210,9 +237,19 @@ class Schema(object):
         if values:
             raise ExtraFields(', '.join(values.iterkeys()))
 
-        defaults = dict((field, validator()) for \
-            (field, validator) in self.optional.iteritems())
-        object.__setattr__(self, '_defaults', defaults)
+    @classmethod
+    def _defaults(cls):
+        '''
+        Returns a dict mapping each optional field to its default value.
+        It is made the first time it is needed and shared by all instances.
+        '''
+        try:
+            return cls.__dict__['_defaults_cache']
+        except KeyError:
+            defaults = dict((field, validator()) for \
+                (field, validator) in cls.optional.iteritems())
+            cls._defaults_cache = defaults
+            return defaults
 
     def __setattr__(self, attr, value):
         try:
@@ -228,8 +265,12 @@ class Schema(object):
     def __delattr__(self, attr):
         if attr in self.required:
             raise RequiredField(attr)
-        default = self._defaults[attr]
-        object.__setattr__(self, attr, default)
+        try:
+            validator = self.optional[attr]
+        except KeyError:
+            raise ExtraFields(attr)
+        # call with no args for default value, as in __init__
+        object.__setattr__(self, attr, validator())
 
     @property
     def unwrap(self):
@@ -238,7 +279,7 @@ class Schema(object):
     def __eq__(self, other):
         other = unwrap(other)
         if isinstance(other, dict):
-            other = dict(self._defaults, **other)
+            other = dict(self._defaults(), **other)
         return unwrap(self) == other
 
     def __repr__(self):
@@ -296,6 +337,7 @@ def nonfalse(validator):
         if not result:
             raise EmptyField
         return result
+    wrapper.schema_wrapper = (nonfalse, validator)
     return wrapper
 
 t_uni, t_int = [nonfalse(i) for i in (unicode, int)]
@@ -327,6 +369,7 @@ def withdefault(validator, default):
         if not args:
             return default
         return validator(*args)
+    wrapper.schema_wrapper = (withdefault, validator, default)
     return wrapper
 
 def many(validator, uniq=False, atleast=None):
@@ -357,8 +400,169 @@ def many(validator, uniq=False, atleast=None):
         if atleast is not None and len(result) < atleast:
             raise InvalidField
         return result
+    wrapper.schema_wrapper = (many, validator, uniq, atleast)
     return wrapper
 
+#: validators whose results never need to be unwrapped or dereferenced
+_BUILTIN_VALIDATORS = frozenset((unicode, str, int, long, float, bool))
+_SCALARS = (basestring, int, long, float, bool, type(None))
+
+_compiled = {}
+
+def compile_schema(cls):
+    '''
+    Returns a function which does the same as calling the Schema subclass
+    ``cls`` with a single mapping, raising the same errors for invalid
+    input, but faster. The fields of ``cls`` are looked at only once, and
+    fields validated by builtin types, subschemas, or :func:`many`,
+    :func:`nonfalse` and :func:`withdefault` wrappers of those skip the
+    generic unwrapping and dereferencing steps. Other fields are validated
+    as usual. Compiled functions are cached, so compiling a class again is
+    cheap.
+
+        >>> class Dif(Schema):
+        ...     required = {'type': t_uni, 'value': t_uni}
+        >>> class Difs(Schema):
+        ...     required = {'difs': many(Dif, atleast=1)}
+        ...     optional = {'note': withdefault(str, 'none')}
+        >>> parse = compile_schema(Difs)
+        >>> parse is compile_schema(Difs)
+        True
+        >>> difs = parse({'difs': [{'type': u't', 'value': u'v'}]})
+        >>> difs
+        <Difs difs=[{'type': u't', 'value': u'v'}] note='none'>
+        >>> difs.difs[0]
+        <Dif type=u't' value=u'v'>
+        >>> difs == Difs({'difs': [{'type': u't', 'value': u'v'}]})
+        True
+        >>> difs.note = 'noted'
+        >>> del difs.note
+        >>> difs.note
+        'none'
+        >>> parse({'difs': [{'type': u't'}]})
+        Traceback (most recent call last):
+          ...
+        RequiredField: value
+        >>> parse({'difs': []})
+        Traceback (most recent call last):
+          ...
+        InvalidField
+        >>> parse({'difs': 'abc'})
+        Traceback (most recent call last):
+          ...
+        InvalidField: ('difs', 'abc')
+        >>> parse({'difs': [{'type': u't', 'value': u''}]})
+        Traceback (most recent call last):
+          ...
+        EmptyField: difs
+        >>> parse({'difs': [{'type': u't', 'value': u'v'}], 'extra': 1})
+        Traceback (most recent call last):
+          ...
+        ExtraFields: extra
+
+    '''
+    try:
+        return _compiled[cls]
+    except KeyError:
+        pass
+
+    # filled in below, after the function is cached, so that schemas which
+    # refer to themselves can be compiled
+    fields = []
+    names = frozenset(chain(cls.required, cls.optional))
+    new = object.__new__
+    setattr_ = object.__setattr__
+
+    def validate(values):
+        if type(values) is not dict:
+            if not isinstance(values, Schema):
+                return cls(values)
+            values = unwrap(values)
+        self = new(cls)
+        nfound = 0
+        for field, validator, fast, required in fields:
+            try:
+                value = values[field]
+            except KeyError:
+                if required:
+                    raise RequiredField(field)
+                # field is optional, use default value
+                value = dereference(validator(), self)
+            else:
+                nfound += 1
+                if fast is None:
+                    value = self._validate(field, validator, value)
+                    value = dereference(value, self)
+                else:
+                    try:
+                        value = fast(value)
+                    except EmptyField:
+                        raise EmptyField(field)
+                    except SchemaError:
+                        raise
+                    except Exception:
+                        raise InvalidField(field, value)
+            setattr_(self, field, value)
+
+        if nfound != len(values):
+            raise ExtraFields(', '.join(k for k in values if k not in names))
+        return self
+
+    _compiled[cls] = validate
+    for field, validator in chain(
+            cls.required.iteritems(), cls.optional.iteritems()):
+        fields.append((field, validator, _compile_validator(validator),
+            field in cls.required))
+    return validate
+
+def _compile_validator(validator):
+    '''
+    Returns a function equivalent to ``validator`` when given a value which
+    has not been unwrapped, and whose result needs no dereferencing, or None
+    if there is no such function.
+    '''
+    if isinstance(validator, type) and issubclass(validator, Schema):
+        return compile_schema(validator)
+
+    if validator in _BUILTIN_VALIDATORS:
+        def fast(value):
+            if not isinstance(value, _SCALARS):
+                value = unwrap(value)
+            return validator(value)
+        return fast
+
+    wrapped = getattr(validator, 'schema_wrapper', None)
+    if wrapped is None:
+        return None
+    inner = _compile_validator(wrapped[1])
+    if inner is None:
+        return None
+
+    if wrapped[0] is withdefault:
+        # only differs from the wrapped validator when called with no args
+        return inner
+
+    if wrapped[0] is nonfalse:
+        def fast(value):
+            result = inner(value)
+            if not result:
+                raise EmptyField
+            return result
+        return fast
+
+    if wrapped[0] is many:
+        uniq, atleast = wrapped[2:]
+        def fast(iterable):
+            result = [inner(i) for i in iterable]
+            if uniq:
+                result = list(set(result))
+            if atleast is not None and len(result) < atleast:
+                raise InvalidField
+            return result
+        return fast
+
+    return None
+
 
 if __name__ == '__main__':
     import doctest
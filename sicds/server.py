@@ -0,0 +1,673 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+'''
+A pre-forking, threaded HTTP/1.1 WSGI server for :class:`sicds.app.SiCDSApp`,
+so that one node can use all of its cores.
+
+:class:`PreforkServer` forks ``workers`` processes which share a listening
+socket (or, where the platform supports ``SO_REUSEPORT``, each listen on
+their own socket bound to the same port, and the kernel spreads connections
+among them). Each worker serves connections with a pool of ``threads``
+threads, keeping them open between requests (HTTP/1.1 keep-alive). Workers
+which die are replaced, and SIGTERM (or SIGINT) shuts everything down
+gracefully: workers stop accepting connections and finish the requests
+they have started before exiting.
+
+Since workers are forked from the process which set up the app, the store
+must be one which several processes can share (see
+:attr:`sicds.base.BaseStore.PROCESS_SAFE`). With ``workers=0``, the threads
+serve in this process instead, with any store.
+'''
+
+import atexit
+import fcntl
+import os
+import signal
+import socket
+from errno import ECHILD, EINTR
+from Queue import Queue
+from select import POLLIN, poll, select, error as SelectError
+from SocketServer import TCPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+from sys import exc_info, stderr
+from threading import Lock, Thread
+from time import sleep, time
+from traceback import print_exc
+from urllib import unquote
+
+class _BodyReader(object):
+    '''
+    File-like object for a request body of ``length`` bytes, which can be
+    drained afterwards so that the next request on the connection can be
+    read. Without a length, the body is read in chunked transfer coding.
+    '''
+    def __init__(self, rfile, length=None):
+        self.rfile = rfile
+        self.chunked = length is None
+        #: bytes left in the body, or in the current chunk if chunked
+        self.left = 0 if self.chunked else length
+        self.eof = not self.chunked and not length
+        self.buf = ''
+
+    def _read(self, size):
+        '''
+        Reads up to ``size`` bytes of the body from the connection.
+        '''
+        if self.eof:
+            return ''
+        if self.chunked and not self.left:
+            line = self.rfile.readline(1024)
+            try:
+                self.left = int(line.split(';', 1)[0], 16)
+            except ValueError:
+                raise IOError('Bad chunk size in request body')
+            if not self.left:
+                # skip any trailer, up to the blank line ending the body
+                while self.rfile.readline(1024).strip():
+                    pass
+                self.eof = True
+                return ''
+        data = self.rfile.read(min(size, self.left))
+        if not data:
+            raise IOError('Connection closed before end of request body')
+        self.left -= len(data)
+        if not self.left:
+            if self.chunked:
+                self.rfile.readline(1024) # the CRLF ending the chunk
+            else:
+                self.eof = True
+        return data
+
+    def read(self, size=-1):
+        chunks = [self.buf]
+        n = len(self.buf)
+        while size < 0 or n < size:
+            data = self._read(65536 if size < 0 else size - n)
+            if not data:
+                break
+            chunks.append(data)
+            n += len(data)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buf = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        while '\n' not in self.buf and (size < 0 or len(self.buf) < size):
+            data = self._read(65536 if size < 0 else size - len(self.buf))
+            if not data:
+                break
+            self.buf += data
+        end = self.buf.find('\n') + 1 or len(self.buf)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self, limit):
+        '''
+        Reads and discards what is left of the body, and returns whether
+        that was all of it, i.e. at most ``limit`` bytes.
+        '''
+        self.buf = ''
+        while not self.eof:
+            if limit <= 0:
+                return False
+            limit -= len(self._read(min(limit, 65536)))
+        return True
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the WSGI app of the server on an HTTP/1.1 connection, for as many
+    requests as the client sends until it closes the connection, asks for
+    it to be closed, or leaves it idle for :attr:`timeout` seconds.
+    Responses without a Content-Length are sent in chunked transfer coding.
+
+    Unlike other request handlers, making one only sets up the connection:
+    the server calls :meth:`handle` each time the client has sent a
+    request, and :meth:`finish` once the connection is to be closed.
+    '''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'SiCDS'
+    #: seconds an idle connection is kept open
+    timeout = 5
+    #: at most this much of a request body left unread by the app is
+    #: skipped to read the next request; the connection is closed otherwise
+    MAX_DRAIN = 65536
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle(self):
+        '''
+        Serves the requests the client has sent, and returns whether the
+        connection is to be kept open for more.
+        '''
+        while True:
+            self.close_connection = 1
+            self.handle_one_request()
+            if self.close_connection:
+                return False
+            # a request the client has already sent (pipelined) may have
+            # been read ahead into the buffer of rfile, where the server
+            # would not see it
+            if not self.rfile._rbuf.getvalue():
+                return True
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if self.server.stopping:
+            self.close_connection = 1
+        try:
+            self.run_wsgi()
+            self.wfile.flush()
+        except socket.error:
+            self.close_connection = 1
+
+    def environ(self, body):
+        env = self.server.base_environ.copy()
+        path, _, query = self.path.partition('?')
+        env.update({
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            })
+        for name in self.headers:
+            value = ','.join(v.strip() for v in
+                self.headers.getheaders(name))
+            name = name.upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            env[name] = value
+        return env
+
+    def run_wsgi(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = _BodyReader(self.rfile)
+        else:
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                self.send_error(400, 'Bad Content-Length')
+                return
+            body = _BodyReader(self.rfile, length)
+        if self.headers.get('Expect', '').lower() == '100-continue' and \
+                self.request_version == 'HTTP/1.1':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+        env = self.environ(body)
+        if body.chunked:
+            env.pop('CONTENT_LENGTH', None)
+
+        state = dict(status=None, headers=None, sent=False, chunked=False)
+
+        def send_headers():
+            code, _, reason = state['status'].partition(' ')
+            self.send_response(int(code), reason)
+            names = set()
+            for name, value in state['headers']:
+                self.send_header(name, value)
+                names.add(name.lower())
+            if 'content-length' not in names:
+                if self.request_version == 'HTTP/1.1':
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    state['chunked'] = True
+                else:
+                    self.close_connection = 1
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            state['sent'] = True
+
+        def write(data):
+            if not state['sent']:
+                send_headers()
+            if not data or self.command == 'HEAD':
+                return
+            if state['chunked']:
+                data = '{0:x}\r\n{1}\r\n'.format(len(data), data)
+            self.wfile.write(data)
+
+        def start_response(status, headers, exc=None):
+            if exc and state['sent']:
+                raise exc[0], exc[1], exc[2]
+            state['status'], state['headers'] = status, headers
+            return write
+
+        try:
+            result = self.server.app(env, start_response)
+            try:
+                for data in result:
+                    write(data)
+                if not state['sent']:
+                    send_headers()
+                if state['chunked'] and self.command != 'HEAD':
+                    self.wfile.write('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except socket.error:
+            raise
+        except Exception:
+            print_exc(file=stderr)
+            self.close_connection = 1
+            if not state['sent']:
+                self.send_error(500)
+            return
+        try:
+            if not body.drain(self.MAX_DRAIN):
+                self.close_connection = 1
+        except IOError:
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        # requests are logged by the app's loggers
+        pass
+
+class WSGIServer(TCPServer):
+    '''
+    Serves a WSGI app with a pool of ``threads`` threads, using
+    :class:`WSGIRequestHandler`. One more thread accepts connections and
+    watches those waiting for a request: each is handed to a thread of the
+    pool only once the client has sent something, and goes back to being
+    watched after its response, so that idle keep-alive connections do not
+    hold threads. Readable connections wait in a queue of up to ``threads``
+    for a free thread, beyond which the server stops accepting and the
+    kernel's backlog fills.
+    '''
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, app, threads=1, reuse_port=False,
+            bind_and_activate=True, multiprocess=False):
+        self.app = app
+        self.threads = threads
+        self.reuse_port = reuse_port
+        #: set once the server is stopping: responses ask clients to close
+        #: their connections
+        self.stopping = False
+        self.requests = Queue(threads)
+        self.workers = []
+        self.base_environ = {
+            'SERVER_NAME': address[0] or socket.gethostname(),
+            'SCRIPT_NAME': '',
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': stderr,
+            'wsgi.multithread': threads > 1,
+            'wsgi.multiprocess': multiprocess,
+            'wsgi.run_once': False,
+            }
+        TCPServer.__init__(self, address, WSGIRequestHandler,
+            bind_and_activate)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
+        self.base_environ['SERVER_PORT'] = str(self.server_address[1])
+
+    def start(self):
+        '''
+        Starts the threads of the pool and the thread accepting and
+        watching connections.
+        '''
+        #: connections to be watched, handed over by other threads
+        self.parked = []
+        self.lock = Lock()
+        #: set once the watching thread has stopped
+        self.closed = False
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # other processes may accept from the same socket once it is ready
+        self.socket.setblocking(0)
+        for i in xrange(self.threads):
+            worker = Thread(target=self._work, name='WSGIServer')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.poller = Thread(target=self._poll, name='WSGIServer poll')
+        self.poller.daemon = True
+        self.poller.start()
+
+    def process_request(self, request, client_address):
+        self._park(self.RequestHandlerClass(request, client_address, self))
+
+    def _park(self, handler):
+        '''
+        Has the connection of ``handler`` watched until the client sends a
+        request, or closes it if the server is stopping.
+        '''
+        with self.lock:
+            if not self.closed:
+                self.parked.append(handler)
+                self._wake()
+                handler = None
+        if handler is not None:
+            self._close(handler)
+
+    def _wake(self):
+        # called with the lock held, so that the pipe is not closed under it
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError:
+            pass # the pipe is full, so the poll wakes up anyway
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except socket.error:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _poll(self):
+        '''
+        Accepts connections, hands those on which the client has sent
+        something (or which it has closed) to the pool, and closes those
+        left idle for :attr:`WSGIRequestHandler.timeout` seconds.
+        '''
+        poller = poll()
+        poller.register(self.socket, POLLIN)
+        poller.register(self.wakeup[0], POLLIN)
+        #: maps the file descriptors of the connections watched to their
+        #: handlers and the times they are closed at if still idle
+        idle = {}
+        while not self.stopping:
+            with self.lock:
+                parked, self.parked = self.parked, []
+            now = time()
+            for handler in parked:
+                fd = handler.connection.fileno()
+                idle[fd] = handler, now + handler.timeout
+                poller.register(fd, POLLIN)
+            timeout = None
+            if idle:
+                timeout = max(min(d for h, d in idle.itervalues()) - now, 0)
+                timeout *= 1000
+            try:
+                events = poller.poll(timeout)
+            except SelectError as e:
+                if e.args[0] != EINTR:
+                    raise
+                continue
+            for fd, event in events:
+                if fd == self.wakeup[0]:
+                    os.read(fd, 512)
+                elif fd in idle:
+                    poller.unregister(fd)
+                    self.requests.put(idle.pop(fd)[0])
+                else:
+                    self._handle_request_noblock()
+            now = time()
+            for fd, (handler, deadline) in idle.items():
+                if deadline <= now:
+                    poller.unregister(fd)
+                    del idle[fd]
+                    self._close(handler)
+        with self.lock:
+            self.closed = True
+            parked, self.parked = self.parked, []
+        for handler in parked + [h for h, d in idle.itervalues()]:
+            self._close(handler)
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def _work(self):
+        while True:
+            handler = self.requests.get()
+            if handler is None:
+                return
+            try:
+                keep = handler.handle()
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                keep = False
+            if keep:
+                self._park(handler)
+            else:
+                self._close(handler)
+
+    def handle_error(self, request, client_address):
+        # clients going away are not worth a traceback
+        if not isinstance(exc_info()[1], socket.error):
+            TCPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        '''
+        Stops accepting connections, closes the idle ones and waits for the
+        threads to finish the requests they have started.
+        '''
+        self.stopping = True
+        with self.lock:
+            if not self.closed:
+                self._wake()
+        self.poller.join()
+        self.server_close()
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+#: the value of SO_REUSEPORT, which the socket module of Python 2 does not
+#: define on every platform which has it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+    15 if os.uname()[0] == 'Linux' else None)
+
+def _supports_reuse_port():
+    if SO_REUSEPORT is None:
+        return False
+    sock = socket.socket()
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+class PreforkServer(object):
+    '''
+    Serves ``app`` on ``host`` and ``port`` from ``workers`` forked
+    processes with ``threads`` threads each (see the module docstring).
+    :meth:`serve_forever` returns once the server has been shut down by a
+    signal.
+    '''
+    #: seconds given to workers to finish their requests on shutdown, after
+    #: which they are killed
+    GRACEFUL_TIMEOUT = 30
+    #: a worker which dies within this many seconds of starting is replaced
+    #: only after as long again, so that a worker failing on startup (e.g.
+    #: because the store is down) does not make the server spin
+    MIN_LIFETIME = 1.0
+
+    def __init__(self, app, host, port, workers=0, threads=1):
+        if workers and not app.store.PROCESS_SAFE:
+            raise ValueError('{0} cannot be shared by worker processes'
+                .format(app.store.__class__.__name__))
+        if threads > 1 and not app.threadsafe:
+            raise ValueError('the app cannot be served by several threads')
+        self.app = app
+        self.address = (host, port)
+        self.nworkers = workers
+        self.threads = threads
+        #: maps the pid of each worker to the time it was started
+        self.workers = {}
+        self.stopping = False
+        self.reuse_port = bool(workers) and _supports_reuse_port()
+        # with SO_REUSEPORT, the socket here only holds the port (it is
+        # bound but does not listen, so it is given no connections), and
+        # each worker listens on its own
+        self.httpd = WSGIServer(self.address, app, threads, self.reuse_port,
+            bind_and_activate=False, multiprocess=bool(workers))
+        self.httpd.server_bind()
+        if not self.reuse_port:
+            self.httpd.server_activate()
+        self.port = self.httpd.server_address[1]
+
+    def _on_signal(self, signum, frame):
+        self.stopping = True
+
+    def _wait(self, timeout):
+        '''
+        Waits up to ``timeout`` seconds for a signal, whichever thread it is
+        delivered to.
+        '''
+        try:
+            if select([self.wakeup], [], [], timeout)[0]:
+                os.read(self.wakeup, 512)
+        except (SelectError, OSError) as e:
+            if e.args[0] != EINTR:
+                raise
+
+    def _handle_signals(self):
+        r, w = os.pipe()
+        for fd in (r, w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.wakeup = r
+        signal.set_wakeup_fd(w)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def _serve(self, httpd):
+        '''
+        Serves requests with ``httpd`` in this process until a signal stops
+        it.
+        '''
+        httpd.start()
+        while not self.stopping:
+            self._wait(None)
+        httpd.stop()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time()
+            return
+        status = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup)
+            self._handle_signals()
+            # only the master is interrupted from the terminal
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.app.after_fork()
+            httpd = self.httpd
+            if self.reuse_port:
+                httpd.server_close()
+                httpd = WSGIServer(self.address[:1] + (self.port,), self.app,
+                    self.threads, reuse_port=True, multiprocess=True)
+            self._serve(httpd)
+            self.app.close()
+            status = 0
+        except:
+            print_exc(file=stderr)
+        finally:
+            # the exit handlers (e.g. flushing queued log records) are run
+            # here, since the worker must not return into the master's loop
+            try:
+                atexit._run_exitfuncs()
+            finally:
+                os._exit(status)
+
+    def _reap(self):
+        '''
+        Collects the workers which have exited and returns how many did.
+        '''
+        reaped = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == ECHILD:
+                    self.workers.clear()
+                    return reaped
+                if e.errno != EINTR:
+                    raise
+                continue
+            if not pid:
+                return reaped
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            reaped += 1
+            if not self.stopping:
+                stderr.write('Worker {0} exited with status {1}\n'
+                    .format(pid, status))
+                if time() - started < self.MIN_LIFETIME:
+                    sleep(self.MIN_LIFETIME)
+
+    def serve_forever(self):
+        self._handle_signals()
+        if not self.nworkers:
+            self._serve(self.httpd)
+            return
+        while not self.stopping:
+            while len(self.workers) < self.nworkers and not self.stopping:
+                self._spawn()
+            self._wait(1.0)
+            self._reap()
+        for pid in self.workers:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time() + self.GRACEFUL_TIMEOUT
+        while self.workers and time() < deadline:
+            self._wait(0.1)
+            self._reap()
+        for pid in self.workers:
+            self._kill(pid, signal.SIGKILL)
+        while self.workers:
+            self._wait(0.1)
+            self._reap()
+        self.httpd.server_close()
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass # already gone
@@ -0,0 +1,247 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from atexit import register as atexit
+from calendar import timegm
+from datetime import datetime, timedelta
+from hashlib import sha1
+from math import ceil, log
+from os import fsync, rename
+from sicds.base import PartialStoreError, StoreWrapper, url_options, utcnow
+from struct import calcsize, pack, unpack
+from threading import Lock
+
+class BloomFilter(object):
+    '''
+    A fixed-size set of bits, ``nhashes`` of which are set for each element
+    added. Membership tests can give false positives, at a rate which stays
+    below ``error_rate`` while no more than ``capacity`` elements have been
+    added, but never false negatives.
+
+        >>> f = BloomFilter(1000, 0.01)
+        >>> f.nbits, f.nhashes
+        (9586, 7)
+        >>> 'a' in f
+        False
+        >>> f.add('a')
+        True
+        >>> 'a' in f
+        True
+        >>> f.add('a')
+        False
+        >>> f.count, f.fill_ratio > 0
+        (1, True)
+
+    '''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.nhashes = max(1, int(round(float(self.nbits) / capacity * log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        #: number of bits currently set
+        self.nset = 0
+        #: number of elements added which were not already present
+        self.count = 0
+
+    def _positions(self, element):
+        h1, h2 = unpack('<QQ', sha1(element).digest()[:16])
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in xrange(self.nhashes)]
+
+    def __contains__(self, element):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7))
+            for i in self._positions(element))
+
+    def add(self, element):
+        '''
+        Adds ``element``, returning true if it was definitely not present.
+        '''
+        bits = self.bits
+        new = 0
+        for i in self._positions(element):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                bits[i >> 3] |= mask
+                new += 1
+        self.nset += new
+        if new:
+            self.count += 1
+        return bool(new)
+
+    @property
+    def fill_ratio(self):
+        return float(self.nset) / self.nbits
+
+    @property
+    def estimated_error_rate(self):
+        '''
+        False positive rate at the current fill ratio.
+        '''
+        return self.fill_ratio ** self.nhashes
+
+    #: snapshot header: magic, nbits, nhashes, nset, count, utc timestamp
+    SNAPSHOT_HEADER = '>8sQIQQd'
+    SNAPSHOT_MAGIC = 'SICDSBF1'
+
+    def dump(self, path, timestamp):
+        '''
+        Atomically writes the filter and the given time (a utc datetime) to
+        the file at ``path``.
+        '''
+        tmppath = path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            f.write(pack(self.SNAPSHOT_HEADER, self.SNAPSHOT_MAGIC,
+                self.nbits, self.nhashes, self.nset, self.count,
+                timegm(timestamp.utctimetuple())))
+            f.write(self.bits)
+            f.flush()
+            fsync(f.fileno())
+        finally:
+            f.close()
+        rename(tmppath, path)
+
+    def load(self, path):
+        '''
+        Loads a filter of the same size written by :meth:`dump` from the file
+        at ``path`` and returns the time it was written, or returns None if
+        there is no such file or it was written by a differently sized filter.
+        '''
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            header = f.read(calcsize(self.SNAPSHOT_HEADER))
+            try:
+                magic, nbits, nhashes, nset, count, timestamp = \
+                    unpack(self.SNAPSHOT_HEADER, header)
+            except Exception:
+                return None
+            if (magic, nbits, nhashes) != \
+                    (self.SNAPSHOT_MAGIC, self.nbits, self.nhashes):
+                return None
+            bits = bytearray(f.read())
+        finally:
+            f.close()
+        if len(bits) != len(self.bits):
+            return None
+        self.bits, self.nset, self.count = bits, nset, count
+        return datetime.utcfromtimestamp(timestamp)
+
+class BloomStore(StoreWrapper):
+    '''
+    Keeps a bloom filter of every digest in the wrapped store. Digests the
+    filter has never seen are known to be unique without asking the store,
+    and are inserted into it with :meth:`_add_difs_records_nowait`; only
+    digests the filter may have seen take the usual path.
+
+    The filter is rebuilt from the store on startup. If ``bloom_snapshot``
+    names a file, the filter is loaded from it first, so that only digests
+    added since the snapshot was taken need to be read from the store, and a
+    new snapshot is written after startup and on exit.
+
+    The filter must see every digest that goes into the store, so this
+    should only be used while this process is the store's only writer.
+    A digest which two requests submit at nearly the same time may be
+    reported unique to both if the first request's insert has not reached
+    the store yet when the second one checks it.
+
+    Options (in the url's query string): ``bloom_capacity``,
+    ``bloom_error_rate``, ``bloom_snapshot``.
+    '''
+    # the filter is kept in each process's own memory
+    PROCESS_SAFE = False
+
+    #: how far back from a snapshot's time to look for digests added
+    #: concurrently with taking it
+    SNAPSHOT_SLACK = timedelta(minutes=1)
+
+    def __init__(self, url, store):
+        StoreWrapper.__init__(self, url, store)
+        options = url_options(url, bloom_capacity=1000000,
+            bloom_error_rate=0.001, bloom_snapshot='')
+        self.snapshot_path = options['bloom_snapshot']
+        self.filter = BloomFilter(options['bloom_capacity'],
+            options['bloom_error_rate'])
+        self.lock = Lock()
+        self.skipped = 0
+        self.checked = 0
+        self._rebuild()
+        if self.snapshot_path:
+            self.snapshot()
+            atexit(self.snapshot)
+
+    def _rebuild(self):
+        since = None
+        if self.snapshot_path:
+            since = self.filter.load(self.snapshot_path)
+        if since is not None:
+            since -= self.SNAPSHOT_SLACK
+        add = self.filter.add
+        for id in self.store.iterdigests(since):
+            add(id)
+
+    def snapshot(self):
+        '''
+        Writes the filter to the file given by the ``bloom_snapshot`` option.
+        '''
+        with self.lock:
+            self.filter.dump(self.snapshot_path, utcnow())
+
+    def _add_difs_records_many(self, key, records):
+        ids = map(self._difs_record_id, records)
+        with self.lock:
+            new = map(self.filter.add, ids)
+            nunseen = sum(new)
+            self.skipped += nunseen
+            self.checked += len(new) - nunseen
+        unseen = [r for (r, isnew) in zip(records, new) if isnew]
+        seen = [r for (r, isnew) in zip(records, new) if not isnew]
+        if unseen:
+            self.store._add_difs_records_nowait(key, unseen)
+        added = iter(PartialStoreError.results_of(
+            self.store._add_difs_records_many, key, seen))
+        return PartialStoreError.check(
+            [isnew or added.next() for isnew in new])
+
+    def clear(self):
+        self.store.clear()
+        with self.lock:
+            self.filter = BloomFilter(self.filter.capacity,
+                self.filter.error_rate)
+
+    def stats(self):
+        stats = self.store.stats()
+        f = self.filter
+        stats[u'bloom'] = dict(
+            capacity=f.capacity,
+            error_rate=f.error_rate,
+            estimated_error_rate=f.estimated_error_rate,
+            nbits=f.nbits,
+            nhashes=f.nhashes,
+            count=f.count,
+            fill_ratio=f.fill_ratio,
+            skipped=self.skipped,
+            checked=self.checked,
+            )
+        return stats
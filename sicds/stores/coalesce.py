@@ -0,0 +1,162 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from collections import defaultdict
+from sicds.base import PartialStoreError, StoreWrapper, url_options
+from threading import Event, Lock
+
+class _Batch(object):
+    '''
+    The dif records gathered from concurrent requests for one write to the
+    wrapped store.
+    '''
+    def __init__(self):
+        #: (key, record) pairs, in the order they were submitted
+        self.records = []
+        #: set once the batch is full, to wake the request waiting on it
+        self.full = Event()
+        #: set once the results (or an error) are in
+        self.done = Event()
+        self.results = self.error = None
+
+class CoalescingStore(StoreWrapper):
+    '''
+    Merges the dif records of concurrent requests into one write to the
+    wrapped store. The first request to come along starts a batch and waits
+    up to ``coalesce_ms`` milliseconds, or until ``coalesce_max`` records
+    have been gathered, for others to add their records to it. It then adds
+    the batch to the store with one call to :meth:`_add_difs_records_many`
+    per key, while the next batch starts gathering, and hands each request
+    its own results.
+
+    A digest submitted by several requests in the same batch is only sent
+    to the store once, and is found new by the first of them at most::
+
+        >>> from sicds.config import store_from_url
+        >>> from threading import Thread
+        >>> store = store_from_url('coalesce+tmp:?coalesce_ms=20')
+        >>> results = {}
+        >>> def submit(id):
+        ...     results[id] = store._add_difs_records_many(u'key', ['a', id])
+        >>> threads = [Thread(target=submit, args=(id,)) for id in 'xyz']
+        >>> for t in threads:
+        ...     t.start()
+        >>> for t in threads:
+        ...     t.join()
+        >>> sorted(results.values())
+        [[False, True], [False, True], [True, True]]
+
+    Batches are added one at a time, but everything else (keys, logging,
+    stats...) goes straight to the store, so it is only as safe to share
+    between threads as the store is (see
+    :attr:`sicds.base.BaseLogger.THREADSAFE`)::
+
+        >>> store_from_url('coalesce+tmp:').THREADSAFE
+        False
+        >>> store_from_url('coalesce+striped:').THREADSAFE
+        True
+
+    With a single-threaded server, it only adds latency.
+    '''
+    def __init__(self, url, store):
+        StoreWrapper.__init__(self, url, store)
+        options = url_options(url, coalesce_ms=2.0, coalesce_max=1000)
+        self.window = options['coalesce_ms'] / 1000.0
+        self.max_records = options['coalesce_max']
+        #: the batch gathering records, if any
+        self.batch = None
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.batches = self.records = self.merged = 0
+
+    def _add_difs_records_many(self, key, records):
+        if not records:
+            return []
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            start = len(batch.records)
+            batch.records.extend((key, r) for r in records)
+            if len(batch.records) >= self.max_records:
+                # the next request starts a new batch
+                self.batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self.flush_lock:
+                # records can still be added while the previous batch is
+                # being flushed
+                with self.lock:
+                    if self.batch is batch:
+                        self.batch = None
+                self._flush(batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return PartialStoreError.check(
+            batch.results[start:start + len(records)])
+
+    def _flush(self, batch):
+        try:
+            records = batch.records
+            results = [False] * len(records)
+            #: maps the id of each record to the index of its first copy
+            seen = {}
+            ids = []
+            bykey = defaultdict(list)
+            for i, (key, r) in enumerate(records):
+                id = self._difs_record_id(r)
+                ids.append(id)
+                if id not in seen:
+                    seen[id] = i
+                    bykey[key].append(i)
+            for key, indices in bykey.iteritems():
+                added = PartialStoreError.results_of(
+                    self.store._add_difs_records_many, key,
+                    [records[i][1] for i in indices])
+                for i, isnew in zip(indices, added):
+                    results[i] = isnew
+            for i, id in enumerate(ids):
+                # copies of a record the store failed to add fail with it
+                first = results[seen[id]]
+                if isinstance(first, Exception):
+                    results[i] = first
+            self.batches += 1
+            self.records += len(records)
+            self.merged += len(records) - len(seen)
+            batch.results = results
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def stats(self):
+        stats = self.store.stats()
+        stats[u'coalesce'] = dict(
+            batches=self.batches,
+            records=self.records,
+            merged=self.merged,
+            window_ms=self.window * 1000,
+            max_records=self.max_records,
+            )
+        return stats
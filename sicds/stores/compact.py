@@ -0,0 +1,170 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+import numpy
+from sicds.base import url_options
+from sicds.stores.tmp import TmpStore
+from threading import Lock
+
+class CompactStore(TmpStore):
+    '''
+    Stores records in memory like :class:`sicds.stores.tmp.TmpStore`, but
+    keeps only a fingerprint of each digest (its last ``fingerprint_bits``
+    bits, 64 or 128), in sorted numpy arrays, taking 8 or 16 bytes per
+    digest rather than the 80 to 100 a set of digest strings takes.
+
+    Digests are looked up in the arrays a batch at a time with
+    ``searchsorted``. New fingerprints go into an insert buffer, which is
+    merged into the arrays once it holds ``buffer_size`` entries or a 64th
+    as many as the arrays, whichever is more, so that merging costs about
+    the same per insert however big the store gets. A merge briefly needs
+    room for a second copy of the arrays.
+
+    With 128 bits, a fingerprint is the whole digest for digests of up to
+    16 bytes (e.g. ``hash=blake2b&digest_size=15``), and lookups are exact.
+    Otherwise a new digest is taken for a duplicate only if its fingerprint
+    matches one of the n in the store, which with 64 bits happens with a
+    chance of about n in 2**64.
+
+    Can be shared by the threads of a threaded server. Needs numpy.
+    '''
+    SUPPORTS_RETENTION = False
+    SUPPORTS_CAPACITY = False
+    SUPPORTS_PARTITION = False
+    THREADSAFE = True
+    # only fingerprints are kept, not the digests themselves
+    LISTS_DIGESTS = False
+
+    def __init__(self, url):
+        TmpStore.__init__(self, url)
+        options = url_options(url, fingerprint_bits=128, buffer_size=2**16)
+        if options['fingerprint_bits'] not in (64, 128):
+            raise ValueError('fingerprint_bits must be 64 or 128')
+        self.nbytes = options['fingerprint_bits'] // 8
+        self.buffer_size = options['buffer_size']
+        self.lock = Lock()
+        self.keylock = Lock()
+        self.merges = 0
+        self._reset()
+
+    def _reset(self):
+        #: sorted high 64 bits of each fingerprint, and if fingerprints are
+        #: 128 bits, the low 64 bits, sorted along with them
+        self.hi = numpy.empty(0, numpy.uint64)
+        self.lo = numpy.empty(0, numpy.uint64) if self.nbytes == 16 else None
+        self.buffer = set()
+
+    def _fingerprints(self, records):
+        n = self.nbytes
+        data = ''.join(r[-n:].rjust(n, '\0') for r in records)
+        words = numpy.frombuffer(data, '>u8').astype(numpy.uint64)
+        if n == 8:
+            return words, None
+        words = words.reshape(-1, 2)
+        return words[:, 0].copy(), words[:, 1].copy()
+
+    def _in_arrays(self, hi, lo):
+        '''
+        Returns a boolean array telling which of the given fingerprints are
+        in the sorted arrays.
+        '''
+        if not len(self.hi):
+            return numpy.zeros(len(hi), bool)
+        left = numpy.searchsorted(self.hi, hi, 'left')
+        right = numpy.searchsorted(self.hi, hi, 'right')
+        if lo is None:
+            return right > left
+        found = (right - left == 1) & \
+            (self.lo[numpy.minimum(left, len(self.lo) - 1)] == lo)
+        # fingerprints whose high bits are shared by several in the arrays
+        for i in numpy.flatnonzero(right - left > 1):
+            found[i] = lo[i] in self.lo[left[i]:right[i]]
+        return found
+
+    def _merge(self):
+        keys = sorted(self.buffer)
+        if self.lo is None:
+            hi = numpy.array(keys, numpy.uint64)
+            pos = numpy.searchsorted(self.hi, hi)
+            self.hi = numpy.insert(self.hi, pos, hi)
+        else:
+            hi = numpy.array([k[0] for k in keys], numpy.uint64)
+            lo = numpy.array([k[1] for k in keys], numpy.uint64)
+            left = numpy.searchsorted(self.hi, hi, 'left')
+            right = numpy.searchsorted(self.hi, hi, 'right')
+            pos = left
+            # among fingerprints sharing their high bits, keep the low ones
+            # sorted too
+            for i in numpy.flatnonzero(right > left):
+                pos[i] += numpy.searchsorted(self.lo[left[i]:right[i]], lo[i])
+            self.hi = numpy.insert(self.hi, pos, hi)
+            self.lo = numpy.insert(self.lo, pos, lo)
+        self.buffer.clear()
+        self.merges += 1
+
+    def _add_difs_records(self, records):
+        return all(self._add_difs_records_many(None, records))
+
+    def _add_difs_records_many(self, key, records):
+        if not records:
+            return []
+        hi, lo = self._fingerprints(records)
+        keys = hi.tolist() if lo is None else zip(hi.tolist(), lo.tolist())
+        added = []
+        with self.lock:
+            buffer = self.buffer
+            for k, found in zip(keys, self._in_arrays(hi, lo).tolist()):
+                if found or k in buffer:
+                    added.append(False)
+                else:
+                    buffer.add(k)
+                    added.append(True)
+            if len(buffer) >= max(self.buffer_size, len(self.hi) >> 6):
+                self._merge()
+        return added
+
+    def iterdigests(self, since=None):
+        raise NotImplementedError
+
+    def register_key(self, newkey):
+        with self.keylock:
+            return TmpStore.register_key(self, newkey)
+
+    def ensure_keys(self, keys):
+        with self.keylock:
+            self.keys.update(keys)
+            return iter(list(self.keys))
+
+    def clear(self):
+        with self.lock:
+            self._reset()
+
+    def stats(self):
+        stats = TmpStore.stats(self)
+        with self.lock:
+            stats.update(
+                entries=len(self.hi) + len(self.buffer),
+                buffered=len(self.buffer),
+                fingerprint_bits=self.nbytes * 8,
+                array_bytes=self.hi.nbytes +
+                    (0 if self.lo is None else self.lo.nbytes),
+                merges=self.merges,
+                )
+        return stats
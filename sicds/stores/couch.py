@@ -20,12 +20,48 @@
 
 from couchdb import Server
 from couchdb.design import ViewDefinition
-from itertools import imap
+from couchdb.http import PreconditionFailed, ResourceNotFound, Session
+from itertools import chain, imap
 from operator import attrgetter, itemgetter
 from base64 import urlsafe_b64encode
-from sicds.base import DocStore
+from sicds.base import DocStore, PartialStoreError, StoreError, url_options
+from sicds.stores.httppool import HTTPConnectionPool
+from simplejson import dumps, loads
+from threading import Lock
+from time import time
+from urllib import quote
 
 class CouchStore(DocStore):
+    '''
+    Stores dif records and log records in a CouchDB database, and keys in
+    another one with "_keys" appended to its name.
+
+    With ``retention_days``, dif records go instead in databases named
+    after the first with "_difs_<n>" appended, where <n> numbers the
+    stretch of time (a :attr:`RETENTION_BUCKETS` th of the window) during
+    which they were added. A digest is present if it is in any database
+    still within the window, and databases which have left the window
+    are deleted whole, so records are forgotten between one window and
+    one window plus a stretch after they were added.
+
+    With ``partition``, each client's dif records go instead in a database
+    of their own, named after the first with "_difs_<hash of the key>"
+    appended, which :meth:`purge_key` deletes. This cannot be combined with
+    ``retention_days``.
+
+    Dif and log records are added with raw ``_bulk_docs`` requests over a
+    pool of up to ``pool_size`` persistent connections (see
+    :class:`sicds.stores.httppool.HTTPConnectionPool`), bypassing
+    couchdb-python, which handles everything else. Requests time out after
+    ``timeout`` seconds, as does waiting for a free connection.
+    '''
+    SUPPORTS_RETENTION = True
+    SUPPORTS_PARTITION = True
+    PROCESS_SAFE = True
+    THREADSAFE = True
+    SHARED_BY_URL = True
+    RETENTION_BUCKETS = 8
+
     #: the id of the design doc specifying the view for log records
     LOG_DDOCID = u'log'
     LOG_VIEW_NAME = u'by_{0}'.format(DocStore.LOG_INDEX)
@@ -37,11 +73,41 @@ function (doc) {{
 '''.format(DocStore.LOG_INDEX)
 
     def __init__(self, url):
-        self.server = Server('http://{0}'.format(url.netloc))
+        self._init_store_options(url)
+        self.url = url
+        self.options = url_options(url, pool_size=10, timeout=30.0)
+        self._connect()
         self.dbid = url.path.split('/')[1]
         self.keydbid = self.dbid + '_keys'
+        #: the prefix of the names of retention bucket and partition
+        #: databases
+        self.difs_prefix = self.dbid + '_difs_'
+        if self.retention is not None:
+            if self.partition:
+                raise StoreError('CouchStore does not support partition '
+                    'with retention_days')
+            self.bucket_span = self.retention.total_seconds() / \
+                self.RETENTION_BUCKETS
+            self.bucket_lock = Lock()
         self._bootstrap()
 
+    def _connect(self):
+        url, options = self.url, self.options
+        self.server = Server('http://{0}'.format(url.netloc),
+            session=Session(timeout=options['timeout']))
+        self.pool = HTTPConnectionPool(url.hostname, url.port or 5984,
+            options['pool_size'], options['timeout'], url.username,
+            url.password)
+
+    def after_fork(self):
+        # connections opened by the parent process cannot be shared with it
+        self._connect()
+        self.db = self.server[self.dbid]
+        self.keydb = self.server[self.keydbid]
+        if self.retention is not None:
+            self.bucket = None
+            self.bucketdbs = []
+
     def _bootstrap(self):
         if self.dbid not in self.server:
             self.server.create(self.dbid)
@@ -52,14 +118,146 @@ function (doc) {{
         self.log_view = ViewDefinition(self.LOG_DDOCID,
             self.LOG_VIEW_NAME, self.LOG_VIEW_CODE)
         self.log_view.sync(self.db)
+        #: with a retention window, the number of the current stretch of
+        #: time, and the databases in the window, newest first
+        self.bucket = None
+        self.bucketdbs = []
+
+    def _bucketdbs(self):
+        '''
+        Returns the databases of dif records within the retention window,
+        newest first, after creating the current one and deleting those
+        which have left the window, if the current stretch of time has
+        changed since the last call.
+        '''
+        now = int(time() // self.bucket_span)
+        if now == self.bucket:
+            return self.bucketdbs
+        with self.bucket_lock:
+            if now == self.bucket:
+                return self.bucketdbs
+            oldest = now - self.RETENTION_BUCKETS
+            current = self.difs_prefix + str(now)
+            try:
+                self.server.create(current)
+            except PreconditionFailed:
+                pass # created by another process
+            live = []
+            for name in self.server:
+                if not name.startswith(self.difs_prefix):
+                    continue
+                n = name[len(self.difs_prefix):]
+                if not n.isdigit():
+                    continue
+                if int(n) < oldest:
+                    try:
+                        del self.server[name]
+                    except ResourceNotFound:
+                        pass # deleted by another process
+                else:
+                    live.append((int(n), name))
+            self.bucketdbs = [self.server[name] for (n, name) in
+                sorted(live, reverse=True)]
+            self.bucket = now
+            return self.bucketdbs
 
-    @staticmethod
-    def _hash(key, difs):
-        return urlsafe_b64encode(DocStore._hash(key, difs))
+    _encode_digest = staticmethod(urlsafe_b64encode)
+
+    def _bulk_docs(self, dbid, docs):
+        '''
+        Adds ``docs`` to the database ``dbid`` in a single request and
+        returns a list with one entry per doc which is true if it was added,
+        i.e. if no doc with the same id was there already. Docs which fail
+        otherwise raise :class:`sicds.base.PartialStoreError`.
+        '''
+        if not docs:
+            return []
+        status, body = self.pool.request('POST',
+            '/{0}/_bulk_docs'.format(quote(dbid, safe='')),
+            dumps({'docs': docs}), {'Content-Type': 'application/json'})
+        if status == 404:
+            raise ResourceNotFound(dbid)
+        if status not in (200, 201):
+            raise StoreError('_bulk_docs to {0} failed with {1}: {2}'
+                .format(dbid, status, body))
+        # results come back in the order given
+        added = []
+        for result in loads(body):
+            error = result.get('error')
+            if error is None:
+                added.append(True)
+            elif error == 'conflict':
+                added.append(False)
+            else:
+                added.append(StoreError('{0}: {1}'.format(error,
+                    result.get('reason'))))
+        return PartialStoreError.check(added)
 
     def _add_difs_records(self, records):
-        results = self.db.update(records)
-        return all(successful for (successful, id, rev_exc) in results)
+        if self.retention is not None:
+            return all(self._add_difs_records_bucketed(records))
+        return all(self._bulk_docs(self.dbid, records))
+
+    def _add_difs_records_many(self, key, records):
+        if self.retention is not None:
+            return self._add_difs_records_bucketed(records)
+        if self.partition:
+            return self._add_difs_records_partitioned(key, records)
+        return self._bulk_docs(self.dbid, records)
+
+    def _partition_dbid(self, key):
+        return self.dbid + '_' + self._partition_name(key)
+
+    def _add_difs_records_partitioned(self, key, records):
+        dbid = self._partition_dbid(key)
+        try:
+            return self._bulk_docs(dbid, records)
+        except ResourceNotFound:
+            try:
+                self.server.create(dbid)
+            except PreconditionFailed:
+                pass # created by another process
+            return self._bulk_docs(dbid, records)
+
+    def _add_difs_records_bucketed(self, records):
+        if not records:
+            return []
+        dbs = self._bucketdbs()
+        ids = [r[self.kID] for r in records]
+        present = set()
+        for db in dbs[1:]:
+            rows = db.view('_all_docs', keys=ids)
+            present.update(row.key for row in rows if 'id' in row)
+        added = [False] * len(records)
+        new = [i for (i, id) in enumerate(ids) if id not in present]
+        results = PartialStoreError.results_of(self._bulk_docs, dbs[0].name,
+            [records[i] for i in new])
+        for i, successful in zip(new, results):
+            added[i] = successful
+        return PartialStoreError.check(added)
+
+    def iterdigests(self, since=None):
+        if self.retention is not None:
+            return (row.id for db in self._bucketdbs()
+                for row in db.view('_all_docs'))
+        # log records share the database with dif records, so their ids
+        # come along too. this is harmless for callers which only need a
+        # superset of the digests, such as a bloom filter.
+        ids = (row.id for row in self.db.view('_all_docs')
+            if not row.id.startswith('_design/'))
+        if not self.partition:
+            return ids
+        return chain(ids, (row.id for name in list(self.server)
+            if name.startswith(self.difs_prefix)
+            for row in self.server[name].view('_all_docs')))
+
+    def purge_key(self, key):
+        if not self.partition:
+            raise NotImplementedError
+        try:
+            del self.server[self._partition_dbid(key)]
+        except ResourceNotFound:
+            pass # nothing added for the key yet
 
     def register_key(self, newkey):
         try:
@@ -73,15 +271,35 @@ function (doc) {{
             self.register_key(key)
         return imap(attrgetter('id'), self.keydb.view('_all_docs'))
 
+    def key_changes(self, since=None):
+        # the keys database's changes feed lists the keys registered since
+        # the sequence number it returned last time
+        changes = self.keydb.changes(since=since or 0)
+        keys = [row['id'] for row in changes['results']
+            if not row.get('deleted')]
+        return keys, changes['last_seq']
+
+    def stats(self):
+        stats = DocStore.stats(self)
+        stats.update(connections=self.pool.connects,
+            requests=self.pool.requests)
+        return stats
+
     def clear(self):
         if self.dbid in self.server:
             del self.server[self.dbid]
         if self.keydbid in self.server:
             del self.server[self.keydbid]
+        for name in list(self.server):
+            if name.startswith(self.difs_prefix):
+                del self.server[name]
         self._bootstrap()
 
     def _add_log_record(self, record):
-        self.db.save(record)
+        self.db.save(self._decode_bodies(record))
+
+    def _add_log_records(self, records):
+        self._bulk_docs(self.dbid, map(self._decode_bodies, records))
 
     def iterlog(self):
         return imap(attrgetter('doc'),
@@ -0,0 +1,259 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from atexit import register as atexit
+from fcntl import LOCK_EX, LOCK_NB, flock
+from mmap import mmap
+from os import fsync, remove, rename
+from os.path import exists, getsize
+from sicds.base import BaseStore, StoreError, url_options
+from sicds.loggers import FileLogger
+from sicds.stores.hashtable import DigestTable, TableFull
+from struct import calcsize, pack_into, unpack_from
+from threading import Lock
+
+class FileStore(BaseStore, FileLogger):
+    '''
+    Stores digests in a hash table in a memory-mapped file at the url's path,
+    keys in a file next to it with a ".keys" suffix, and log records in a
+    file with a ".log" suffix.
+
+    The table file starts with a header giving its dimensions, the number of
+    digests in it, and whether it was closed cleanly. If it was not, the
+    table is scanned on startup and rebuilt if any digest was only partly
+    written. When the table gets too full it is rehashed into a new file
+    twice the size, which then replaces the old one.
+
+    Writes reach the file through the operating system's page cache, so they
+    survive the process crashing; ``sync_every`` can be set to also flush
+    them to disk after that many new digests.
+
+    Options (in the url's query string): ``slots`` (initial number of slots,
+    a power of 2), ``sync_every``.
+    '''
+    #: header: magic, version, digest width, number of slots, number of
+    #: digests, dirty flag
+    HEADER = '>8sHHQQB'
+    MAGIC = 'SICDSHT1'
+    #: version 1 tables placed digests by their first bytes (see
+    #: :meth:`sicds.stores.hashtable.DigestTable._probe`), and are rebuilt
+    #: on startup
+    VERSION = 2
+    HEADER_SIZE = 64
+    COUNT_OFFSET = calcsize('>8sHHQ')
+    DIRTY_OFFSET = calcsize('>8sHHQQ')
+    #: the table is grown when more than this fraction of its slots are used
+    MAX_LOAD = 0.5
+    THREADSAFE = True
+
+    def __init__(self, url):
+        options = url_options(url, slots=2**16, sync_every=0)
+        self.path = url.path
+        self.initial_slots = options['slots']
+        self.sync_every = options['sync_every']
+        self._init_store_options(url)
+        self.width = self.hasher.size
+        if self.migrate_from is not None and \
+                self.migrate_from.size != self.hasher.size:
+            raise StoreError('Digests of different sizes cannot be migrated '
+                'in a fixed-width table')
+        self.lock = Lock()
+        self.file = open(self.path + '.log', 'a')
+        self.filelock = Lock()
+        self.keypath = self.path + '.keys'
+        self.keys = set(self._readkeys())
+        self.mm = None
+        self._open()
+        atexit(self.close)
+
+    def _readkeys(self):
+        try:
+            f = open(self.keypath)
+        except IOError:
+            return []
+        try:
+            return [line[:-1].decode('utf-8') for line in f
+                if line.endswith('\n')]
+        finally:
+            f.close()
+
+    def _create(self, path, nslots):
+        f = open(path, 'wb')
+        try:
+            f.truncate(self.HEADER_SIZE + DigestTable.size(nslots, self.width))
+            header = bytearray(self.HEADER_SIZE)
+            pack_into(self.HEADER, header, 0, self.MAGIC, self.VERSION,
+                self.width, nslots, 0, 0)
+            f.write(header)
+            f.flush()
+            fsync(f.fileno())
+        finally:
+            f.close()
+
+    def _map(self, path):
+        '''
+        Maps the table file at ``path`` and returns the file, the map, and
+        the table in it.
+        '''
+        f = open(path, 'r+b')
+        try:
+            flock(f.fileno(), LOCK_EX | LOCK_NB)
+        except IOError:
+            f.close()
+            raise StoreError('{0} is in use by another process'.format(path))
+        mm = mmap(f.fileno(), getsize(path))
+        magic, version, width, nslots, count, dirty = \
+            unpack_from(self.HEADER, mm)
+        if magic != self.MAGIC or version not in (1, self.VERSION):
+            raise StoreError('{0} is not a digest table'.format(path))
+        if width != self.width:
+            raise StoreError('{0} holds {1} byte digests, expected {2}'.format(
+                path, width, self.width))
+        return f, mm, DigestTable(mm, self.HEADER_SIZE, nslots, width)
+
+    def _open(self):
+        growpath = self.path + '.grow'
+        if exists(growpath):
+            # left behind by a crash while growing; the old table is intact
+            remove(growpath)
+        if not exists(self.path):
+            self._create(self.path, self.initial_slots)
+        self.tablefile, self.mm, self.table = self._map(self.path)
+        if unpack_from('>8sH', self.mm)[1] != self.VERSION:
+            self._rebuild(self.table.nslots)
+            return
+        if self.mm[self.DIRTY_OFFSET] != '\0':
+            count, torn = self.table.scan()
+            if torn:
+                self._rebuild(self.table.nslots)
+                return
+            self._setcount(count)
+        else:
+            self.count = unpack_from('>Q', self.mm, self.COUNT_OFFSET)[0]
+        self._setdirty(True)
+
+    def _setcount(self, count):
+        self.count = count
+        pack_into('>Q', self.mm, self.COUNT_OFFSET, count)
+
+    def _setdirty(self, dirty):
+        self.mm[self.DIRTY_OFFSET] = '\1' if dirty else '\0'
+        self.mm.flush()
+
+    def _rebuild(self, nslots):
+        '''
+        Rehashes all the digests in the table into a new file with
+        ``nslots`` slots, which then replaces the current one.
+        '''
+        growpath = self.path + '.grow'
+        self._create(growpath, nslots)
+        f, mm, table = self._map(growpath)
+        count = 0
+        for digest in self.table:
+            count += table.add(digest)
+        pack_into('>Q', mm, self.COUNT_OFFSET, count)
+        mm.flush()
+        mm.close()
+        f.close()
+        self._unmap()
+        rename(growpath, self.path)
+        self._open()
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.tablefile.close()
+            self.mm = None
+
+    def _add(self, digest):
+        if (self.count + 1) > self.table.nslots * self.MAX_LOAD:
+            self._rebuild(self.table.nslots * 2)
+        try:
+            added = self.table.add(digest)
+        except TableFull:
+            self._rebuild(self.table.nslots * 2)
+            added = self.table.add(digest)
+        if added:
+            self._setcount(self.count + 1)
+            if self.sync_every and not self.count % self.sync_every:
+                self.mm.flush()
+        return added
+
+    @staticmethod
+    def _new_difs_record(id):
+        return id
+
+    def _add_difs_records_many(self, key, records):
+        with self.lock:
+            return map(self._add, records)
+
+    def iterdigests(self, since=None):
+        with self.lock:
+            return iter(list(self.table))
+
+    def register_key(self, newkey):
+        with self.lock:
+            if newkey in self.keys:
+                return False
+            f = open(self.keypath, 'a')
+            try:
+                f.write(newkey.encode('utf-8') + '\n')
+                f.flush()
+                fsync(f.fileno())
+            finally:
+                f.close()
+            self.keys.add(newkey)
+            return True
+
+    def ensure_keys(self, keys):
+        for key in keys:
+            self.register_key(key)
+        return iter(list(self.keys))
+
+    def clear(self):
+        with self.lock:
+            self._unmap()
+            for path in (self.path, self.keypath):
+                if exists(path):
+                    remove(path)
+            with self.filelock:
+                self.file.truncate(0)
+            self.keys.clear()
+            self._open()
+
+    def close(self):
+        '''
+        Flushes the table to disk and marks it as cleanly closed.
+        '''
+        with self.lock:
+            if self.mm is not None:
+                self._setdirty(False)
+                self._unmap()
+
+    def stats(self):
+        stats = BaseStore.stats(self)
+        nslots = self.table.nslots
+        stats.update(
+            entries=self.count,
+            slots=nslots,
+            load_factor=float(self.count) / nslots,
+            bytes=self.HEADER_SIZE + DigestTable.size(nslots, self.width),
+            )
+        return stats
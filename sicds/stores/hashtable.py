@@ -0,0 +1,161 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from struct import unpack_from
+from zlib import crc32
+
+class TableFull(Exception): pass
+
+class DigestTable(object):
+    '''
+    An open-addressing hash table of fixed-width digests laid out in a
+    writable buffer, such as an mmap, starting at ``offset``. Digests are
+    assumed to be uniformly distributed (they are the output of a
+    cryptographic hash), so their last 8 bytes are used as the hash (the
+    first one may be a version tag, the same for every digest; see
+    :mod:`sicds.digest`).
+
+    Each slot is a tag byte followed by a digest. An empty slot is all zero
+    bytes. When a digest is added, its bytes are written before its tag,
+    and the tag is derived from the digest, so a slot whose digest was only
+    partly written can be told apart from a complete one (see :meth:`scan`).
+
+        >>> buf = bytearray(DigestTable.size(8, 8))
+        >>> table = DigestTable(buf, 0, 8, 8)
+        >>> table.add('abcdefgh'), table.add('abcdefgh'), table.add('ijklmnop')
+        (True, False, True)
+        >>> 'abcdefgh' in table, 'qrstuvwx' in table
+        (True, False)
+        >>> sorted(table)
+        ['abcdefgh', 'ijklmnop']
+        >>> table.scan()
+        (2, 0)
+
+    So tagged digests are spread over the stores' tables as evenly as
+    untagged ones::
+
+        >>> from sicds.app import Dif
+        >>> from sicds.config import store_from_url
+        >>> from tempfile import mkdtemp
+        >>> for url in ('shm:?slots=4096&stripes=1&hash=sha1',
+        ...         'file://' + mkdtemp() + '/difs?slots=4096&hash=sha1'):
+        ...     store = store_from_url(url)
+        ...     digests = [store._hash(u'key', [Dif(type=u't',
+        ...         value=unicode(i))]) for i in range(1500)]
+        ...     added = store._add_difs_records_many(u'key', digests)
+        ...     table = getattr(store, 'table', None) or store.tables[0]
+        ...     starts = set(next(table._probe(d)) for d in digests)
+        ...     print sum(added), len(starts) > 1000
+        1500 True
+        1500 True
+
+    '''
+    def __init__(self, buf, offset, nslots, width):
+        assert nslots & (nslots - 1) == 0, 'nslots must be a power of 2'
+        assert width >= 8, 'digests must be at least 8 bytes wide'
+        self.buf = buf
+        self.offset = offset
+        self.nslots = nslots
+        self.width = width
+        self.slotsize = width + 1
+
+    @staticmethod
+    def size(nslots, width):
+        '''
+        Returns the number of bytes a table with the given dimensions needs.
+        '''
+        return nslots * (width + 1)
+
+    @staticmethod
+    def _tag(digest):
+        return chr(0x80 | (crc32(digest) & 0x7f))
+
+    def _probe(self, digest):
+        '''
+        Yields the offset of each slot ``digest`` could occupy, in order.
+        '''
+        mask = self.nslots - 1
+        start = unpack_from('<Q', digest, len(digest) - 8)[0] & mask
+        for i in xrange(self.nslots):
+            yield self.offset + ((start + i) & mask) * self.slotsize
+
+    def _find(self, digest):
+        '''
+        Returns the offset of the slot holding ``digest`` and true, or the
+        offset of the empty slot it would go in and false.
+        '''
+        buf = self.buf
+        width = self.width
+        empty = '\0'
+        for slot in self._probe(digest):
+            tag = buf[slot:slot+1]
+            if tag == empty:
+                return slot, False
+            if buf[slot+1:slot+1+width] == digest:
+                return slot, True
+        raise TableFull
+
+    def __contains__(self, digest):
+        try:
+            return self._find(digest)[1]
+        except TableFull:
+            return False
+
+    def add(self, digest):
+        '''
+        Adds ``digest`` if it is not already present. Returns true if it
+        was added.
+
+        :raises: :exc:`TableFull` if there is no room for it
+        '''
+        if len(digest) != self.width:
+            raise ValueError('expected digest of {0} bytes'.format(self.width))
+        slot, present = self._find(digest)
+        if present:
+            return False
+        self.buf[slot+1:slot+1+self.width] = digest
+        self.buf[slot:slot+1] = self._tag(digest)
+        return True
+
+    def _slots(self):
+        buf = self.buf
+        width = self.width
+        end = self.offset + self.nslots * self.slotsize
+        for slot in xrange(self.offset, end, self.slotsize):
+            tag = buf[slot:slot+1]
+            if tag != '\0':
+                yield tag, str(buf[slot+1:slot+1+width])
+
+    def __iter__(self):
+        tag = self._tag
+        return (digest for (t, digest) in self._slots() if t == tag(digest))
+
+    def scan(self):
+        '''
+        Returns the number of complete and the number of partly written slots.
+        '''
+        ok = torn = 0
+        tag = self._tag
+        for t, digest in self._slots():
+            if t == tag(digest):
+                ok += 1
+            else:
+                torn += 1
+        return ok, torn
@@ -0,0 +1,126 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from base64 import b64encode
+from errno import ECONNRESET, EPIPE
+from httplib import BadStatusLine, HTTPConnection
+from Queue import Empty, LifoQueue
+from sicds.base import StoreError
+from socket import error as SocketError
+
+class PoolTimeout(StoreError): pass
+
+def _closed_by_server(e):
+    return isinstance(e, BadStatusLine) or \
+        getattr(e, 'errno', None) in (ECONNRESET, EPIPE)
+
+class HTTPConnectionPool(object):
+    '''
+    A bounded pool of persistent (keep-alive) HTTP connections to one
+    server, which can be shared by the threads of a threaded server. Each
+    request takes a connection from the pool, waiting up to ``timeout``
+    seconds for one if all ``size`` of them are in use, and puts it back
+    afterwards for the next request to reuse. Connections are opened when
+    first needed, most recently used first, so that idle ones are left to
+    time out on the server rather than being used at the risk of finding
+    them closed.
+
+    A request which finds a reused connection closed by the server (which
+    does so to connections left idle for long) is retried once on a new
+    connection. Other failures, e.g. timeouts, are not retried, since the
+    server may have acted on the request.
+    '''
+    def __init__(self, host, port, size=10, timeout=30.0, username=None,
+            password=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.headers = {'Connection': 'keep-alive'}
+        if username is not None:
+            self.headers['Authorization'] = 'Basic ' + b64encode(
+                '{0}:{1}'.format(username, password or ''))
+        self.pool = LifoQueue(size)
+        for i in xrange(size):
+            self.pool.put(None) # a connection yet to be opened
+        #: (approximate) number of connections opened and requests made
+        self.connects = self.requests = 0
+
+    def _connect(self):
+        self.connects += 1
+        return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers={}):
+        '''
+        Makes a request and returns the status and body of the response.
+        '''
+        try:
+            conn = self.pool.get(True, self.timeout)
+        except Empty:
+            raise PoolTimeout('No free connection to {0}:{1} after {2}s'
+                .format(self.host, self.port, self.timeout))
+        try:
+            headers = dict(self.headers, **headers)
+            reused = conn is not None
+            if not reused:
+                conn = self._connect()
+            try:
+                status, data, will_close = self._request(conn, method, path,
+                    body, headers)
+            except (BadStatusLine, SocketError) as e:
+                if not reused or not _closed_by_server(e):
+                    raise
+                conn.close()
+                conn = self._connect()
+                status, data, will_close = self._request(conn, method, path,
+                    body, headers)
+            if will_close:
+                conn.close()
+                conn = None
+            return status, data
+        except:
+            # whatever state it was left in, the connection is not reused
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def _request(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        self.requests += 1
+        return resp.status, data, resp.will_close
+
+    def close(self):
+        '''
+        Closes the connections which are not in use.
+        '''
+        conns = []
+        while True:
+            try:
+                conns.append(self.pool.get_nowait())
+            except Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self.pool.put(None)
@@ -0,0 +1,326 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from atexit import register as atexit
+from binascii import crc32
+from collections import defaultdict
+from glob import glob
+from itertools import chain
+from os import O_APPEND, O_CREAT, O_WRONLY, close, fsync, open as osopen, \
+    remove, write
+from sicds.base import StoreError, StoreWrapper, url_options
+from struct import Struct
+from sys import stderr
+from threading import Event, Lock, Thread
+
+#: journal frame header: crc32 of the rest, length of key, length of digest
+_HEADER = Struct('>III')
+#: key length in the header of a frame for the ``None`` key, which is not
+#: the same as ``u''`` to partitioned stores
+_NO_KEY = 0xffffffff
+
+def _frame(key, id):
+    '''
+    Returns the journal frame for ``id`` added under ``key``::
+
+        >>> from tempfile import NamedTemporaryFile
+        >>> f = NamedTemporaryFile()
+        >>> f.write(_frame(None, 'a') + _frame(u'', 'b') + _frame(u'k', 'c'))
+        >>> f.flush()
+        >>> list(_read_frames(f.name))
+        [(None, 'a'), (u'', 'b'), (u'k', 'c')]
+    '''
+    if key is None:
+        keylen = _NO_KEY
+        body = id
+    else:
+        key = key.encode('utf-8')
+        keylen = len(key)
+        body = key + id
+    return _HEADER.pack(crc32(body) & 0xffffffff, keylen, len(id)) + body
+
+def _read_frames(path):
+    '''
+    Yields the (key, digest) pairs journaled in the file at ``path``, up to
+    the first frame which was only partly written.
+    '''
+    f = open(path, 'rb')
+    try:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            crc, keylen, idlen = _HEADER.unpack(header)
+            nokey = keylen == _NO_KEY
+            if nokey:
+                keylen = 0
+            body = f.read(keylen + idlen)
+            if len(body) < keylen + idlen or crc32(body) & 0xffffffff != crc:
+                return
+            key = None if nokey else body[:keylen].decode('utf-8')
+            yield key, body[keylen:]
+    finally:
+        f.close()
+
+class JournalStore(StoreWrapper):
+    '''
+    Answers from an index in memory of every digest in the wrapped store,
+    so that requests do not wait on the store. New digests are appended to
+    a journal file at the path given by the ``journal`` option, and a
+    request is answered once they have been synced to disk, so none are
+    lost if the process crashes. Requests which come in while another one
+    is syncing are synced together with a single fsync once it is done.
+
+    A background thread adds the journaled digests to the store every
+    ``journal_flush_interval`` seconds, in one call per key, and then
+    deletes the journal files they were in. Each flush starts a new file.
+    On startup the index is loaded from the store and any digests left in
+    journal files are replayed, and on exit those not yet in the store are
+    flushed::
+
+        >>> from sicds.config import store_from_url
+        >>> from tempfile import mkdtemp
+        >>> url = 'journal+tmp:?journal_flush_interval=3600&journal=' + \\
+        ...     mkdtemp() + '/journal'
+        >>> store = store_from_url(url)
+        >>> store._add_difs_records_many(u'key', ['a', 'b'])
+        [True, True]
+        >>> store.store._add_difs_records_many(u'key', ['a'])
+        [True]
+        >>> crashed = store_from_url(url)
+        >>> crashed._add_difs_records_many(u'key', ['a', 'b', 'c'])
+        [False, False, True]
+        >>> crashed.close()
+        >>> sorted(crashed.store.iterdigests())
+        ['a', 'b', 'c']
+
+    The index must see every digest that goes into the store, so this should
+    only be used while this process is the store's only writer.
+    '''
+    PROCESS_SAFE = False
+
+    def __init__(self, url, store):
+        StoreWrapper.__init__(self, url, store)
+        if self.retention is not None:
+            # the index cannot tell when a digest expires from the store
+            raise StoreError('journal cannot wrap a store with retention_days')
+        # wrappers share the url's options with the store they wrap
+        options = url_options(url, journal='', journal_flush_interval=1.0,
+            max_entries=0, max_bytes=0)
+        if options['max_entries'] or options['max_bytes']:
+            # nor when the store evicts it
+            raise StoreError('journal cannot wrap a store with max_entries '
+                'or max_bytes')
+        if not options['journal']:
+            raise StoreError('journal needs the path of its journal file')
+        self.path = options['journal']
+        self.flush_interval = options['journal_flush_interval']
+        #: guards the index, pending records and the current journal file
+        self.lock = Lock()
+        #: held while syncing the journal, so that one sync serves everyone
+        #: waiting on it
+        self.sync_lock = Lock()
+        #: held for the whole of a flush, so that flushes add records to the
+        #: store one at a time and each deletes only journal files whose
+        #: records are in the store
+        self.flush_lock = Lock()
+        #: number of writes to the journal, and of those synced
+        self.written = self.synced = 0
+        self.syncs = self.flushes = self.flush_failures = 0
+        self.fd = None
+        self._load()
+        self._stop = Event()
+        self._flusher = Thread(target=self._flush_forever, name='JournalStore')
+        self._flusher.daemon = True
+        self._flusher.start()
+        atexit(self.close)
+
+    def _segments(self):
+        '''
+        Returns the numbers of the journal files on disk, oldest first.
+        '''
+        prefix = self.path + '.'
+        return sorted(int(p[len(prefix):]) for p in glob(prefix + '*')
+            if p[len(prefix):].isdigit())
+
+    def _segment_path(self, n):
+        return '{0}.{1}'.format(self.path, n)
+
+    def _open_segment(self, n):
+        if self.fd is not None:
+            close(self.fd)
+        self.segment = n
+        self.fd = osopen(self._segment_path(n), O_WRONLY | O_CREAT | O_APPEND,
+            0644)
+
+    def _load(self):
+        self.index = set(str(id) for id in self.store.iterdigests())
+        #: (key, record) pairs journaled but not yet added to the store
+        self.pending = []
+        segments = self._segments()
+        for n in segments:
+            for key, id in _read_frames(self._segment_path(n)):
+                self.index.add(id)
+                self.pending.append((key,
+                    self.store._new_difs_record(self._decode_digest(id))))
+        self._open_segment(segments[-1] + 1 if segments else 0)
+
+    def _add_difs_records(self, records):
+        return all(self._add_difs_records_many(None, records))
+
+    def _add_difs_records_nowait(self, key, records):
+        self._add_difs_records_many(key, records)
+
+    def _add_difs_records_many(self, key, records):
+        added = []
+        frames = []
+        with self.lock:
+            for r in records:
+                id = str(self._difs_record_id(r))
+                if id in self.index:
+                    added.append(False)
+                    continue
+                self.index.add(id)
+                added.append(True)
+                frames.append(_frame(key, id))
+                self.pending.append((key, r))
+            if frames:
+                data = ''.join(frames)
+                while data:
+                    data = data[write(self.fd, data):]
+                self.written += 1
+            # even with nothing new to journal, the digests found in the
+            # index may still be waiting to be synced
+            seq = self.written
+        self._sync(seq)
+        return added
+
+    def _sync(self, seq):
+        '''
+        Returns once the ``seq`` th write to the journal has been synced.
+        '''
+        if self.synced >= seq:
+            return
+        with self.sync_lock:
+            if self.synced >= seq:
+                return # synced by whoever held the lock
+            with self.lock:
+                target = self.written
+                fd = self.fd
+            fsync(fd)
+            self.synced = target
+            self.syncs += 1
+
+    def flush(self):
+        '''
+        Adds the journaled records to the store and deletes the journal
+        files they were in.
+        '''
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.sync_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, []
+                fsync(self.fd)
+                self.synced = self.written
+                flushed = self.segment
+                self._open_segment(flushed + 1)
+        bykey = defaultdict(list)
+        for key, r in pending:
+            bykey[key].append(r)
+        try:
+            for key, records in bykey.iteritems():
+                self.store._add_difs_records_many(key, records)
+        except:
+            # try again next time, the journal files are kept until then
+            with self.lock:
+                self.pending[:0] = pending
+            self.flush_failures += 1
+            raise
+        self.flushes += 1
+        for n in self._segments():
+            if n <= flushed:
+                remove(self._segment_path(n))
+
+    def _flush_forever(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                stderr.write('Failed to flush journal: {0}\n'.format(repr(e)))
+
+    def close(self):
+        '''
+        Stops the background thread, flushes what is left, and closes the
+        journal, which is deleted if everything made it to the store.
+        '''
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        with self.lock:
+            close(self.fd)
+            self.fd = None
+            if not self.pending:
+                remove(self._segment_path(self.segment))
+
+    def iterdigests(self, since=None):
+        with self.lock:
+            pending = [self._difs_record_id(r) for (key, r) in self.pending]
+        return chain(self.store.iterdigests(since), pending)
+
+    def purge_key(self, key):
+        # the index does not know which digests are the key's, so it is
+        # loaded from the store again
+        with self.flush_lock:
+            self._flush()
+            self.store.purge_key(key)
+            with self.lock:
+                self.index = set(str(id) for id in self.store.iterdigests())
+                # including what came in since the flush
+                self.index.update(str(self._difs_record_id(r))
+                    for (k, r) in self.pending)
+
+    def clear(self):
+        with self.flush_lock:
+            with self.sync_lock:
+                with self.lock:
+                    self.store.clear()
+                    self.index.clear()
+                    self.pending = []
+                    for n in self._segments():
+                        remove(self._segment_path(n))
+                    self._open_segment(0)
+
+    def stats(self):
+        stats = self.store.stats()
+        stats[u'journal'] = dict(
+            entries=len(self.index),
+            pending=len(self.pending),
+            syncs=self.syncs,
+            flushes=self.flushes,
+            flush_failures=self.flush_failures,
+            )
+        return stats
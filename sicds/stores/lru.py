@@ -0,0 +1,178 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from collections import OrderedDict
+from sicds.base import PartialStoreError, StoreError, StoreWrapper, \
+    url_options
+from sys import getsizeof
+from threading import Lock
+
+class LRUStore(StoreWrapper):
+    '''
+    Keeps a bounded cache of the digests most recently confirmed to be in the
+    wrapped store, so that digests submitted again soon afterwards are known
+    to be duplicate without asking the store. When the cache grows past
+    ``lru_bytes`` (an estimate of the memory it uses), the least recently
+    used digests are evicted.
+
+        >>> from sicds.config import store_from_url
+        >>> store = store_from_url('lru+tmp:?lru_bytes=1000000')
+        >>> store._add_difs_records_many(u'key', ['a', 'b'])
+        [True, True]
+        >>> store._add_difs_records_many(u'key', ['a', 'c'])
+        [False, True]
+        >>> sorted(store.stats()[u'lru'].items())
+        [('bytes', ...), ('entries', 3), ('evictions', 0), ('hits', 1), ('max_bytes', 1000000), ('misses', 3)]
+
+    Digests are cached for as long as they are in the store, so the store
+    cannot be one which forgets them::
+
+        >>> from urlparse import urlsplit
+        >>> LRUStore(urlsplit('lru:?max_entries=1000'),
+        ...     store_from_url('tmp:?max_entries=1000'))
+        Traceback (most recent call last):
+        ...
+        StoreError: lru cannot wrap a store with max_entries or max_bytes
+
+    Nor are digests which the store failed to add::
+
+        >>> from sicds.base import PartialStoreError
+        >>> store = store_from_url('lru+tmp:')
+        >>> def failing_add(key, records):
+        ...     return PartialStoreError.check([StoreError('x')] * len(records))
+        >>> store.store._add_difs_records_many = failing_add
+        >>> store._add_difs_records_many(u'key', ['a'])
+        Traceback (most recent call last):
+        ...
+        PartialStoreError: [StoreError('x',)]
+        >>> store.stats()[u'lru']['entries']
+        0
+
+    With ``partition``, purging a key empties the cache, since it does not
+    know which digests are the key's. Only this process's cache can be
+    emptied, so such a store cannot be shared by worker processes::
+
+        >>> store = store_from_url('lru+tmp:?partition=1')
+        >>> store._add_difs_records_many(u'key', ['a'])
+        [True]
+        >>> store._add_difs_records_many(u'key', ['a'])
+        [False]
+        >>> store.purge_key(u'key')
+        >>> store._add_difs_records_many(u'key', ['a'])
+        [True]
+        >>> [store.stats()[u'lru'][k] for k in ('entries', 'hits', 'misses')]
+        [1, 1, 2]
+        >>> store = store_from_url('lru+sqlite://:memory:?partition=1')
+        >>> store.store.PROCESS_SAFE, store.PROCESS_SAFE
+        (True, False)
+
+    '''
+    #: estimated memory used by each cache entry besides its digest
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, url, store):
+        StoreWrapper.__init__(self, url, store)
+        # wrappers share the url's options with the store they wrap
+        options = url_options(url, lru_bytes=64 * 2**20, max_entries=0,
+            max_bytes=0)
+        if self.retention is not None:
+            # the cache cannot tell when a digest expires from the store
+            raise StoreError('lru cannot wrap a store with retention_days')
+        if options['max_entries'] or options['max_bytes']:
+            # nor when the store evicts it
+            raise StoreError('lru cannot wrap a store with max_entries or '
+                'max_bytes')
+        self.max_bytes = options['lru_bytes']
+        self.lock = Lock()
+        self._empty()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def PROCESS_SAFE(self):
+        # a purge empties only this process's cache, and the others would
+        # keep answering duplicate for the purged digests
+        return self.store.PROCESS_SAFE and not self.partition
+
+    def _empty(self):
+        self.cache = OrderedDict()
+        self.nbytes = 0
+
+    def _touch(self, id):
+        '''
+        Returns true and marks ``id`` most recently used if it is cached.
+        '''
+        try:
+            size = self.cache.pop(id)
+        except KeyError:
+            self.misses += 1
+            return False
+        self.cache[id] = size
+        self.hits += 1
+        return True
+
+    def _insert(self, id):
+        if id in self.cache:
+            return
+        size = getsizeof(id) + self.ENTRY_OVERHEAD
+        self.cache[id] = size
+        self.nbytes += size
+        while self.nbytes > self.max_bytes and self.cache:
+            _, evicted = self.cache.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def _add_difs_records_many(self, key, records):
+        ids = map(self._difs_record_id, records)
+        with self.lock:
+            cached = map(self._touch, ids)
+        misses = [r for (r, hit) in zip(records, cached) if not hit]
+        added = iter(PartialStoreError.results_of(
+            self.store._add_difs_records_many, key, misses))
+        results = [not hit and added.next() for hit in cached]
+        with self.lock:
+            for id, hit, result in zip(ids, cached, results):
+                # records the store failed to add are not cached
+                if not hit and not isinstance(result, Exception):
+                    self._insert(id)
+        return PartialStoreError.check(results)
+
+    def purge_key(self, key):
+        self.store.purge_key(key)
+        # the cache does not know which digests are the key's
+        with self.lock:
+            self._empty()
+
+    def clear(self):
+        self.store.clear()
+        with self.lock:
+            self._empty()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        stats = self.store.stats()
+        stats[u'lru'] = dict(
+            entries=len(self.cache),
+            bytes=self.nbytes,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            )
+        return stats
@@ -18,13 +18,37 @@
 # Boston, MA  02110-1301
 # USA
 
+from bson.binary import Binary
+from datetime import timedelta
 from itertools import imap
 from operator import itemgetter
 from pymongo import Connection
-from pymongo.binary import Binary
-from sicds.base import DocStore
+from pymongo.errors import BulkWriteError, OperationFailure
+from sicds.base import DocStore, PartialStoreError, StoreError, utcnow
 
 class MongoStore(DocStore):
+    '''
+    Stores dif records, keys and log records in collections of a MongoDB
+    database.
+
+    Dif records are stamped with the time they were added as a BSON date,
+    so that with ``retention_days`` a TTL index on it has MongoDB delete
+    them once expired. Until MongoDB gets around to deleting an expired
+    record (it checks once a minute), a digest added again renews it.
+    Records added as strings by earlier versions never expire.
+
+    With ``partition``, each client's dif records go in a collection of
+    their own, which :meth:`purge_key` drops.
+    '''
+    SUPPORTS_RETENTION = True
+    SUPPORTS_PARTITION = True
+    PROCESS_SAFE = True
+    THREADSAFE = True
+    SHARED_BY_URL = True
+
+    #: error code mongodb reports for an insert of an already present _id
+    DUPLICATE_KEY = 11000
+
     #: the name of the collection that stores log entries
     cLOG = u'logentries'
     #: the name of the collection that stores api keys documents
@@ -32,23 +56,69 @@ class MongoStore(DocStore):
     #: the name of the collection that stores the dif documents
     cDIFS = u'difs'
 
+    #: how far before the previous call to :meth:`key_changes` to look for
+    #: keys, to allow for registrations which took that long to reach the
+    #: server or were stamped by a clock running behind
+    KEY_CHANGES_SLACK = timedelta(minutes=1)
+
     def __init__(self, url):
-        host = url.hostname
-        port = url.port
-        self.conn = Connection(host=host, port=port)
+        self.host = url.hostname
+        self.port = url.port
+        self._init_store_options(url)
         self.dbid = url.path.split('/')[1]
+        self._connect()
+
+    def _connect(self):
+        self.conn = Connection(host=self.host, port=self.port)
         self.db = self.conn[self.dbid]
         self._bootstrap()
 
+    def after_fork(self):
+        # pymongo's sockets cannot be shared with the parent process
+        self._connect()
+
     def _bootstrap(self):
         self.logc = self.db[self.cLOG]
         self.logc.ensure_index(self.LOG_INDEX)
         self.keyc = self.db[self.cKEYS]
+        self.keyc.ensure_index(self.kTIMEADDED)
         self.difc = self.db[self.cDIFS]
+        if self.retention is not None:
+            self._ensure_ttl_index(self.difc)
+
+    def _ensure_ttl_index(self, difc):
+        seconds = int(self.retention.total_seconds())
+        try:
+            # cached by pymongo, so this only goes to the server once in a
+            # while for each collection
+            difc.ensure_index(self.kTIMEADDED, expireAfterSeconds=seconds)
+        except OperationFailure:
+            # the index exists with another expiry, change it in place
+            self.db.command('collMod', difc.name, index={
+                'keyPattern': {self.kTIMEADDED: 1},
+                'expireAfterSeconds': seconds,
+                })
+
+    def _difc(self, key):
+        '''
+        Returns the collection holding the dif records of the given key.
+        '''
+        if not self.partition:
+            return self.difc
+        difc = self.db[self._partition_name(key)]
+        if self.retention is not None:
+            self._ensure_ttl_index(difc)
+        return difc
+
+    def _difcs(self):
+        return [self.difc] + [self.db[name] for name in
+            self.db.collection_names() if name.startswith(self.cDIFS + '_')]
 
-    @staticmethod
-    def _hash(key, difs):
-        return Binary(DocStore._hash(key, difs))
+    @classmethod
+    def _new_difs_record(cls, id):
+        return {cls.kID: id, cls.kTIMEADDED: utcnow()}
+
+    _encode_digest = _decode_digest = staticmethod(Binary)
 
     def _add_difs_records(self, records):
         # mongodb does not yet support bulk insert of docs with potentially
@@ -61,9 +131,73 @@ class MongoStore(DocStore):
                 uniq = False
         return uniq
 
+    def _add_difs_records_many(self, key, records):
+        if not records:
+            return []
+        difc = self._difc(key)
+        bulk = difc.initialize_unordered_bulk_op()
+        for r in records:
+            bulk.insert(r)
+        added = [True] * len(records)
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] == self.DUPLICATE_KEY:
+                    added[error['index']] = False
+                else:
+                    # the bulk insert is unordered, so only this one failed
+                    added[error['index']] = StoreError(error.get('errmsg'))
+            if self.retention is not None:
+                self._renew_expired(difc, records, added)
+        return PartialStoreError.check(added)
+
+    def _renew_expired(self, difc, records, added):
+        '''
+        Renews those of the dif records which were already present (i.e.
+        not ``added``, which failed ones are not either) but have expired,
+        and marks them added.
+        '''
+        cutoff = self._cutoff()
+        present = dict((r[self.kID], i) for (i, r) in enumerate(records)
+            if not added[i])
+        expired = difc.find({self.kID: {'$in': present.keys()},
+            self.kTIMEADDED: {'$lt': cutoff}}, [self.kID])
+        for doc in expired:
+            i = present[doc[self.kID]]
+            # only one of several requests renewing it at once gets to
+            result = difc.update({self.kID: doc[self.kID],
+                self.kTIMEADDED: {'$lt': cutoff}},
+                {'$set': {self.kTIMEADDED: records[i][self.kTIMEADDED]}},
+                safe=True)
+            added[i] = result['n'] == 1
+
+    def _add_difs_records_nowait(self, key, records):
+        if not records:
+            return
+        bulk = self._difc(key).initialize_unordered_bulk_op()
+        for r in records:
+            bulk.insert(r)
+        bulk.execute({'w': 0})
+
+    def iterdigests(self, since=None):
+        if self.retention is not None:
+            since = max(since, self._cutoff()) if since else self._cutoff()
+        # records added by earlier versions have their time as a string
+        spec = {'$or': [{self.kTIMEADDED: {'$gt': since}},
+            {self.kTIMEADDED: {'$gt': since.isoformat()}}]} if since else {}
+        return (doc[self.kID] for difc in self._difcs()
+            for doc in difc.find(spec, [self.kID]))
+
+    def purge_key(self, key):
+        if not self.partition:
+            raise NotImplementedError
+        self.db.drop_collection(self._partition_name(key))
+
     def register_key(self, newkey):
         try:
-            self.keyc.insert({self.kID: newkey}, check_keys=False, safe=True)
+            self.keyc.insert({self.kID: newkey, self.kTIMEADDED: utcnow()},
+                check_keys=False, safe=True)
             return True
         except:
             return False
@@ -73,12 +207,24 @@ class MongoStore(DocStore):
             self.register_key(key)
         return imap(itemgetter(self.kID), self.keyc.find())
 
+    def key_changes(self, since=None):
+        # keys registered by earlier versions have no time, but are all
+        # found by the first call
+        now = utcnow()
+        spec = {self.kTIMEADDED: {'$gte': since - self.KEY_CHANGES_SLACK}} \
+            if since else {}
+        return imap(itemgetter(self.kID), self.keyc.find(spec, [self.kID])), now
+
     def clear(self):
         self.conn.drop_database(self.db)
         self._bootstrap()
 
     def _add_log_record(self, record):
-        self.logc.insert(record)
+        self.logc.insert(self._decode_bodies(record))
+
+    def _add_log_records(self, records):
+        if records:
+            self.logc.insert(map(self._decode_bodies, records))
 
     def iterlog(self):
         return self.logc.find()
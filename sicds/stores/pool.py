@@ -0,0 +1,187 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from contextlib import contextmanager
+from Queue import Empty, LifoQueue
+from sicds.base import StoreError, StoreWrapper, url_options
+from threading import Lock, local
+
+class PoolTimeout(StoreError): pass
+
+class PooledStore(StoreWrapper):
+    '''
+    Makes more instances of the wrapped store from the url it was made
+    from, so that the threads of a threaded server do not all go through
+    one instance (and its connection to the backend). By default each
+    thread is given an instance of its own the first time it uses the
+    store. With ``pool_instances``, at most that many are made instead, and
+    each call takes one from the pool for as long as it runs, waiting up to
+    ``pool_timeout`` seconds for one to be free::
+
+        >>> from sicds.config import store_from_url
+        >>> from tempfile import mkdtemp
+        >>> from threading import Thread
+        >>> store = store_from_url('pool+sqlite://' + mkdtemp() + '/db')
+        >>> record = store._new_difs_record('a')
+        >>> store._add_difs_records_many(u'key', [record])
+        [True]
+        >>> results = []
+        >>> t = Thread(target=lambda: results.append(
+        ...     store._add_difs_records_many(u'key', [record])))
+        >>> t.start(); t.join()
+        >>> results, store.stats()[u'pool']
+        ([[False]], {'instances': 2, 'max_instances': 0})
+
+    This only works with stores whose instances made from the same url share
+    their records (see :attr:`sicds.base.BaseStore.SHARED_BY_URL`), so
+    wrappers which keep records of their own go in front of it, e.g.
+    "lru+pool+mongodb://localhost:27017/sicds".
+    '''
+    THREADSAFE = True
+
+    def __init__(self, url, store):
+        StoreWrapper.__init__(self, url, store)
+        if not store.SHARED_BY_URL or store.from_url is None:
+            raise StoreError('pool cannot make more instances of {0}'
+                .format(store.__class__.__name__))
+        options = url_options(url, pool_instances=0, pool_timeout=30.0)
+        self.max_instances = options['pool_instances']
+        self.timeout = options['pool_timeout']
+        self.lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        #: number of instances made, including the wrapped store
+        self.instances = 1
+        #: each thread's instance, without ``pool_instances``
+        self.local = local()
+        # the thread which made the store keeps it
+        self.local.store = self.store
+        #: instances not in use, with ``pool_instances``
+        self.free = LifoQueue()
+        self.free.put(self.store)
+
+    def _new_instance(self):
+        from sicds.config import store_from_url
+        return store_from_url(self.store.from_url)
+
+    def _make(self, limit=0):
+        '''
+        Returns a new instance, or None if ``limit`` instances have been
+        made already.
+        '''
+        with self.lock:
+            if limit and self.instances >= limit:
+                return None
+            self.instances += 1
+        try:
+            return self._new_instance()
+        except:
+            with self.lock:
+                self.instances -= 1
+            raise
+
+    @contextmanager
+    def _instance(self):
+        '''
+        Gives the instance the calling thread is to use, for the duration of
+        a ``with`` block.
+        '''
+        if not self.max_instances:
+            store = getattr(self.local, 'store', None)
+            if store is None:
+                store = self.local.store = self._make()
+            yield store
+            return
+        try:
+            store = self.free.get_nowait()
+        except Empty:
+            store = self._make(self.max_instances)
+            if store is None:
+                try:
+                    store = self.free.get(True, self.timeout)
+                except Empty:
+                    raise PoolTimeout('No free store instance after {0}s'
+                        .format(self.timeout))
+        try:
+            yield store
+        finally:
+            self.free.put(store)
+
+    def after_fork(self):
+        # the instances of other threads were left behind with them
+        self.store.after_fork()
+        self._reset()
+
+    def _add_difs_records(self, records):
+        with self._instance() as store:
+            return store._add_difs_records(records)
+
+    def _add_difs_records_many(self, key, records):
+        with self._instance() as store:
+            return store._add_difs_records_many(key, records)
+
+    def _add_difs_records_nowait(self, key, records):
+        with self._instance() as store:
+            return store._add_difs_records_nowait(key, records)
+
+    def iterdigests(self, since=None):
+        with self._instance() as store:
+            return iter(list(store.iterdigests(since)))
+
+    def register_key(self, newkey):
+        with self._instance() as store:
+            return store.register_key(newkey)
+
+    def ensure_keys(self, keys):
+        with self._instance() as store:
+            return iter(list(store.ensure_keys(keys)))
+
+    def key_changes(self, since=None):
+        with self._instance() as store:
+            keys, token = store.key_changes(since)
+            return list(keys), token
+
+    def purge_key(self, key):
+        with self._instance() as store:
+            store.purge_key(key)
+
+    def clear(self):
+        with self._instance() as store:
+            store.clear()
+
+    def stats(self):
+        with self._instance() as store:
+            stats = store.stats()
+        stats[u'pool'] = dict(instances=self.instances,
+            max_instances=self.max_instances)
+        return stats
+
+    def _add_log_record(self, record):
+        with self._instance() as store:
+            store._add_log_record(record)
+
+    def _add_log_records(self, records):
+        with self._instance() as store:
+            store._add_log_records(records)
+
+    def iterlog(self):
+        with self._instance() as store:
+            return iter(list(store.iterlog()))
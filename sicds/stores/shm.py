@@ -0,0 +1,159 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from mmap import mmap
+from multiprocessing import Lock
+from sicds.base import BaseStore, StoreError, url_options
+from sicds.loggers import TmpLogger
+from sicds.stores.hashtable import DigestTable, TableFull
+from struct import calcsize, pack_into, unpack_from
+from zlib import crc32
+
+class ShmStore(BaseStore, TmpLogger):
+    '''
+    Stores digests and keys in an anonymous shared memory segment, so that
+    worker processes forked after the store is created all see the same
+    data. Records are lost when the last of them exits. Log records are
+    kept in each process's own memory.
+
+    Digests are split across ``stripes`` fixed-size hash tables, each
+    guarded by its own process-shared lock: a process claims a slot for a
+    digest by finding it empty and filling it while holding the lock, so
+    adding a digest if it is absent is atomic across all processes.
+
+    Options (in the url's query string): ``slots`` (total number of digest
+    slots), ``stripes``, ``key_bytes`` (room for registered keys).
+    '''
+    PROCESS_SAFE = True
+    THREADSAFE = True
+    #: a stripe refuses new digests once this fraction of its slots is used
+    MAX_LOAD = 0.75
+
+    def __init__(self, url):
+        TmpLogger.__init__(self)
+        options = url_options(url, slots=2**20, stripes=16, key_bytes=2**16)
+        nstripes = options['stripes']
+        slots = max(1, options['slots'] // nstripes)
+        # round up to a power of 2 as the tables require
+        nslots = 1 << (slots - 1).bit_length()
+        self._init_store_options(url)
+        self.width = self.hasher.size
+        if self.migrate_from is not None and \
+                self.migrate_from.size != self.hasher.size:
+            raise StoreError('Digests of different sizes cannot be migrated '
+                'in a fixed-width table')
+        self.key_bytes = options['key_bytes']
+        self.counts_size = calcsize('>{0}Q'.format(nstripes))
+        tablesize = DigestTable.size(nslots, self.width)
+        self.size = self.counts_size + nstripes * tablesize + \
+            calcsize('>Q') + self.key_bytes
+        self.mm = mmap(-1, self.size)
+        self.tables = [DigestTable(self.mm, self.counts_size + i * tablesize,
+            nslots, self.width) for i in xrange(nstripes)]
+        self.locks = [Lock() for i in xrange(nstripes)]
+        self.keys_offset = self.counts_size + nstripes * tablesize
+        self.keylock = Lock()
+
+    @staticmethod
+    def _new_difs_record(id):
+        return id
+
+    def _stripe(self, digest):
+        return (crc32(digest) & 0xffffffff) % len(self.tables)
+
+    def _count(self, stripe):
+        return unpack_from('>Q', self.mm, stripe * 8)[0]
+
+    def _add(self, stripe, digest):
+        table = self.tables[stripe]
+        count = self._count(stripe)
+        if count + 1 > table.nslots * self.MAX_LOAD:
+            if digest in table:
+                return False
+            raise StoreError('shared memory table is full')
+        added = table.add(digest)
+        if added:
+            pack_into('>Q', self.mm, stripe * 8, count + 1)
+        return added
+
+    def _add_difs_records_many(self, key, records):
+        added = []
+        for digest in records:
+            stripe = self._stripe(digest)
+            with self.locks[stripe]:
+                added.append(self._add(stripe, digest))
+        return added
+
+    def iterdigests(self, since=None):
+        digests = []
+        for table, lock in zip(self.tables, self.locks):
+            with lock:
+                digests.extend(table)
+        return iter(digests)
+
+    def _keys(self):
+        used = unpack_from('>Q', self.mm, self.keys_offset)[0]
+        start = self.keys_offset + 8
+        keys = self.mm[start:start+used].decode('utf-8')
+        return keys.split(u'\n')[:-1]
+
+    def register_key(self, newkey):
+        with self.keylock:
+            if newkey in self._keys():
+                return False
+            used = unpack_from('>Q', self.mm, self.keys_offset)[0]
+            entry = newkey.encode('utf-8') + '\n'
+            if used + len(entry) > self.key_bytes:
+                raise StoreError('no room in shared memory for more keys')
+            start = self.keys_offset + 8 + used
+            self.mm[start:start+len(entry)] = entry
+            pack_into('>Q', self.mm, self.keys_offset, used + len(entry))
+            return True
+
+    def ensure_keys(self, keys):
+        for key in keys:
+            self.register_key(key)
+        with self.keylock:
+            return iter(self._keys())
+
+    def clear(self):
+        for locks in (self.locks, [self.keylock]):
+            for lock in locks:
+                lock.acquire()
+        try:
+            self.mm[:] = '\0' * self.size
+        finally:
+            for locks in (self.locks, [self.keylock]):
+                for lock in locks:
+                    lock.release()
+
+    def stats(self):
+        stats = BaseStore.stats(self)
+        counts = [self._count(i) for i in xrange(len(self.tables))]
+        nslots = self.tables[0].nslots
+        stats.update(
+            entries=sum(counts),
+            slots=nslots * len(self.tables),
+            stripes=len(self.tables),
+            load_factor=float(sum(counts)) / (nslots * len(self.tables)),
+            max_stripe_load_factor=float(max(counts)) / nslots,
+            bytes=self.size,
+            )
+        return stats
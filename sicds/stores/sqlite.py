@@ -0,0 +1,228 @@
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from simplejson import dumps, loads
+from sicds.base import BaseStore, url_options, utcnow
+from sqlite3 import connect
+from threading import local
+from time import time
+
+class SqliteStore(BaseStore):
+    '''
+    Stores digests, keys and log records in tables of an SQLite database at
+    the url's path. Each thread gets its own connection, and all the dif
+    records for a request are added in a single transaction.
+
+    Options (in the url's query string): ``journal_mode`` (default "wal"),
+    ``synchronous`` (default "normal"), ``timeout`` (seconds to wait for
+    another connection's write lock).
+
+    With ``retention_days``, an expired dif record counts as absent and is
+    renewed when its digest is added again, and expired records are
+    deleted every so often.
+
+    With ``partition``, each client's dif records go in a table of their
+    own, created when first needed and dropped by :meth:`purge_key`.
+    '''
+    SUPPORTS_RETENTION = True
+    SUPPORTS_PARTITION = True
+    PROCESS_SAFE = True
+    THREADSAFE = True
+    SHARED_BY_URL = True
+    #: with a retention window, expired dif records are deleted at most
+    #: this many times per window
+    PURGES_PER_RETENTION = 64
+
+    DIFS_SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS {0} '
+            '(id BLOB PRIMARY KEY, time_added TEXT NOT NULL) WITHOUT ROWID',
+        )
+    SCHEMA = DIFS_SCHEMA + (
+        'CREATE TABLE IF NOT EXISTS keys '
+            '(key TEXT PRIMARY KEY) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS log '
+            '(timestamp TEXT NOT NULL, record TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS log_{0} ON log ({0})'.format(
+            BaseStore.LOG_INDEX),
+        )
+    RETENTION_SCHEMA = (
+        'CREATE INDEX IF NOT EXISTS {0}_time_added ON {0} (time_added)',
+        )
+    TABLES = ('difs', 'keys', 'log')
+
+    def __init__(self, url):
+        options = url_options(url, journal_mode='wal', synchronous='normal',
+            timeout=30.0)
+        self._init_store_options(url)
+        self.path = url.path
+        self.journal_mode = options['journal_mode']
+        self.synchronous = options['synchronous']
+        self.timeout = options['timeout']
+        self.local = local()
+        #: when expired records were last deleted from each table
+        self.last_purge = {}
+        with self._transaction() as conn:
+            self._create_difs_table(conn, 'difs', self.SCHEMA)
+
+    def _create_difs_table(self, conn, table, schema=DIFS_SCHEMA):
+        if self.retention is not None:
+            schema += self.RETENTION_SCHEMA
+        for statement in schema:
+            conn.execute(statement.format(table))
+
+    def _conn(self):
+        try:
+            return self.local.conn
+        except AttributeError:
+            conn = connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+            conn.execute('PRAGMA journal_mode={0}'.format(self.journal_mode))
+            conn.execute('PRAGMA synchronous={0}'.format(self.synchronous))
+            self.local.conn = conn
+            return conn
+
+    def after_fork(self):
+        # SQLite connections must not be carried across a fork
+        self.local = local()
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    @staticmethod
+    def _new_difs_record(id):
+        return (id, utcnow().isoformat())
+
+    @staticmethod
+    def _difs_record_id(record):
+        return record[0]
+
+    def _add_difs_records_many(self, key, records):
+        added = []
+        if self.retention is not None:
+            cutoff = self._cutoff().isoformat()
+        table = 'difs'
+        with self._transaction() as conn:
+            if self.partition:
+                # the table may have been dropped by another connection
+                # since this one last used it, so make sure every time
+                table = self._partition_name(key)
+                self._create_difs_table(conn, table)
+            insert = 'INSERT OR IGNORE INTO {0} VALUES (?, ?)'.format(table)
+            renew = ('UPDATE {0} SET time_added = ? '
+                'WHERE id = ? AND time_added < ?'.format(table))
+            for id, time_added in records:
+                cursor = conn.execute(insert, (buffer(id), time_added))
+                if cursor.rowcount != 1 and self.retention is not None:
+                    # renew the record if it has expired
+                    cursor = conn.execute(renew,
+                        (time_added, buffer(id), cutoff))
+                added.append(cursor.rowcount == 1)
+            if self.retention is not None:
+                self._purge(conn, table, cutoff)
+        return added
+
+    def _purge(self, conn, table, cutoff):
+        '''
+        Deletes expired dif records from ``table`` if that has not been done
+        lately.
+        '''
+        now = time()
+        interval = self.retention.total_seconds() / self.PURGES_PER_RETENTION
+        if now - self.last_purge.get(table, 0) >= interval:
+            self.last_purge[table] = now
+            conn.execute('DELETE FROM {0} WHERE time_added < ?'.format(table),
+                (cutoff,))
+
+    def _partition_tables(self, conn):
+        return [name for (name,) in conn.execute("SELECT name FROM "
+            "sqlite_master WHERE type = 'table' AND name LIKE 'difs!_%' "
+            "ESCAPE '!'")]
+
+    def iterdigests(self, since=None):
+        if self.retention is not None:
+            since = max(since, self._cutoff()) if since else self._cutoff()
+        conn = self._conn()
+        tables = ['difs'] + self._partition_tables(conn)
+        return (str(id) for table in tables
+            for (id,) in self._iterdigests(conn, table, since))
+
+    @staticmethod
+    def _iterdigests(conn, table, since):
+        if since is None:
+            return conn.execute('SELECT id FROM {0}'.format(table))
+        return conn.execute('SELECT id FROM {0} WHERE time_added > ?'
+            .format(table), (since.isoformat(),))
+
+    def purge_key(self, key):
+        if not self.partition:
+            raise NotImplementedError
+        table = self._partition_name(key)
+        with self._transaction() as conn:
+            conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+        self.last_purge.pop(table, None)
+
+    def register_key(self, newkey):
+        with self._transaction() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO keys VALUES (?)',
+                (newkey,))
+            return cursor.rowcount == 1
+
+    def ensure_keys(self, keys):
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO keys VALUES (?)',
+                ((key,) for key in keys))
+        return (key for (key,) in self._conn().execute('SELECT key FROM keys'))
+
+    def clear(self):
+        with self._transaction() as conn:
+            for table in self.TABLES:
+                conn.execute('DELETE FROM {0}'.format(table))
+            for table in self._partition_tables(conn):
+                conn.execute('DROP TABLE {0}'.format(table))
+
+    def _add_log_record(self, record):
+        self._add_log_records([record])
+
+    def _add_log_records(self, records):
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO log VALUES (?, ?)',
+                ((r[self.LOG_INDEX], dumps(self._decode_bodies(r)))
+                for r in records))
+
+    def iterlog(self):
+        rows = self._conn().execute('SELECT record FROM log ORDER BY {0}'
+            .format(self.LOG_INDEX))
+        return (loads(record) for (record,) in rows)
+
+class _Transaction(object):
+    '''
+    Context manager wrapping a write transaction on an SQLite connection.
+    The write lock is taken up front so that concurrent writers wait on the
+    connection's timeout rather than failing to upgrade a read lock.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, type, value, traceback):
+        self.conn.execute('ROLLBACK' if type else 'COMMIT')
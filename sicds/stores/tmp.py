@@ -18,18 +18,192 @@
 # Boston, MA  02110-1301
 # USA
 
-from sicds.base import BaseStore
+from collections import defaultdict, deque
+from sicds.base import BaseStore, url_options
 from sicds.loggers import TmpLogger
+from sys import getsizeof
+from threading import Lock
+from time import time
+
+class GenerationalSet(object):
+    '''
+    A set which forgets its elements some time after they were added, or
+    once it holds too many of them, oldest first. The elements are kept in
+    generations, each a set of elements added around the same time, and
+    whole generations are dropped at once, so that forgetting takes
+    constant time per element.
+
+    With a ``lifetime``, each generation holds the elements added during
+    one ``lifetime / ngenerations`` long span of time, and is dropped once
+    all of its elements are at least ``lifetime`` old. So elements are
+    forgotten between ``lifetime`` and ``lifetime * (ngenerations + 1) /
+    ngenerations`` after they were added. Adding an element which is already
+    present does not renew it::
+
+        >>> from datetime import timedelta
+        >>> now = [0]
+        >>> s = GenerationalSet(timedelta(seconds=4), ngenerations=4,
+        ...     clock=lambda: now[0])
+        >>> s.add('a')
+        >>> now[0] = 2
+        >>> s.update(['a', 'b'])
+        >>> now[0] = 4.5
+        >>> sorted(s), len(s.generations)
+        (['a', 'b'], 3)
+        >>> now[0] = 5
+        >>> sorted(s), 'a' in s, s.expired
+        (['b'], False, 1)
+
+    With ``max_entries``, a generation is also started whenever the newest
+    one holds ``max_entries / ngenerations`` elements, and the oldest is
+    dropped (its elements counted in :attr:`evicted`) whenever the set
+    holds more than ``max_entries``, like a segmented FIFO queue::
+
+        >>> s = GenerationalSet(max_entries=4, ngenerations=2)
+        >>> s.update('abcd')
+        >>> len(s), s.evicted
+        (4, 0)
+        >>> s.add('e')
+        >>> sorted(s), s.evicted
+        (['c', 'd', 'e'], 2)
+
+    '''
+    def __init__(self, lifetime=None, max_entries=None, ngenerations=8,
+            clock=time):
+        self.span = lifetime and lifetime.total_seconds() / ngenerations
+        self.max_entries = max_entries
+        self.per_generation = max_entries and -(-max_entries // ngenerations)
+        self.ngenerations = ngenerations
+        self.clock = clock
+        #: (index of the span of time, set of elements added then) pairs,
+        #: oldest first. The index is None without a ``lifetime``.
+        self.generations = deque()
+        self.size = 0
+        #: number of elements forgotten for being too old
+        self.expired = 0
+        #: number of elements forgotten to make room for new ones
+        self.evicted = 0
+
+    def _drop(self):
+        i, dropped = self.generations.popleft()
+        self.size -= len(dropped)
+        return len(dropped)
+
+    def _current(self):
+        '''
+        Drops expired generations and returns the one to add elements to.
+        '''
+        generations = self.generations
+        now = None
+        if self.span:
+            now = int(self.clock() // self.span)
+            while generations and generations[0][0] < now - self.ngenerations:
+                self.expired += self._drop()
+        if not generations or generations[-1][0] != now or (
+                self.per_generation and
+                len(generations[-1][1]) >= self.per_generation):
+            generations.append((now, set()))
+        return generations[-1][1]
+
+    def __contains__(self, element):
+        self._current()
+        return any(element in s for (i, s) in self.generations)
+
+    def add(self, element):
+        if element in self:
+            return
+        self.generations[-1][1].add(element)
+        self.size += 1
+        if self.max_entries and self.size > self.max_entries:
+            self.evicted += self._drop()
+
+    def update(self, elements):
+        for element in elements:
+            self.add(element)
+
+    def intersection(self, elements):
+        return set(e for e in elements if e in self)
+
+    def __iter__(self):
+        self._current()
+        return (e for (i, s) in list(self.generations) for e in list(s))
+
+    def __len__(self):
+        self._current()
+        return self.size
+
+    def clear(self):
+        self.generations.clear()
+        self.size = 0
 
 class TmpStore(BaseStore, TmpLogger):
     '''
     Stores records in memory. All records are lost when the object is destroyed.
+    With ``retention_days``, ``max_entries`` or ``max_bytes`` (an estimate of
+    the memory taken by the records), records are kept in a
+    :class:`GenerationalSet`, and the oldest are evicted to stay in bounds.
+    With ``partition``, each client's records are kept in a set of their
+    own, and the bounds apply to each set separately.
     '''
-    def __init__(self, *args):
+    SUPPORTS_RETENTION = True
+    SUPPORTS_CAPACITY = True
+    SUPPORTS_PARTITION = True
+    # unlike its log, the sets of dif records and keys are not guarded
+    THREADSAFE = False
+    #: estimated memory used by each record besides its digest
+    ENTRY_OVERHEAD = 50
+
+    def __init__(self, url):
+        self._init_store_options(url)
         TmpLogger.__init__(self)
-        self.db = set()
+        self.db = self._new_db(self._entry_limit())
+        #: with ``partition``, the set of dif records of each key
+        self.partitions = {}
         self.keys = set()
 
+    def _entry_limit(self):
+        '''
+        Returns the most records the store can hold, or None if unbounded.
+        '''
+        limits = []
+        if self.max_entries:
+            limits.append(self.max_entries)
+        if self.max_bytes:
+            entry = getsizeof(self._hash(u'', [])) + self.ENTRY_OVERHEAD
+            limits.append(max(1, self.max_bytes // entry))
+        return min(limits) if limits else None
+
+    def _new_db(self, max_entries=None):
+        if self.retention is None and max_entries is None:
+            return set()
+        return GenerationalSet(self.retention, max_entries)
+
+    def _db(self, key):
+        '''
+        Returns the set holding the dif records of the given key.
+        '''
+        if not self.partition:
+            return self.db
+        try:
+            return self.partitions[key]
+        except KeyError:
+            return self.partitions.setdefault(key,
+                self._new_db(self._entry_limit()))
+
+    def _dbs(self):
+        return [self.db] + self.partitions.values()
+
+    def stats(self):
+        stats = BaseStore.stats(self)
+        dbs = self._dbs()
+        stats.update(
+            entries=sum(len(db) for db in dbs),
+            evictions=sum(getattr(db, 'evicted', 0) for db in dbs),
+            expirations=sum(getattr(db, 'expired', 0) for db in dbs),
+            max_entries=self._entry_limit(),
+            )
+        return stats
+
     @staticmethod
     def _new_difs_record(id):
         return id
@@ -40,6 +214,15 @@ class TmpStore(BaseStore, TmpLogger):
         self.db.update(records)
         return uniq
 
+    def _add_difs_records_many(self, key, records):
+        db = self._db(key)
+        added = [r not in db for r in records]
+        db.update(records)
+        return added
+
+    def iterdigests(self, since=None):
+        return iter([id for db in self._dbs() for id in db])
+
     def register_key(self, newkey):
         if newkey in self.keys:
             return False
@@ -50,5 +233,75 @@ class TmpStore(BaseStore, TmpLogger):
         self.keys.update(keys)
         return iter(self.keys)
 
+    def purge_key(self, key):
+        if not self.partition:
+            raise NotImplementedError
+        self.partitions.pop(key, None)
+
     def clear(self):
         self.db.clear()
+        self.partitions.clear()
+
+class StripedStore(TmpStore):
+    '''
+    Stores records in memory like :class:`TmpStore`, but can be shared by
+    the threads of a threaded server. Digests are split across ``stripes``
+    sets, each guarded by its own lock, so threads only wait for each other
+    when they touch the same stripe, and adding a digest if it is absent is
+    atomic: two requests can never both find the same digest new.
+    '''
+    SUPPORTS_PARTITION = False
+    THREADSAFE = True
+
+    def __init__(self, url):
+        TmpStore.__init__(self, url)
+        nstripes = url_options(url, stripes=16)['stripes']
+        limit = self._entry_limit()
+        # each stripe gets an equal share of the bound
+        limit = limit and -(-limit // nstripes)
+        self.db = [self._new_db(limit) for i in xrange(nstripes)]
+        self.locks = [Lock() for i in xrange(nstripes)]
+        self.keylock = Lock()
+
+    def _add_difs_records(self, records):
+        return all(self._add_difs_records_many(None, records))
+
+    def _add_difs_records_many(self, key, records):
+        nstripes = len(self.db)
+        bystripe = defaultdict(list)
+        for i, r in enumerate(records):
+            bystripe[hash(r) % nstripes].append(i)
+        added = [False] * len(records)
+        for stripe, indices in bystripe.iteritems():
+            db = self.db[stripe]
+            with self.locks[stripe]:
+                for i in indices:
+                    r = records[i]
+                    if r not in db:
+                        db.add(r)
+                        added[i] = True
+        return added
+
+    def iterdigests(self, since=None):
+        digests = []
+        for db, lock in zip(self.db, self.locks):
+            with lock:
+                digests.extend(db)
+        return iter(digests)
+
+    def register_key(self, newkey):
+        with self.keylock:
+            return TmpStore.register_key(self, newkey)
+
+    def ensure_keys(self, keys):
+        with self.keylock:
+            self.keys.update(keys)
+            return iter(list(self.keys))
+
+    def clear(self):
+        for db, lock in zip(self.db, self.locks):
+            with lock:
+                db.clear()
+
+    def _dbs(self):
+        return self.db
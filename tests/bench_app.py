@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+
+'''
+Compares the identify response path against building the response through
+IDResult and IDResponse Schema instances and dumping the unwrapped result,
+as was done before. For each, reports the time to make a response for 1000
+items, and the size of what is kept for logging the response::
+
+    python tests/bench_app.py [nitems] [nruns]
+
+'''
+
+from gc import get_referents
+from sys import argv, getsizeof
+from timeit import default_timer
+
+from simplejson import dumps
+from sicds.app import IDResponse, IDResult, SiCDSApp, _dumps_idresponse
+
+def schema_response(key, uniq, dup):
+    results = [IDResult({'id': i, 'result': 'unique'}) for i in uniq] + \
+              [IDResult({'id': i, 'result': 'duplicate'}) for i in dup]
+    respjson = IDResponse(key=key, results=results).unwrap
+    return dumps(respjson), respjson
+
+def direct_response(key, uniq, dup):
+    resp = SiCDSApp._response(_dumps_idresponse(key, uniq, dup))
+    return resp.body, resp.logged_body
+
+def deepsize(obj):
+    '''
+    Returns the number of objects reachable from ``obj`` and their total
+    size in bytes, not counting shared strings such as dict keys twice.
+    '''
+    seen = set()
+    todo = [obj]
+    nbytes = 0
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        nbytes += getsizeof(o)
+        if isinstance(o, (dict, list)):
+            todo.extend(get_referents(o))
+    return len(seen), nbytes
+
+def bench(make, key, uniq, dup, nruns):
+    best = None
+    for i in xrange(nruns):
+        start = default_timer()
+        body, logged = make(key, uniq, dup)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return body, best, deepsize(logged)
+
+def main():
+    nitems = int(argv[1]) if argv[1:] else 1000
+    nruns = int(argv[2]) if argv[2:] else 50
+    key = u'bench_key'
+    ids = [u'item{0}'.format(i) for i in xrange(nitems)]
+    uniq, dup = ids[::2], ids[1::2]
+    expected = None
+    print('{0} items, best of {1} runs:'.format(nitems, nruns))
+    for name, make in (('schema', schema_response), ('direct', direct_response)):
+        body, best, (nobjects, nbytes) = bench(make, key, uniq, dup, nruns)
+        if expected is None:
+            expected = body
+        assert body == expected, 'responses differ'
+        print('  {0}: {1:.2f} ms, logged body is {2} objects, {3} bytes'
+            .format(name, best * 1000, nobjects, nbytes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+
+'''
+Compares ways of making the ``_bulk_docs`` requests CouchStore adds dif
+records with, from several threads at once: a new connection per request,
+the pooled persistent connections CouchStore uses, and couchdb-python's
+``Database.update`` (if couchdb-python is installed). Runs against a local
+HTTP stand-in for CouchDB which just tracks document ids, unless given the
+url of a database on a real CouchDB server (which will be created)::
+
+    python tests/bench_couch.py [nthreads] [nrequests] [url]
+
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from httplib import HTTPConnection
+from itertools import count
+from sys import argv
+from threading import Lock, Thread
+from timeit import default_timer
+from urlparse import urlsplit
+
+from simplejson import dumps, loads
+from sicds.stores.httppool import HTTPConnectionPool
+
+BATCH_SIZE = 20
+POOL_SIZE = 10
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # replies are written in one go, like CouchDB does, rather than
+    # the headers and body in separate packets, which with keep-alive
+    # would wait on the client's delayed ack
+    wbufsize = -1
+    ids = set()
+    lock = Lock()
+
+    def do_POST(self):
+        docs = loads(self.rfile.read(int(self.headers['Content-Length'])))
+        results = []
+        with self.lock:
+            for doc in docs['docs']:
+                if doc['_id'] in self.ids:
+                    results.append({'id': doc['_id'], 'error': 'conflict'})
+                else:
+                    self.ids.add(doc['_id'])
+                    results.append({'id': doc['_id'], 'rev': '1-0'})
+        self._reply(201, dumps(results))
+
+    def do_PUT(self):
+        self._reply(201, '{"ok":true}')
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def body(docs):
+    return dumps({'docs': docs})
+
+HEADERS = {'Content-Type': 'application/json'}
+
+def per_request(url):
+    def post(docs):
+        conn = HTTPConnection(url.hostname, url.port)
+        try:
+            conn.request('POST', url.path + '/_bulk_docs', body(docs),
+                dict(HEADERS, Connection='close'))
+            return conn.getresponse().read()
+        finally:
+            conn.close()
+    return post
+
+def pooled(url):
+    pool = HTTPConnectionPool(url.hostname, url.port, POOL_SIZE)
+    def post(docs):
+        return pool.request('POST', url.path + '/_bulk_docs', body(docs),
+            HEADERS)[1]
+    return post
+
+def couchdb_python(url):
+    from couchdb import Database
+    db = Database(url.geturl())
+    return db.update
+
+def bench(post, nthreads, nrequests, ids):
+    def run():
+        for i in xrange(nrequests):
+            post([{'_id': str(ids.next())} for j in xrange(BATCH_SIZE)])
+    threads = [Thread(target=run) for i in xrange(nthreads)]
+    start = default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return default_timer() - start
+
+def main():
+    nthreads = int(argv[1]) if argv[1:] else 8
+    nrequests = int(argv[2]) if argv[2:] else 500
+    if argv[3:]:
+        url = urlsplit(argv[3])
+        HTTPConnectionPool(url.hostname, url.port).request('PUT', url.path)
+    else:
+        server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        Thread(target=server.serve_forever).start()
+        url = urlsplit('http://127.0.0.1:{0}/bench'.format(server.server_port))
+    try:
+        import couchdb
+    except ImportError:
+        couchdb = None
+    ways = [('connection per request', per_request), ('pool', pooled)]
+    if couchdb is not None:
+        ways.append(('couchdb-python', couchdb_python))
+    ids = count()
+    print('{0} threads x {1} requests of {2} docs:'.format(nthreads,
+        nrequests, BATCH_SIZE))
+    try:
+        for name, make in ways:
+            elapsed = bench(make(url), nthreads, nrequests, ids)
+            print('  {0}: {1:.0f} requests/s'.format(name,
+                nthreads * nrequests / elapsed))
+    finally:
+        if not argv[3:]:
+            server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+
+'''
+Reports how long it takes to validate an identify request through the
+generic Schema constructor and through the compiled fast path, and how
+much memory the resulting Schema instances take::
+
+    python tests/bench_schema.py [nitems] [nruns]
+
+'''
+
+from sys import argv, getsizeof
+from timeit import default_timer
+
+from sicds.app import IDRequest, _parse_idrequest
+from sicds.schema import Schema
+
+def make_request(nitems, ncolls=2, ndifs=3):
+    return {u'key': u'bench_key', u'contentItems': [
+        {u'id': u'item{0}'.format(i), u'difcollections': [
+            {u'name': u'collection{0}'.format(j), u'difs': [
+                {u'type': u'type{0}'.format(k), u'value': u'value{0}'.format(k)}
+                for k in xrange(ndifs)]}
+            for j in xrange(ncolls)]}
+        for i in xrange(nitems)]}
+
+def schema_memory(obj):
+    '''
+    Returns the number of Schema instances reachable from ``obj`` and the
+    bytes taken by them (including any ``__dict__`` and per-instance
+    defaults) and by the lists
+    holding them, not counting the field values they share with the request.
+    '''
+    ninstances = nbytes = 0
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if isinstance(o, Schema):
+            ninstances += 1
+            nbytes += getsizeof(o)
+            if hasattr(o, '__dict__'):
+                nbytes += getsizeof(o.__dict__)
+                if '_defaults' in o.__dict__:
+                    nbytes += getsizeof(o.__dict__['_defaults'])
+            todo.extend(getattr(o, f) for f in o.required)
+            todo.extend(getattr(o, f) for f in o.optional)
+        elif isinstance(o, list):
+            nbytes += getsizeof(o)
+            todo.extend(o)
+    return ninstances, nbytes
+
+def bench(parse, req, nruns):
+    best = None
+    for i in xrange(nruns):
+        start = default_timer()
+        parsed = parse(req)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return parsed, best
+
+def main():
+    nitems = int(argv[1]) if argv[1:] else 1000
+    nruns = int(argv[2]) if argv[2:] else 20
+    req = make_request(nitems)
+    print('{0} items, best of {1} runs:'.format(nitems, nruns))
+    for name, parse in (('generic', IDRequest), ('compiled', _parse_idrequest)):
+        parsed, best = bench(parse, req, nruns)
+        ninstances, nbytes = schema_memory(parsed)
+        print('  {0}: {1:.2f} ms, {2} instances taking {3} bytes'
+            .format(name, best * 1000, ninstances, nbytes))
+
+if __name__ == '__main__':
+    main()
@@ -23,25 +23,82 @@ from collections import namedtuple
 from functools import partial
 from itertools import count
 from json import dumps, loads
+from operator import attrgetter
+from os.path import join
 from re import compile
 from sys import stdout
+from tempfile import gettempdir
 from webob import exc
 from webtest import TestApp
 
-from sicds.app import SiCDSApp, IDRequest, IDResult, IDResponse, \
-    KeyRegRequest, KeyRegResponse
-from sicds.config import SiCDSConfig, UrlInitFailure
+from sicds.app import SiCDSApp, makeapp, Dif, IDRequest, IDResult, \
+    IDResponse, KeyRegRequest, KeyRegResponse, PurgeRequest, PurgeResponse, \
+    StatsRequest
+from sicds.config import SiCDSConfig, UrlInitFailure, store_from_url
 from sicds.shell import startshell
 
 # first run doctests
 import doctest
 import sicds.app
+import sicds.base
 import sicds.config
+import sicds.digest
+import sicds.keys
+import sicds.loggers
 import sicds.schema
-doctested = (sicds.app, sicds.config, sicds.schema)
+import sicds.stores.bloom
+import sicds.stores.coalesce
+import sicds.stores.hashtable
+import sicds.stores.journal
+import sicds.stores.lru
+import sicds.stores.pool
+import sicds.stores.tmp
+doctested = (sicds.app, sicds.base, sicds.config, sicds.digest, sicds.keys,
+    sicds.loggers, sicds.schema, sicds.stores.bloom, sicds.stores.coalesce,
+    sicds.stores.hashtable, sicds.stores.journal, sicds.stores.lru,
+    sicds.stores.pool, sicds.stores.tmp)
 for m in doctested:
     doctest.testmod(m=m, optionflags=doctest.ELLIPSIS)
 
+# check that the hash table stores spread versioned digests, which all share
+# their leading bytes, over their tables instead of piling them up in one
+# chain, and that none of them is taken for another
+def check_table_spread(url, n=2000, maxprobe=32):
+    store = store_from_url(url)
+    store.clear()
+    digests = [store._hash(u'key', [Dif(type=u't', value=unicode(i))])
+        for i in xrange(2 * n)]
+    if len(set(d[:1] for d in digests)) != 1:
+        raise AssertionError('{0}: digests are not versioned'.format(url))
+    added, unseen = digests[:n], digests[n:]
+    if not all(store._add_difs_records_many(u'key', added)):
+        raise AssertionError('{0}: new digest taken for a duplicate'
+            .format(url))
+    if any(store._add_difs_records_many(u'key', added)):
+        raise AssertionError('{0}: duplicate digest taken for a new one'
+            .format(url))
+    tables = getattr(store, 'tables', None) or [store.table]
+    longest = 0
+    for d in added:
+        for table in tables:
+            slot, present = table._find(d)
+            if present:
+                start = next(table._probe(d))
+                longest = max(longest,
+                    (slot - start) // table.slotsize % table.nslots)
+    if longest > maxprobe:
+        raise AssertionError('{0}: a digest is {1} slots from its start'
+            .format(url, longest))
+    if not all(store._add_difs_records_many(u'key', unseen)):
+        raise AssertionError('{0}: new digest taken for a duplicate'
+            .format(url))
+    store.clear()
+
+for url in ('shm:?slots=8192&stripes=2&hash=sha1',
+        'file://' + join(gettempdir(), 'sicds_test_spread.difs') +
+        '?slots=8192&hash=sha1'):
+    check_table_spread(url)
+
 # now perform functional tests
 TESTKEY = 'test_key'
 TESTSUPERKEY = 'test_superkey'
@@ -57,6 +114,30 @@ def make_config(store):
 # make sure these configs don't point to anything important!
 testconfigs = (
     make_config('tmp:'),
+    make_config('striped:'),
+    make_config('shm:?slots=65536'),
+    make_config('compact:?buffer_size=2'),
+    make_config('compact:?fingerprint_bits=64&buffer_size=2'),
+    make_config('bloom+tmp:'),
+    make_config('lru+tmp:'),
+    make_config('coalesce+striped:?coalesce_ms=1'),
+    make_config('journal+sqlite://' + join(gettempdir(), 'sicds_test_journal.sqlite') +
+        '?partition=1&journal=' + join(gettempdir(), 'sicds_test.journal')),
+    make_config('tmp:?hash=sha256&digest_size=16'),
+    make_config('striped:?hash=sha1&migrate_from=legacy'),
+    make_config('striped:?retention_days=30'),
+    make_config('tmp:?max_entries=100000'),
+    make_config('lru+tmp:?partition=1'),
+    make_config('sqlite://' + join(gettempdir(), 'sicds_test_partition.sqlite') +
+        '?partition=1'),
+    make_config('sqlite://' + join(gettempdir(), 'sicds_test_retention.sqlite') +
+        '?retention_days=30'),
+    make_config('pool+sqlite://' + join(gettempdir(), 'sicds_test_pool.sqlite') +
+        '?pool_instances=2'),
+    make_config('tmp:?hash=blake2b'),
+    dict(make_config('tmp:'), log_queue_size=100),
+    make_config('file://' + join(gettempdir(), 'sicds_test.difs')),
+    make_config('sqlite://' + join(gettempdir(), 'sicds_test.sqlite')),
     make_config('couchdb://localhost:5984/sicds_test'),
     make_config('mongodb://localhost:27017/sicds_test'),
     )
@@ -88,13 +169,17 @@ def make_resp(req, result='unique'):
 class TestCase(object):
     '''
     Encapsulates a SiCDSRequest, a path, an expected response, and status code.
+    If ``applies`` is given, the test is only run against stores for which it
+    returns true.
     '''
-    def __init__(self, desc, req, resp='', path=SiCDSApp.R_IDENTIFY, status=200):
+    def __init__(self, desc, req, resp='', path=SiCDSApp.R_IDENTIFY, status=200,
+            applies=None):
         self.desc = desc
         self.req = dumps(req) if isinstance(req, dict) else req
         self.resp = dumps(resp) if isinstance(resp, dict) else resp
         self.path = path
         self.status = status
+        self.applies = applies
 
 testcases = []
 
@@ -144,6 +229,22 @@ tc_u12 = TestCase('[dif1, dif2] unique', req12, res12_u)
 tc_d21 = TestCase('[dif2, dif1] duplicate (order does not matter)', req21, res21_d)
 testcases.extend((tc_u12, tc_d21))
 
+# test that items in the same request are checked as if one after another:
+# an item sharing a collection with an earlier item in the request is duplicate
+c4 = make_coll()
+c5 = make_coll()
+i4 = make_item(difcollections=[c4])
+i45 = make_item(difcollections=[c4, c5])
+i5 = make_item(difcollections=[c5])
+req45 = make_req(contentItems=[i4, i45, i5])
+res45 = IDResponse(key=req45['key'], results=[
+    IDResult(id=i4['id'], result='unique'),
+    IDResult(id=i45['id'], result='duplicate'),
+    IDResult(id=i5['id'], result='duplicate'),
+    ]).unwrap
+tc_batch = TestCase('[c4], [c4, c5], [c5] in one request', req45, res45)
+testcases.append(tc_batch)
+
 # test registering a new key
 NEWKEY = 'test_key2'
 req_keyreg = KeyRegRequest(superkey=TESTSUPERKEY, newkey=NEWKEY).unwrap
@@ -165,6 +266,62 @@ res1_newkey = dict(res1_u, key=NEWKEY)
 tc_newkey_u = TestCase('item1 unique to new client', req1_newkey, res1_newkey)
 testcases.append(tc_newkey_u)
 
+# test that items can be streamed in and their results streamed back, one
+# per line, however many there are
+stream_items = [make_item() for i in range(SiCDSApp.STREAM_BATCH_SIZE + 1)]
+req_stream = '\n'.join(dumps(r) for r in
+    [{'key': TESTKEY}] + stream_items + req1['contentItems']) + '\n'
+res_stream = '\n'.join(dumps(IDResult(id=i['id'], result=r).unwrap) for (i, r) in
+    [(i, 'unique') for i in stream_items] +
+    [(req1['contentItems'][0], 'duplicate')]) + '\n'
+tc_stream = TestCase('stream items', req_stream, res_stream,
+    path=SiCDSApp.R_IDENTIFY_STREAM)
+testcases.append(tc_stream)
+
+req_stream_invalid = '\n'.join((dumps({'key': TESTKEY}),
+    dumps(make_item()), 'invalid', dumps(make_item())))
+tc_stream_invalid = TestCase('stream stops at invalid item', req_stream_invalid,
+    '"result": "unique"}\n{"error": ', path=SiCDSApp.R_IDENTIFY_STREAM)
+testcases.append(tc_stream_invalid)
+
+req_stream_badkey = dumps({'key': 'bad_key'}) + '\n' + dumps(make_item())
+tc_stream_badkey = TestCase('reject stream with bad key', req_stream_badkey,
+    path=SiCDSApp.R_IDENTIFY_STREAM, status=exc.HTTPForbidden().status_int)
+testcases.append(tc_stream_badkey)
+
+# test that store stats are only available with the superkey
+req_stats = StatsRequest(superkey=TESTSUPERKEY).unwrap
+tc_stats = TestCase('stats', req_stats, path=SiCDSApp.R_STATS)
+testcases.append(tc_stats)
+
+req_stats_badkey = StatsRequest(superkey='bad_superkey').unwrap
+tc_stats_badkey = TestCase('reject stats with bad superkey', req_stats_badkey,
+    path=SiCDSApp.R_STATS, status=exc.HTTPForbidden().status_int)
+testcases.append(tc_stats_badkey)
+
+# test that the superkey can purge a key's dif records, and only from a store
+# which partitions them by key
+partitioned = attrgetter('partition')
+req_purge = PurgeRequest(superkey=TESTSUPERKEY, key=TESTKEY).unwrap
+res_purge = PurgeResponse(key=TESTKEY, result='purged').unwrap
+tc_purge = TestCase('purge key', req_purge, res_purge, path=SiCDSApp.R_PURGE,
+    applies=partitioned)
+tc_purged_u = TestCase('item1 unique after purge', req1, res1_u,
+    applies=partitioned)
+tc_purged_newkey_d = TestCase('item1 still duplicate to new client',
+    req1_newkey, dict(res1_d, key=NEWKEY), applies=partitioned)
+testcases.extend((tc_purge, tc_purged_u, tc_purged_newkey_d))
+
+tc_purge_unsupported = TestCase('reject purge without partitions', req_purge,
+    path=SiCDSApp.R_PURGE, status=exc.HTTPNotImplemented().status_int,
+    applies=lambda store: not store.partition)
+testcases.append(tc_purge_unsupported)
+
+req_purge_badkey = dict(req_purge, superkey='bad_superkey')
+tc_purge_badkey = TestCase('reject purge with bad superkey', req_purge_badkey,
+    path=SiCDSApp.R_PURGE, status=exc.HTTPForbidden().status_int)
+testcases.append(tc_purge_badkey)
+
 # check that various bad requests give error responses
 req_badkey = dict(req1, key='bad_key')
 tc_badkey = TestCase('reject bad key', req_badkey,
@@ -177,6 +334,19 @@ tc_missing_fields = TestCase('reject missing fields', {},
     )
 testcases.append(tc_missing_fields)
 
+req_invalid_field = dict(make_req(), contentItems='invalid')
+tc_invalid_field = TestCase('reject invalid field', req_invalid_field,
+    status=exc.HTTPBadRequest().status_int,
+    )
+testcases.append(tc_invalid_field)
+
+req_empty_field = make_req()
+req_empty_field['contentItems'][0]['difcollections'][0]['difs'] = []
+tc_empty_field = TestCase('reject empty dif list', req_empty_field,
+    status=exc.HTTPBadRequest().status_int,
+    )
+testcases.append(tc_empty_field)
+
 req_extra_fields = dict(make_req(), extra='extra')
 tc_extra_fields = TestCase('reject extra fields', req_extra_fields,
     status=exc.HTTPBadRequest().status_int,
@@ -203,10 +373,11 @@ for config in testconfigs:
     config.store.clear()
     storetype = config.store.__class__.__name__
     stdout.write('{0}:\t'.format(storetype))
-    app = SiCDSApp(config.superkey, config.store, config.loggers, keys=config.keys)
-    app = TestApp(app)
+    app = TestApp(makeapp(config))
     failures = {}
     for i, tc in enumerate(testcases):
+        if tc.applies and not tc.applies(config.store):
+            continue
         resp = app.post(tc.path, tc.req, status=tc.status,
             expect_errors=True, # if there's an error don't cover it up
             headers={'content-type': 'application/json'})
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from httplib import HTTPConnection
+from os import WNOHANG, fork, kill, waitpid, _exit
+from signal import SIGKILL, SIGTERM
+from sicds.app import SiCDSApp
+from sicds.config import store_from_url
+from sicds.loggers import NullLogger
+from sicds.server import PreforkServer, WSGIServer
+from simplejson import dumps, loads
+from time import sleep, time
+from unittest import TestCase, main
+
+def identify(key, id, value):
+    return dumps({'key': key, 'contentItems': [{'id': id, 'difcollections':
+        [{'name': u'n', 'difs': [{'type': u't', 'value': value}]}]}]})
+
+class TestWSGIServer(TestCase):
+    def setUp(self):
+        store = store_from_url('striped:')
+        self.app = SiCDSApp(u'superkey', store, [NullLogger(None)], keys=[u'key'])
+        self.httpd = WSGIServer(('localhost', 0), self.app, threads=2)
+        self.httpd.start()
+        self.conn = HTTPConnection('localhost', self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        self.httpd.stop()
+
+    def post(self, path, body):
+        self.conn.request('POST', path, body)
+        resp = self.conn.getresponse()
+        return resp, resp.read()
+
+    def test_keep_alive(self):
+        resp, body = self.post('/', identify(u'key', u'a', u'x'))
+        self.assertEqual(loads(body)['results'][0]['result'], 'unique')
+        sock = self.conn.sock
+        resp, body = self.post('/', identify(u'key', u'b', u'x'))
+        self.assertEqual(loads(body)['results'][0]['result'], 'duplicate')
+        # both requests went over the same connection
+        self.assertTrue(self.conn.sock is sock)
+
+    def test_idle_connection(self):
+        # a connection kept open after its request does not hold a thread
+        httpd = WSGIServer(('localhost', 0), self.app, threads=1)
+        httpd.start()
+        try:
+            idle = HTTPConnection('localhost', httpd.server_address[1])
+            idle.request('POST', '/', identify(u'key', u'a', u'x'))
+            idle.getresponse().read()
+            start = time()
+            conn = HTTPConnection('localhost', httpd.server_address[1])
+            conn.request('POST', '/', identify(u'key', u'b', u'x'))
+            self.assertEqual(conn.getresponse().status, 200)
+            self.assertTrue(time() - start < 1)
+            # and is served again when the client sends another request
+            idle.request('POST', '/', identify(u'key', u'c', u'x'))
+            self.assertEqual(idle.getresponse().status, 200)
+            conn.close()
+            idle.close()
+        finally:
+            httpd.stop()
+
+    def test_unread_body(self):
+        # the app refuses a body this big without reading all of it, and
+        # the rest is skipped to get to the next request
+        resp, body = self.post('/', ' ' * (self.app.REQMAXBYTES * 4))
+        self.assertEqual(resp.status, 413)
+        resp, body = self.post('/', identify(u'key', u'a', u'x'))
+        self.assertEqual(resp.status, 200)
+
+    def test_chunked(self):
+        lines = ['{"key": "key"}\n'] + [dumps({'id': id, 'difcollections':
+            [{'name': u'n', 'difs': [{'type': u't', 'value': u'x'}]}]}) + '\n'
+            for id in (u'a', u'b')]
+        self.conn.putrequest('POST', '/stream')
+        self.conn.putheader('Transfer-Encoding', 'chunked')
+        self.conn.endheaders()
+        for line in lines:
+            self.conn.send('{0:x}\r\n{1}\r\n'.format(len(line), line))
+        self.conn.send('0\r\n\r\n')
+        resp = self.conn.getresponse()
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+        results = [loads(line)['result'] for line in resp.read().splitlines()]
+        self.assertEqual(results, ['unique', 'duplicate'])
+        resp, body = self.post('/', identify(u'key', u'c', u'x'))
+        self.assertEqual(resp.status, 200)
+
+    def test_chunked_too_large(self):
+        self.conn.putrequest('POST', '/')
+        self.conn.putheader('Transfer-Encoding', 'chunked')
+        self.conn.endheaders()
+        chunk = ' ' * 1024
+        for i in xrange(100):
+            self.conn.send('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+        self.conn.send('0\r\n\r\n')
+        resp = self.conn.getresponse()
+        resp.read()
+        self.assertEqual(resp.status, 413)
+
+class TestPreforkServer(TestCase):
+    def setUp(self):
+        store = store_from_url('shm:?slots=1024&stripes=4')
+        app = SiCDSApp(u'superkey', store, [NullLogger(None)], keys=[u'key'])
+        self.server = PreforkServer(app, 'localhost', 0, workers=2)
+        self.pid = fork()
+        if not self.pid:
+            status = 1
+            try:
+                self.server.serve_forever()
+                status = 0
+            finally:
+                _exit(status)
+        self.server.httpd.server_close()
+
+    def tearDown(self):
+        try:
+            kill(self.pid, SIGKILL)
+            waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+    def post(self, body):
+        # until the workers are up, connections are refused (SO_REUSEPORT)
+        # or wait in the backlog
+        for i in range(50):
+            conn = HTTPConnection('localhost', self.server.port)
+            try:
+                conn.request('POST', '/', body)
+                return loads(conn.getresponse().read())
+            except IOError:
+                sleep(0.1)
+            finally:
+                conn.close()
+        self.fail('no worker answered')
+
+    def workers(self):
+        with open('/proc/{0}/task/{0}/children'.format(self.pid)) as f:
+            return f.read().split()
+
+    def test_workers(self):
+        results = [self.post(identify(u'key', unicode(i), u'x'))['results']
+            [0]['result'] for i in range(8)]
+        # whichever worker answered, they share the store
+        self.assertEqual(results, ['unique'] + ['duplicate'] * 7)
+        # a worker which dies is replaced
+        workers = self.workers()
+        self.assertEqual(len(workers), 2)
+        kill(int(workers[0]), SIGKILL)
+        deadline = time() + 5
+        while time() < deadline and (len(self.workers()) != 2 or
+                workers[0] in self.workers()):
+            sleep(0.1)
+        self.assertEqual(len(self.workers()), 2)
+        self.assertEqual(self.post(identify(u'key', u'z', u'x'))['results']
+            [0]['result'], 'duplicate')
+        # and SIGTERM shuts everything down
+        kill(self.pid, SIGTERM)
+        pid, status = waitpid(self.pid, 0)
+        self.assertEqual(status, 0)
+
+if __name__ == '__main__':
+    main()
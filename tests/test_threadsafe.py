@@ -20,9 +20,11 @@
 # USA
 
 from couchdb.http import ResourceConflict
+from multiprocessing import Process, Queue
 from pymongo.errors import DuplicateKeyError
 from sicds.app import Dif
 from sicds.config import store_from_url
+from threading import Thread
 from unittest import TestCase, main
 
 class TestThreadsafeCouch(TestCase):
@@ -104,6 +106,27 @@ class TestThreadsafeMongo(TestCase):
         # Either way, both records must have made it into the store:
         self.assertRaises(DuplicateKeyError, lambda: insert(record2))
 
+    def test_insert_difs_bulk(self):
+        '''
+        Simulate the same client making two simultaneous requests checking
+        for an item identified by either of two dif collections, with each
+        request inserting its records in one unordered bulk operation.
+        '''
+        mongo = self.mongo
+        key = u'key'
+        dif1 = Dif(type='type1', value='value1')
+        dif2 = Dif(type='type2', value='value2')
+        record1 = mongo._new_difs_record(mongo._hash(key, [dif1]))
+        record2 = mongo._new_difs_record(mongo._hash(key, [dif2]))
+        # request 1 gets in first with record1 only
+        self.assertEqual(mongo._add_difs_records_many(key, [record1]), [True])
+        # request 2's duplicate key error is mapped back to record1 alone,
+        # and record2 still makes it into the store
+        self.assertEqual(mongo._add_difs_records_many(key, [record1, record2]),
+            [False, True])
+        self.assertEqual(mongo._add_difs_records_many(key, [record1, record2]),
+            [False, False])
+
     def test_insert_key(self):
         '''
         Simulate the same client making two simultaneous requests to register
@@ -115,6 +138,88 @@ class TestThreadsafeMongo(TestCase):
         insert(newkey)
         self.assertRaises(DuplicateKeyError, lambda: insert(newkey))
 
+class TestThreadsafeStriped(TestCase):
+    def setUp(self):
+        self.striped = store_from_url('striped:?stripes=4')
+
+    def test_insert_difs(self):
+        '''
+        Have several threads simultaneously insert the same records. Each
+        record must be found new by exactly one of them.
+        '''
+        striped = self.striped
+        key = u'key'
+        records = [striped._new_difs_record(striped._hash(key,
+            [Dif(type='type', value=unicode(i))])) for i in range(1000)]
+        results = []
+        def insert():
+            results.append(striped._add_difs_records_many(key, records))
+        threads = [Thread(target=insert) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(map(sum, zip(*results)), [1] * len(records))
+
+class TestThreadsafeCompact(TestThreadsafeStriped):
+    def setUp(self):
+        self.striped = store_from_url('compact:?buffer_size=16')
+
+class TestThreadsafeCoalesce(TestThreadsafeStriped):
+    def setUp(self):
+        self.striped = store_from_url('coalesce+tmp:?coalesce_ms=1')
+
+class TestThreadsafeJournal(TestThreadsafeStriped):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.striped = store_from_url('journal+tmp:?journal=' +
+            mkdtemp() + '/journal')
+
+    def tearDown(self):
+        self.striped.close()
+
+class TestThreadsafePool(TestThreadsafeStriped):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.striped = store_from_url('pool+sqlite://' + mkdtemp() +
+            '/db?pool_instances=4')
+
+class TestProcesssafeShm(TestCase):
+    def setUp(self):
+        self.shm = store_from_url('shm:?slots=65536&stripes=4')
+
+    def test_insert_difs(self):
+        '''
+        Have several forked processes simultaneously insert the same records.
+        Each record must be found new by exactly one of them.
+        '''
+        shm = self.shm
+        key = u'key'
+        records = [shm._new_difs_record(shm._hash(key,
+            [Dif(type='type', value=unicode(i))])) for i in range(1000)]
+        results = Queue()
+        def insert():
+            results.put(shm._add_difs_records_many(key, records))
+        procs = [Process(target=insert) for i in range(4)]
+        for p in procs:
+            p.start()
+        results = [results.get() for p in procs]
+        for p in procs:
+            p.join()
+        self.assertEqual(map(sum, zip(*results)), [1] * len(records))
+        self.assertEqual(shm.stats()['entries'], len(records))
+
+    def test_insert_key(self):
+        '''
+        A key registered by a forked process is seen by its parent.
+        '''
+        newkey = u'newkey'
+        p = Process(target=self.shm.register_key, args=(newkey,))
+        p.start()
+        p.join()
+        self.assertFalse(self.shm.register_key(newkey))
+        self.assertTrue(newkey in self.shm.ensure_keys([]))
+
 
 if __name__ == '__main__':
     main()
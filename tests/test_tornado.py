@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Ushahidi Inc. <jon@ushahidi.com>,
+# Joshua Bronson <jabronson@gmail.com>, and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from json import dumps, loads
+from sicds.app import SiCDSApp
+from sicds.config import SiCDSConfig
+from tornado.testing import AsyncHTTPTestCase
+from tornado_runner import make_application
+from unittest import main
+
+TESTKEY = 'test_key'
+TESTSUPERKEY = 'test_superkey'
+
+class TestTornado(AsyncHTTPTestCase):
+    '''
+    Exercises the native asynchronous server in tornado_runner.py.
+    '''
+    STORE = 'striped:'
+
+    def get_app(self):
+        config = SiCDSConfig(dict(keys=[TESTKEY], superkey=TESTSUPERKEY,
+            store=self.STORE, loggers=['store:']))
+        self.store = config.store
+        self.app = SiCDSApp(config.superkey, config.store, config.loggers,
+            keys=config.keys)
+        return make_application(self.app)
+
+    def post(self, path, body):
+        return self.fetch(path, method='POST', body=dumps(body))
+
+    def test_identify(self):
+        req = {'key': TESTKEY, 'contentItems': [{'id': 'item1',
+            'difcollections': [{'name': 'collection1',
+            'difs': [{'type': 'type1', 'value': 'value1'}]}]}]}
+        for result in ('unique', 'duplicate'):
+            resp = self.post(SiCDSApp.R_IDENTIFY, req)
+            self.assertEqual(resp.code, 200)
+            self.assertEqual(loads(resp.body), {'key': TESTKEY,
+                'results': [{'id': 'item1', 'result': result}]})
+        resp = self.post(SiCDSApp.R_IDENTIFY, dict(req, key='bad_key'))
+        self.assertEqual(resp.code, 403)
+        # every request was logged
+        self.assertEqual(len(list(self.store.iterlog())), 3)
+
+    def test_register_key(self):
+        req = {'superkey': TESTSUPERKEY, 'newkey': 'newkey'}
+        for result in ('registered', 'already registered'):
+            resp = self.post(SiCDSApp.R_REGISTER_KEY, req)
+            self.assertEqual(loads(resp.body),
+                {'key': 'newkey', 'result': result})
+
+    def test_identify_stream(self):
+        item = {'id': 'item1', 'difcollections': [{'name': 'collection1',
+            'difs': [{'type': 'type1', 'value': 'value1'}]}]}
+        body = '\n'.join(map(dumps, [{'key': TESTKEY}, item, item]))
+        resp = self.fetch(SiCDSApp.R_IDENTIFY_STREAM, method='POST',
+            body=body)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(map(loads, resp.body.splitlines()),
+            [{'id': 'item1', 'result': 'unique'},
+             {'id': 'item1', 'result': 'duplicate'}])
+
+    def test_signed_keys(self):
+        self.app.signed_keys = True
+        resp = self.post(SiCDSApp.R_REGISTER_KEY,
+            {'superkey': TESTSUPERKEY, 'newkey': 'signed'})
+        key = loads(resp.body)['key']
+        self.assertTrue(key.startswith('signed.'))
+        req = {'key': key, 'contentItems': [{'id': 'item1',
+            'difcollections': [{'name': 'collection1',
+            'difs': [{'type': 'type1', 'value': 'value1'}]}]}]}
+        self.assertEqual(self.post(SiCDSApp.R_IDENTIFY, req).code, 200)
+        # nothing was added to the store
+        self.assertNotIn(key, list(self.store.ensure_keys([])))
+
+    def test_purge_unsupported(self):
+        # the store does not partition dif records by key
+        req = {'superkey': TESTSUPERKEY, 'key': TESTKEY}
+        self.assertEqual(self.post(SiCDSApp.R_PURGE, req).code, 501)
+
+    def test_errors(self):
+        self.assertEqual(self.post('/nonexistent', {}).code, 404)
+        self.assertEqual(self.fetch(SiCDSApp.R_IDENTIFY).code, 405)
+        self.assertEqual(self.post(SiCDSApp.R_IDENTIFY, {}).code, 400)
+
+class TestTornadoNotThreadsafe(TestTornado):
+    '''
+    Same as TestTornado with a store whose calls are made from a thread of
+    its own, one at a time.
+    '''
+    STORE = 'tmp:'
+
+    def test_threadsafe(self):
+        self.assertFalse(self.app.threadsafe)
+        self.assertEqual(self.store._executor()._max_workers, 1)
+
+
+if __name__ == '__main__':
+    main()
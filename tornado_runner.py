@@ -19,16 +19,117 @@
 # Boston, MA  02110-1301
 # USA
 
-from sicds.app import getconfig, makeapp
+from sicds.app import SiCDSApp, getconfig, makeapp
+from tornado import gen
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.wsgi import WSGIContainer
+from tornado.web import Application, RequestHandler
+from webob import Request
+
+@gen.coroutine
+def identify(app, json):
+    data = app._identify_request(json)
+    try:
+        results = yield app.store.check_many_async(data.key, data.contentItems)
+    except Exception as e:
+        raise app._store_error(data.contentItems, e)
+    raise gen.Return(app._identify_response(data, results))
+
+@gen.coroutine
+def register(app, json):
+    data = app._register_request(json)
+    if app.signed_keys:
+        raise gen.Return(app._signed_register_response(data))
+    result = yield app.store.register_key_async(data.newkey)
+    raise gen.Return(app._register_response(data, result))
+
+@gen.coroutine
+def stats(app, json):
+    raise gen.Return(app._stats(json))
+
+@gen.coroutine
+def purge(app, json):
+    data = app._purge_request(json)
+    try:
+        yield app.store.purge_key_async(data.key)
+    except NotImplementedError:
+        raise app._purge_unsupported()
+    raise gen.Return(app._purge_response(data))
+
+class SiCDSHandler(RequestHandler):
+    '''
+    Serves a :class:`sicds.app.SiCDSApp` natively in Tornado. Store and
+    logger calls are made through their ``_async`` methods, so requests
+    waiting on the store overlap on the IOLoop instead of blocking it.
+    '''
+    routes = {
+        SiCDSApp.R_IDENTIFY: identify,
+        SiCDSApp.R_REGISTER_KEY: register,
+        SiCDSApp.R_STATS: stats,
+        SiCDSApp.R_PURGE: purge,
+        }
+
+    def initialize(self, app):
+        self.app = app
+
+    def _webob_request(self):
+        r = self.request
+        return Request.blank(r.uri, environ={'REMOTE_ADDR': r.remote_ip},
+            headers=r.headers, method=r.method, body=r.body)
+
+    @gen.coroutine
+    def _handle(self):
+        app = self.app
+        req = self._webob_request()
+        if req.path_info == SiCDSApp.R_IDENTIFY_STREAM:
+            # tornado has already read the whole body, so the streaming route
+            # saves no memory here, but it still takes any number of items.
+            # they are checked as they are read, in the executor
+            resp = yield app.store._submit(self._stream_response, req)
+            self._finish(resp)
+            return
+        resp = None
+        success = False
+        try:
+            reqjson = app._parse(req)
+            handler = self.routes[req.path_info]
+            respjson = yield handler(app, reqjson)
+            resp = app._response(respjson)
+            success = True
+        except Exception as e:
+            resp = app._error_response(e)
+        try:
+            # the loggers run concurrently, but their futures are waited on
+            # one at a time since tornado only hands the results of futures
+            # yielded on their own back to the IOLoop thread
+            for logged in app.log_async(req, resp, success):
+                yield logged
+        except Exception as e:
+            resp = app._log_failure_response(e, req, resp)
+        self._finish(req.get_response(resp))
+
+    def _stream_response(self, req):
+        resp = req.get_response(self.app)
+        resp.body # runs the streamed response to the end
+        return resp
+
+    def _finish(self, resp):
+        self.set_status(resp.status_int, resp.status.split(' ', 1)[1])
+        for name, value in resp.headerlist:
+            if name.lower() != 'content-length':
+                self.set_header(name, value)
+        self.finish(resp.body)
+
+    get = head = post = delete = patch = put = options = _handle
+
+def make_application(app):
+    return Application([(r'.*', SiCDSHandler, dict(app=app))])
 
 def main():
     config = getconfig()
-    application = makeapp(config)
-    container = WSGIContainer(application)
-    http_server = HTTPServer(container)
+    # stores and loggers that are not thread-safe get a thread of their own
+    application = make_application(makeapp(config))
+    http_server = HTTPServer(application)
     print('Serving on port {0}'.format(config.port))
     http_server.listen(config.port)
     IOLoop.instance().start()